@@ -0,0 +1,348 @@
+#This module contains the ResultCollector class, used to accumulate tabular
+#results (e.g. one row per ROI) without growing a DataFrame row by row,
+#which would copy the whole table at each step. It also contains the
+#functions used to read and write tables in the supported formats: csv and,
+#if pyarrow is installed, the columnar parquet and feather formats
+
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+#supported table formats, with the corresponding file extensions
+TABLE_FORMATS = {
+	'csv'     : '.csv',
+	'parquet' : '.parquet',
+	'feather' : '.feather',
+}
+
+def table_format(path):
+	"""the table format of the passed file (or parquet dataset folder), from its extension. None if not supported"""
+	ext = os.path.splitext(str(path))[1].lower()
+	for fmt, fmt_ext in TABLE_FORMATS.items():
+		if ext == fmt_ext:
+			return(fmt)
+	return(None)
+
+def _require_pyarrow(fmt):
+	"""parquet and feather need pyarrow, which is an optional dependency"""
+	try:
+		import pyarrow
+	except ImportError:
+		raise ImportError('Table format "' + fmt + '" requires the pyarrow package, please install it (e.g. pip install pyarrow) or use the csv format')
+	return(pyarrow)
+
+def read_table(infile, columns=None, dtype=None):
+	"""
+	Reads a table in any supported format (see TABLE_FORMATS), returns a DataFrame
+
+	columns: if not None, only these columns are read (columnar formats read nothing else)
+	dtype: optional {column : type} dict, as in pd.read_csv()
+	"""
+	fmt = table_format(infile)
+	if fmt == 'csv':
+		return(pd.read_csv(infile, usecols=columns, dtype=dtype))
+	_require_pyarrow(fmt)
+	if fmt == 'parquet':
+		df = pd.read_parquet(infile, columns=columns)
+	elif fmt == 'feather':
+		df = pd.read_feather(infile, columns=columns)
+	else:
+		raise ValueError('Unsupported table format: ' + str(infile))
+	if dtype is not None:
+		df = df.astype(dtype)
+	return(df)
+
+def read_table_chunks(infile, chunk_rows, columns=None):
+	"""
+	Reads a table in any supported format one chunk (a DataFrame of at most
+	chunk_rows rows) at a time, yields the chunks in order
+
+	columns: if not None, only these columns are read
+	"""
+	fmt = table_format(infile)
+	if fmt == 'csv':
+		for chunk in pd.read_csv(infile, usecols=columns, chunksize=chunk_rows):
+			yield chunk
+		return None
+	pyarrow = _require_pyarrow(fmt)
+	if fmt == 'parquet':
+		#works for both single files and partitioned datasets (folders)
+		import pyarrow.dataset
+		batches = pyarrow.dataset.dataset(infile, format='parquet', partitioning='hive').to_batches(columns=columns, batch_size=chunk_rows)
+	else:
+		#feather files are memory mapped, and read one record batch at a time
+		import pyarrow.ipc
+		reader = pyarrow.ipc.open_file(pyarrow.memory_map(str(infile)))
+		batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+		if columns is not None:
+			batches = (batch.select(columns) for batch in batches)
+	for batch in batches:
+		yield batch.to_pandas()
+	return None
+
+def iter_tables(infiles, chunk_rows, columns=None, workers=1):
+	"""
+	Reads all the passed tables in chunks, yields (infile, chunk) pairs in files order
+
+	With workers > 1 up to "workers" files are parsed at the same time by a pool of
+	threads, while the chunks of the previous files are consumed. At most "workers"
+	files are kept in memory at any time.
+	"""
+	if workers <= 1:
+		for infile in infiles:
+			for chunk in read_table_chunks(infile, chunk_rows, columns):
+				yield (infile, chunk)
+		return None
+	
+	#a sliding window of files being parsed, consumed in order
+	read_all = lambda infile: list(read_table_chunks(infile, chunk_rows, columns))
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		pending = deque()
+		infiles = iter(infiles)
+		for infile in infiles:
+			pending.append((infile, executor.submit(read_all, infile)))
+			if len(pending) >= workers:
+				break
+		while len(pending) > 0:
+			infile, future = pending.popleft()
+			chunks = future.result()
+			#keeping the pool busy
+			next_infile = next(infiles, None)
+			if next_infile is not None:
+				pending.append((next_infile, executor.submit(read_all, next_infile)))
+			for chunk in chunks:
+				yield (infile, chunk)
+	return None
+
+def union_columns(infiles):
+	"""all the columns found in the passed tables, in order of first appearance. Only headers/schemas are read"""
+	res = {}
+	for infile in infiles:
+		for column in table_columns(infile):
+			res[column] = True
+	return(list(res.keys()))
+
+def table_columns(infile):
+	"""the column names of a table in any supported format, reading only the header/schema"""
+	fmt = table_format(infile)
+	if fmt == 'csv':
+		return(list(pd.read_csv(infile, nrows=0).columns))
+	pyarrow = _require_pyarrow(fmt)
+	if fmt == 'parquet':
+		import pyarrow.dataset
+		return(pyarrow.dataset.dataset(infile, format='parquet', partitioning='hive').schema.names)
+	import pyarrow.feather
+	return(pyarrow.feather.read_table(infile, memory_map=True).schema.names)
+
+def union_schema(infiles, chunk_rows=100000):
+	"""
+	The pyarrow schema able to hold all the passed tables, columns in order of first appearance
+
+	The same column may have different types in different tables (e.g. the
+	threshold column is empty, thus float, for a flight and a string for another).
+	Columns with a single type keep it, integers mixed with floats become floats 
+	and any other mix becomes a string, as do columns without values. Parquet and
+	feather types are taken from the schema, csv ones are inferred one chunk at 
+	a time, as read by read_table_chunks()
+	"""
+	pyarrow = _require_pyarrow('parquet')
+	types = {}
+	for infile in infiles:
+		for column, arrow_type in _table_types(infile, chunk_rows):
+			types.setdefault(column, set())
+			if not pyarrow.types.is_null(arrow_type):
+				types[column].add(arrow_type)
+	return(pyarrow.schema([(column, _common_type(pyarrow, found)) for column, found in types.items()]))
+
+def _table_types(infile, chunk_rows):
+	"""(column, pyarrow type) pairs for the passed table, null for columns without values"""
+	pyarrow = _require_pyarrow('parquet')
+	fmt = table_format(infile)
+	if fmt == 'parquet':
+		import pyarrow.dataset
+		schema = pyarrow.dataset.dataset(infile, format='parquet', partitioning='hive').schema
+		return([(field.name, field.type) for field in schema])
+	if fmt == 'feather':
+		import pyarrow.ipc
+		schema = pyarrow.ipc.open_file(pyarrow.memory_map(str(infile))).schema
+		return([(field.name, field.type) for field in schema])
+	res = []
+	for chunk in read_table_chunks(infile, chunk_rows):
+		for column in chunk.columns:
+			if chunk[column].isna().all():
+				res.append((column, pyarrow.null()))
+				continue
+			try:
+				res.append((column, pyarrow.Array.from_pandas(chunk[column]).type))
+			except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+				#mixed values
+				res.append((column, pyarrow.string()))
+	return(res)
+
+def _common_type(pyarrow, found):
+	"""a pyarrow type able to hold all the passed ones, see union_schema()"""
+	if len(found) == 1:
+		return(found.pop())
+	if len(found) > 0 and all(pyarrow.types.is_integer(t) for t in found):
+		return(pyarrow.int64())
+	if len(found) > 0 and all(pyarrow.types.is_integer(t) or pyarrow.types.is_floating(t) for t in found):
+		return(pyarrow.float64())
+	return(pyarrow.string())
+
+def _to_arrow(df, schema):
+	"""converts the DataFrame to a pyarrow Table with the passed schema, values of string columns are converted to strings"""
+	pyarrow = _require_pyarrow('parquet')
+	for field in schema:
+		if (pyarrow.types.is_string(field.type) or pyarrow.types.is_large_string(field.type)) and field.name in df.columns:
+			values = df[field.name]
+			df[field.name] = values.astype(str).where(values.notna(), None)
+	return(pyarrow.Table.from_pandas(df, schema=schema, preserve_index=False))
+
+def write_table(df, outfile, partition_cols=None):
+	"""
+	Writes the DataFrame in the format given by the outfile extension (see TABLE_FORMATS)
+
+	partition_cols: parquet only, if not None outfile is a folder containing one
+	                subfolder per value of the passed columns (a partitioned dataset)
+	"""
+	fmt = table_format(outfile)
+	if fmt == 'csv':
+		df.to_csv(outfile, index=False)
+		return None
+	_require_pyarrow(fmt)
+	if fmt == 'parquet' and partition_cols is not None:
+		#writing the new dataset aside, then replacing the old one (parquet would just add files to it)
+		tmpfolder = str(outfile) + '.tmp'
+		shutil.rmtree(tmpfolder, ignore_errors=True)
+		df.to_parquet(tmpfolder, index=False, partition_cols=partition_cols)
+		if os.path.isdir(outfile):
+			shutil.rmtree(outfile)
+		elif os.path.isfile(outfile):
+			os.remove(outfile)
+		os.replace(tmpfolder, outfile)
+	elif fmt == 'parquet':
+		df.to_parquet(outfile, index=False)
+	elif fmt == 'feather':
+		df.reset_index(drop=True).to_feather(outfile)
+	else:
+		raise ValueError('Unsupported table format: ' + str(outfile))
+	return None
+
+class ResultCollector:
+	"""
+	Collects rows (dicts) and/or tables (DataFrames), builds a single table at the end
+
+	Rows are kept as a list of records and converted to a DataFrame in one go.
+	If an outfile and flush_rows are specified the collected rows are appended
+	to outfile every flush_rows rows, so that memory stays flat even for very
+	long tables. In this case the table is never kept in memory as a whole.
+	The outfile format is given by its extension (see TABLE_FORMATS). Feather
+	files cannot be appended to, and are always written at once. If 
+	partition_cols is specified the outfile is a partitioned parquet dataset
+	(see write_table()), built aside and moved in place when saved. Parquet
+	chunks are written with the passed pyarrow schema or, if None, with the
+	one of the first chunk (see union_schema() when tables are merged).
+	"""
+	def __init__(self, outfile=None, flush_rows=None, columns=None, partition_cols=None, schema=None):
+		self.outfile = outfile
+		self.flush_rows = flush_rows
+		self.partition_cols = partition_cols
+		#if None the columns are taken from the first flushed chunk
+		self.columns = columns
+		self.records = []
+		self.frames = []
+		self.pending_rows = 0
+		self.flushed_rows = 0
+		#for parquet files, open between flushes
+		self.writer = None
+		self.schema = schema
+
+	def append(self, row):
+		"""adds a single row, passed as a {column : value} dict"""
+		self.records.append(row)
+		self.pending_rows += 1
+		self._flush_if_needed()
+
+	def append_frame(self, df):
+		"""adds all the rows of the passed DataFrame"""
+		self._records_to_frame()
+		self.frames.append(df)
+		self.pending_rows += len(df.index)
+		self._flush_if_needed()
+
+	def to_dataframe(self):
+		"""returns all the rows collected (and not yet flushed) as a single DataFrame"""
+		self._records_to_frame()
+		if len(self.frames) == 0:
+			return(pd.DataFrame(columns=self.columns))
+		if len(self.frames) > 1:
+			#concatenating once, and keeping the result for further calls
+			self.frames = [pd.concat(self.frames, ignore_index=True)]
+		return(self.frames[0])
+
+	def save(self):
+		"""writes all the collected rows to outfile, appending to what was already flushed"""
+		if self.outfile is None:
+			raise ValueError('ResultCollector: no outfile specified, cannot save')
+		self._flush()
+		if self.writer is not None:
+			self.writer.close()
+			self.writer = None
+		if self.partition_cols is not None:
+			#replacing the old dataset, if any
+			if os.path.isdir(self.outfile):
+				shutil.rmtree(self.outfile)
+			elif os.path.isfile(self.outfile):
+				os.remove(self.outfile)
+			os.replace(str(self.outfile) + '.tmp', self.outfile)
+
+	def _flush_if_needed(self):
+		if self.outfile is not None and self.flush_rows is not None and self.pending_rows >= self.flush_rows and table_format(self.outfile) != 'feather':
+			self._flush()
+
+	def _flush(self):
+		"""appends the collected rows to the outfile, then forgets them"""
+		df = self.to_dataframe()
+		if self.columns is None:
+			self.columns = list(df.columns)
+		elif len(set(df.columns) - set(self.columns)) > 0:
+			raise ValueError('Found new columns after the table header was written: ' + str(sorted(set(df.columns) - set(self.columns))))
+		df = df.reindex(columns=self.columns)
+		first_chunk = self.flushed_rows == 0
+		fmt = table_format(self.outfile)
+		if fmt == 'parquet':
+			#all chunks share the same schema, the passed one or the one of the first chunk
+			pyarrow = _require_pyarrow(fmt)
+			import pyarrow.parquet
+			if self.schema is None:
+				self.schema = pyarrow.Table.from_pandas(df, preserve_index=False).schema
+			table = _to_arrow(df, self.schema)
+		if fmt == 'parquet' and self.partition_cols is not None:
+			#each chunk adds files to the partitions
+			tmpfolder = str(self.outfile) + '.tmp'
+			if first_chunk:
+				shutil.rmtree(tmpfolder, ignore_errors=True)
+				os.makedirs(tmpfolder)
+			if len(df.index) > 0:
+				pyarrow.parquet.write_to_dataset(table, tmpfolder, partition_cols=self.partition_cols, 
+					basename_template='part-' + str(self.flushed_rows) + '-{i}.parquet')
+		elif fmt == 'parquet':
+			#each chunk becomes a row group
+			if self.writer is None:
+				self.writer = pyarrow.parquet.ParquetWriter(self.outfile, self.schema)
+			self.writer.write_table(table)
+		elif fmt == 'feather':
+			write_table(df, self.outfile)
+		else:
+			df.to_csv(self.outfile, index=False, mode='w' if first_chunk else 'a', header=first_chunk)
+		self.flushed_rows += len(df.index)
+		self.frames = []
+		self.pending_rows = 0
+
+	def _records_to_frame(self):
+		"""moves the collected records into a DataFrame, keeping the insertion order"""
+		if len(self.records) > 0:
+			self.frames.append(pd.DataFrame.from_records(self.records))
+			self.records = []
@@ -12,6 +12,7 @@ import configparser
 import os
 import pprint
 
+import d2r.misc
 from d2r.dataset import dataset_factory
 from d2r.render import render_factory
 from d2r.task import task_factory
@@ -65,3 +66,29 @@ def read_config(infile):
 			raise ValueError('Bad section name: ' + op)
 	
 	return(datasets, tasks, renders)
+
+def read_run_config(infile):
+	'''
+	Reads the run-wide options from the DEFAULT section of the config file,
+	returns a dict with all keys to lower case and defaults filled in
+	'''
+	config = configparser.ConfigParser(interpolation = configparser.ExtendedInterpolation())
+	config.read(infile)
+	res = d2r.misc.parse_config(config['DEFAULT'])
+	
+	#default values
+	if 'cores' not in res:
+		res['cores'] = 1
+	if 'loop_order' not in res:
+		res['loop_order'] = 'task'
+	res['gdal_cachemax'] = int(res['gdal_cachemax']) if 'gdal_cachemax' in res else None
+	if 'parallel_jobs' in res:
+		res['parallel_jobs'] = d2r.misc.parse_boolean(res['parallel_jobs'])
+	else:
+		res['parallel_jobs'] = False
+	
+	#sanity
+	if res['loop_order'] not in ['task', 'dataset']:
+		raise ValueError('loop_order should be either "task" or "dataset", instead was: ' + res['loop_order'])
+	
+	return(res)
@@ -4,15 +4,38 @@
 import numpy as np
 import warnings
 from osgeo import gdal
+from osgeo import gdal_array
+from osgeo import ogr
 from osgeo import osr
 from skimage.draw import polygon
 import geopandas as gpd
+import shapely
 import configparser
+import hashlib
+import copy
 
+import os
 import os.path
 import d2r.config
 import d2r.misc
 import d2r.logger
+import d2r.raster_block
+import d2r.roi_cache
+import d2r.ordering
+import d2r.read_planner
+
+#supported working data types, see Dataset.get_block_dtype()
+DTYPES = ['native', 'float32', 'float64']
+
+#supported resampling algorithms, as named in the config file and as required by
+#(in order): BuildOverviews(), gdal.Translate() and ReadAsArray()
+RESAMPLING = {
+	'nearest'  : ('NEAREST',  'near',     gdal.GRIORA_NearestNeighbour),
+	'average'  : ('AVERAGE',  'average',  gdal.GRIORA_Average),
+	'bilinear' : ('BILINEAR', 'bilinear', gdal.GRIORA_Bilinear),
+	'cubic'    : ('CUBIC',    'cubic',    gdal.GRIORA_Cubic),
+	'mode'     : ('MODE',     'mode',     gdal.GRIORA_Mode),
+}
 
 def dataset_factory(title, config):
 	if not config.getboolean('active'):
@@ -42,9 +65,33 @@ class Dataset:
 		
 		#parsing meta, config
 		(self.config, self.meta) = self.parse_config(config)
-			
-		#we are ready to initialize the data
-		self.__load()
+		
+		#the channels of all the orthomosaics, in order
+		self.channels = []
+		for key in self.datasources:
+			self.channels = self.channels + self.datasources[key][1]
+
+		#the ROIs label image is built only if requested, see get_label_image()
+		self.labels = None
+		self.overlapping_ROIs = set()
+		
+		#the data is actually opened at first access, see open()
+		self._ds = None
+		self._nodata_read = False
+		self._shapes = None
+		self._geom_index = None
+		self._windows = None
+		self._ROI_status = None
+
+		#the ROIs raster blocks caches (one per channel subset), built only if configured, see get_roi_cache()
+		self._roi_cache = {}
+		
+		#cheap check: all the files should at least exist (GDAL virtual
+		#file systems, e.g. /vsicurl/, are checked only when opened)
+		(ortho, shapes) = self.get_files()
+		for f in ortho + [shapes]:
+			if not f.startswith('/vsi') and not os.path.isfile(f):
+				raise FileNotFoundError('Dataset ' + self.title + ', file does not exist: ' + f)
 
 	def parse_config(self, config):
 		"""the basic parsing of the config object, returns two dict (config and meta), all keys to lower case"""
@@ -60,8 +107,18 @@ class Dataset:
 		orthofiles = {}
 		channels = {}
 		
-		#and here we set a default
+		#and here we set some defaults
 		res['max_value'] = None
+		res['label_image'] = False
+		res['overviews'] = False
+		res['overviews_folder'] = None
+		res['resampling'] = 'nearest'
+		res['join_mode'] = 'lazy'
+		res['warp_cache_folder'] = None
+		res['dtype'] = 'float64'
+		res['roi_cache_folder'] = None
+		res['roi_cache_memory'] = 0
+		res['read_buffer'] = 64
 		
 		#for each available parameter
 		for key in config:
@@ -71,12 +128,14 @@ class Dataset:
 				orthofiles[key] = config[key]
 			elif key.startswith('channels'):
 				channels[key] = config[key]
-			elif key in ['max_value', 'nodata']:
+			elif key in ['max_value', 'nodata', 'roi_cache_memory', 'read_buffer']:
 				res[key] = float(config[key])
 			elif key == 'visible_channels':
 				res[key] = d2r.misc.parse_channels(config[key])
 			elif key == 'shapes_index':
 				res[key] = ''.join(config[key].split()).split(',')
+			elif key in ['label_image', 'overviews']:
+				res[key] = d2r.misc.parse_boolean(config[key])
 			else:
 				#everything else is just copied
 				res[key] = config[key]
@@ -86,6 +145,12 @@ class Dataset:
 			raise ValueError('Missing "type" field for dataset: ' + self.title)
 		if 'visible_channels' not in res:
 			raise ValueError('Missing "visible_channels" field for dataset: ' + self.title)
+		if res['join_mode'] not in ['lazy', 'memory']:
+			raise ValueError('Unknown join_mode "' + res['join_mode'] + '", valid values are: lazy, memory')
+		if res['resampling'] not in RESAMPLING:
+			raise ValueError('Unknown resampling algorithm "' + res['resampling'] + '", valid values are: ' + ', '.join(RESAMPLING.keys()))
+		if res['dtype'] not in DTYPES:
+			raise ValueError('Unknown dtype "' + res['dtype'] + '", valid values are: ' + ', '.join(DTYPES))
 
 		#at this point we should have collected orthofiles and channel specs
 		self.datasources = self.parse_datasources(orthofiles, channels)
@@ -158,8 +223,36 @@ class Dataset:
 	def get_raster_size(self):
 		return (self.ds.RasterXSize, self.ds.RasterYSize)
 	def get_nodata_value(self):
+		#the config value wins, otherwise the image one is known once the 
+		#image(s) are opened, and kept after close()
+		if 'nodata' in self.config:
+			return self.config['nodata']
+		if not self._nodata_read:
+			self.__load_rasters()
 		return self.nodata
-	def get_resized_ds(self, target_width = None, target_height = None):
+
+	def get_source_dtype(self):
+		"""the numpy type able to hold the pixel values of all the bands, as stored in the image(s)"""
+		return(np.result_type(*[gdal_array.GDALTypeCodeToNumericTypeCode(self.ds.GetRasterBand(i + 1).DataType) for i in range(self.ds.RasterCount)]))
+
+	def get_read_dtype(self):
+		"""the numpy type used when reading raw pixels, as specified by the "dtype" config field"""
+		if self.config['dtype'] == 'native':
+			return(self.get_source_dtype())
+		return(np.dtype(self.config['dtype']))
+
+	def get_block_dtype(self):
+		"""
+		the floating point numpy type used for computation (missing data is NaN). With
+		dtype=native it is the smallest float type holding the image values exactly 
+		(e.g. float32 for 8 and 16 bit images)
+		"""
+		if self.config['dtype'] == 'native':
+			return(np.result_type(self.get_source_dtype(), np.float32))
+		return(np.dtype(self.config['dtype']))
+
+	def get_resized_size(self, target_width = None, target_height = None):
+		"""the (width, height) of the image resized as requested, see get_resized_ds()"""
 		#taking notes for simplicity of notation
 		width, height = self.get_raster_size()
 
@@ -173,14 +266,33 @@ class Dataset:
 		if target_height is not None and target_width is not None:
 			width = target_width
 			height = target_height
+		return(width, height)
+
+	def get_resized_ds(self, target_width = None, target_height = None):
+		width, height = self.get_resized_size(target_width, target_height)
 		
 		#resize
-		resized_ds = gdal.Translate('', self.ds, format='VRT', width=width, height=height, resampleAlg=gdal.GRA_NearestNeighbour)
+		resized_ds = gdal.Translate('', self.ds, format='VRT', width=width, height=height, resampleAlg=RESAMPLING[self.config['resampling']][1])
 
 		#done
 		return(resized_ds)
 
-	
+	def get_overview_level(self, target_width):
+		"""
+		Returns the overview level best suited for reading the image at the passed width
+		
+		That is the smallest overview still at least target_width pixels wide, or
+		None if the full resolution image should be used (no overviews available, or
+		target_width larger than the overviews)
+		"""
+		band = self.ds.GetRasterBand(1)
+		level = None
+		for i in range(band.GetOverviewCount()):
+			width = band.GetOverview(i).XSize
+			if width >= target_width and (level is None or width < band.GetOverview(level).XSize):
+				level = i
+		return(level)
+
 	def get_raster_data(self, selected_channels, output_width = None, output_height = None, rescale_to_255=True, normalize_if_possible=False):
 		"""
 		Returns raster data as a masked np ndarray
@@ -192,73 +304,120 @@ class Dataset:
 		rescale_to_255 : if True the values will be rescaled to the 0-255 range
 		normalize_if_possible : if True, and if "max_value" has been defined in config, all data will be divided by max_value, so to stay in the 0-1 ramge 
 		"""
-		#a resized gdal dataset
-		resized_ds = self.get_resized_ds(target_width = output_width, target_height = output_height)
-
-		#prepare room for output
-		raster_output = np.zeros((len(selected_channels), resized_ds.RasterYSize, resized_ds.RasterXSize))
-		
-		#getting the channels actual indexes
-		channels = [self.get_channels().index(x) for x in selected_channels]
-		
-		#copying each require channel
-		for i in range(len(channels)):
-			#putting the the channel number i the band number i+1
-			raster_output[i, :, :] = resized_ds.GetRasterBand(channels[i] + 1).ReadAsArray()
+		return(self.get_raster_block(selected_channels, output_width, output_height, rescale_to_255, normalize_if_possible).to_masked())
 
-			#TODO for single channel images we may be in need to do something like this: 
-			#raster_output[i, :, :] = resized_ds.ReadAsArray()
+	def get_raster_block(self, selected_channels, output_width = None, output_height = None, rescale_to_255=True, normalize_if_possible=False):
+		"""same as get_raster_data(), but returns a RasterBlock (missing data as NaN, see d2r.raster_block)"""
+		#the resized image size
+		width, height = self.get_resized_size(target_width = output_width, target_height = output_height)
 
-		#move from channel-first to channel-last
-		raster_output = np.moveaxis(raster_output, 0, -1)
+		#all the requested channels in a single read, directly in channel-last 
+		#format. When downsampling, reading from the closest overview (if any) 
+		#saves decoding the full resolution image
+		raster_output = self.read_window(0, 0, self.ds.RasterXSize, self.ds.RasterYSize, 
+			selected_channels = selected_channels, dtype = self.get_block_dtype(),
+			buf_xsize = width, buf_ysize = height, overview_level = self.get_overview_level(width))
 
-		#fix the nodata value, if present
+		#missing data (nodata value, if present, and invalid values) becomes NaN
 		if self.get_nodata_value() is not None:
-			raster_output = np.ma.masked_equal(raster_output, self.get_nodata_value())
-		
-		#getting rid of invalid values
-		raster_output = np.ma.masked_invalid(raster_output)
+			raster_output[raster_output == self.get_nodata_value()] = np.nan
+		raster_output[~np.isfinite(raster_output)] = np.nan
+		valid = ~np.all(np.isnan(raster_output), axis=2)
+		block = d2r.raster_block.RasterBlock(raster_output, valid, list(selected_channels))
 
 		#should we normalize?
-		if normalize_if_possible and self.config['max_value'] is not None:
-			raster_output = raster_output / self.config['max_value']
+		if normalize_if_possible:
+			block.data = self.normalize_raster(block.data)
 
 		#should we rescale to 0-255 ?
 		if rescale_to_255:
-			mymin = np.min(raster_output)
-			mymax = np.max(raster_output)
-			raster_output = 255 * (raster_output - mymin) / (mymax - mymin)
+			block.data = self.rescale_raster_to_255(block.data)
 
 		#and we are done
-		return(raster_output)
+		return(block)
+
+	def normalize_raster(self, raster):
+		"""if "max_value" has been defined in config, all data will be divided by max_value, so to stay in the 0-1 range"""
+		if self.config['max_value'] is not None:
+			raster = raster / self.config['max_value']
+		return(raster)
+
+	def rescale_raster_to_255(self, raster):
+		"""linearly rescales the raster values from the [min, max] to the 0-255 range"""
+		if np.ma.isMaskedArray(raster):
+			mymin = np.min(raster)
+			mymax = np.max(raster)
+		else:
+			#plain arrays use NaN for missing values
+			mymin = np.nanmin(raster)
+			mymax = np.nanmax(raster)
+		return(255 * ((raster - mymin) / (mymax - mymin)))
 	
-	def __load(self):
-		"""initializes the dataset structures for the corresponding datasource entry"""
-		self.ds = {}
-		
-		self.logger.info('\n---------------------------')
-		self.logger.info('DATASET ' + self.title)
-		for key in self.datasources:
-			self.__load_one_dataset(key)
+	def __getstate__(self):
+		"""GDAL handles cannot be pickled: they are dropped and reopened on the other side"""
+		state = self.__dict__.copy()
+		state['_ds'] = None
+		#the in-memory cache is not worth sending around, the on-disk one is reopened
+		state['_roi_cache'] = {}
+		return(state)
 
-		#if more than one image are loaded we join them
-		self.__join_datasets()
-		
-		#should we print some info about the resulting joined dataset?
-		if 	self.joined_sources:
-			self.logger.info(d2r.misc.tostring_gdal_info(self.ds, 'merged image', self.channels) + '\n')
-		
-		#listing visible channels
-		self.logger.info(' Visible bands (rendered as RGB): ' + str(self.config['visible_channels']) + '\n')
-			
+	def clone(self):
+		"""
+		A copy of the dataset with its own GDAL handle (opened at first access), so that
+		it can be read from another thread. Shapes and the derived structures (ROI 
+		windows and status, label image) are shared, and should be built before cloning. 
+		The ROI cache memory tier is not shared, the on-disk one is.
+		"""
+		other = copy.copy(self)
+		other.__dict__.update(self.__getstate__())
+		return(other)
+
+	@property
+	def ds(self):
+		"""the GDAL dataset (a VRT joining all orthomosaics, if more than one), opened at first access"""
+		if self._ds is None:
+			self.__load_rasters()
+		return(self._ds)
+
+	@property
+	def shapes(self):
+		"""the ROIs GeoDataFrame, in the orthomosaic CRS, read at first access"""
+		if self._shapes is None:
+			self.__load_shapes()
+		return(self._shapes)
+
+	def is_open(self):
+		"""True if the image(s) or the shapes file are currently loaded"""
+		return(self._ds is not None or self._shapes is not None)
+
+	def open(self):
+		"""opens the image(s) and reads the shapes file, if not already done. Usually there is no 
+		need to call this method, everything is opened at first access"""
+		self.ds
+		self.shapes
+
+	def close(self):
+		"""releases GDAL handles, shapes and all the derived structures. They will be reopened if needed"""
+		if self.is_open():
+			self.logger.info('closing dataset ' + self.title)
+		self._ds = None
+		self._shapes = None
+		self._geom_index = None
+		self._windows = None
+		self._ROI_status = None
+		self.labels = None
+		self.overlapping_ROIs = set()
+		self._roi_cache = {}
+
+	def __load_shapes(self):
+		"""reads the shapes file and reprojects it to the orthomosaic CRS"""
 		#opening shapes file
 		self.logger.info('opening shape file ' + self.config['shapes_file'])
-		self.shapes = gpd.read_file(self.config['shapes_file'])
-		self.logger.info('- found ' + str(len(self.shapes.index)) + ' ROIs with fields ' + str(list(self.shapes)))
+		shapes = gpd.read_file(self.config['shapes_file'])
+		self.logger.info('- found ' + str(len(shapes.index)) + ' ROIs with fields ' + str(list(shapes)))
 		self.logger.info('- fields used to uniquely identify a shape: ' + str(self.config['shapes_index']))
 
-		#at this point self.ds is a single gdal dataset (it's not a dict
-		#anymore). Let's play it safe and convert the shapefile orthomosaic 
+		#Let's play it safe and convert the shapefile orthomosaic 
 		#projection to an osr SpatialReference object
 		spatial_ref = osr.SpatialReference()
 		spatial_ref.ImportFromWkt(self.ds.GetProjection())
@@ -267,16 +426,51 @@ class Dataset:
 		proj4_string = spatial_ref.ExportToProj4()
 
 		#reproject the shapefile to match the orthomosaic's CRS
-		self.shapes = self.shapes.to_crs(proj4_string)
+		self._shapes = shapes.to_crs(proj4_string)
+
+		#a hash index from the values of the shapes_index fields to the shape 
+		#position, see get_geom_position(). Uniqueness is checked once, here
+		fields = self.config['shapes_index']
+		missing = [key for key in fields if key not in self._shapes.columns]
+		if len(missing) > 0:
+			raise ValueError('Fields listed in shapes_index are not present in the shapes file: ' + str(missing))
+		keys = list(zip(*[self._shapes[key].tolist() for key in fields]))
+		self._geom_index = {key : position for position, key in enumerate(keys)}
+		if len(self._geom_index) != len(keys):
+			duplicated = self._shapes[self._shapes.duplicated(subset=fields, keep=False)][fields]
+			raise ValueError('The fields in shapes_index do not uniquely identify the shapes, duplicated values:\n' + duplicated.to_string())
 		
+	def __load_rasters(self):
+		"""opens all the orthomosaic files and, if more than one, joins them in a single GDAL dataset"""
+		self.logger.info('\n---------------------------')
+		self.logger.info('DATASET ' + self.title)
+		sources = {}
+		for key in self.datasources:
+			sources[key] = self.__load_one_dataset(key)
+
+		#if more than one image are loaded we join them
+		self._ds = self.__join_datasets(sources)
+		
+		#should we print some info about the resulting joined dataset?
+		if 	self.joined_sources:
+			self.logger.info(d2r.misc.tostring_gdal_info(self._ds, 'merged image', self.channels) + '\n')
+		
+		#listing visible channels
+		self.logger.info(' Visible bands (rendered as RGB): ' + str(self.config['visible_channels']) + '\n')
+
+		#the geotransforms are computed once, see geo_to_pix() and pix_to_geo()
+		self.geotransform = self._ds.GetGeoTransform()
+		self.inv_geotransform = gdal.InvGeoTransform(self.geotransform)
+
 	def __load_one_dataset(self, dataset_key):
 		"""initializes the dataset structures for the corresponding datasource entry"""
 		infile = self.datasources[dataset_key][0]
 		channels = self.datasources[dataset_key][1]
 		self.logger.info('Opening image file ' + infile)
-		self.ds[dataset_key] = gdal.Open(infile, gdal.GA_ReadOnly)
-		#local copy for leaner code
-		ds =  self.ds[dataset_key]
+		if self.config['overviews']:
+			#the image, or a VRT pointing to it, with overviews
+			infile = self.__prepare_overviews(infile)
+		ds = gdal.Open(infile, gdal.GA_ReadOnly)
 		self.logger.info(d2r.misc.tostring_gdal_info(ds, dataset_key, channels))
 		
 		#check on band names
@@ -313,6 +507,7 @@ class Dataset:
 		else:
 			#storing the newfound nodata value from image file
 			self.nodata = nodata
+		self._nodata_read = True
 		self.logger.info(' - value used for nodata pixels: ' + str(self.nodata))
 		
 		#at this point we set the nodata value to what specified
@@ -323,16 +518,52 @@ class Dataset:
 
 		#we are done, print an empty line for formatting
 		self.logger.info("")
+		return(ds)
 
-	def __join_datasets(self):
-		"""joins all available gdal datasets and channels"""
+	def __prepare_overviews(self, infile):
+		"""
+		makes sure that the passed image has overviews, returns the file to be opened
+		
+		Overviews are stored in an external .ovr file next to the image or, if the
+		"overviews_folder" is specified, next to a VRT file pointing to the image
+		and created in that folder (so that the original folder is left untouched)
+		"""
+		target = infile
+		if self.config['overviews_folder'] is not None:
+			os.makedirs(self.config['overviews_folder'], exist_ok=True)
+			core, ext = d2r.misc.get_file_corename_ext(infile)
+			fingerprint = hashlib.sha1(os.path.realpath(infile).encode()).hexdigest()[0:10]
+			target = os.path.join(self.config['overviews_folder'], core + '_' + fingerprint + '.vrt')
+			if not os.path.isfile(target):
+				gdal.Translate(target, infile, format='VRT')
+
+		#are overviews already there?
+		ds = gdal.Open(target, gdal.GA_ReadOnly)
+		if ds.GetRasterBand(1).GetOverviewCount() > 0:
+			return(target)
+
+		#halving the resolution until the image fits in a few hundred pixels
+		factors = []
+		factor = 2
+		while min(ds.RasterXSize, ds.RasterYSize) / factor >= 256:
+			factors.append(factor)
+			factor = factor * 2
+		if len(factors) == 0:
+			return(target)
+		self.logger.info(' - building overviews (factors ' + str(factors) + ') for ' + target)
+		
+		#opened read-only, overviews go to an external .ovr file
+		ds.BuildOverviews(RESAMPLING[self.config['resampling']][0], factors)
+		ds = None
+		return(target)
+
+	def __join_datasets(self, sources):
+		"""joins all the passed gdal datasets (a dict), returns a single gdal dataset"""
 		#let's do the simple case: just one dataset
-		if len(self.ds) == 1:
+		if len(sources) == 1:
 			self.joined_sources = False
-			key = list(self.ds.keys())[0]
-			self.ds = self.ds[key]
-			self.channels = self.datasources[key][1]
-			return None
+			key = list(sources.keys())[0]
+			return(sources[key])
 
 		#if we get here we have two or more datasets to be joined
 		self.joined_sources = True
@@ -340,23 +571,16 @@ class Dataset:
 		if 'nodata' not in self.config:
 			raise ValueError('You defined a joined dataset with data sourced from multiple images. You need to specify a nodata field in the ini file that will be used for all bands')
 		
-		#joining the channels
-		self.channels = []
-		for key in self.datasources:
-			self.channels = self.channels + self.datasources[key][1]
-			
 		#creating a joined GDAL dataset, usign VRT (virtual raster table)
-		ds = d2r.misc.make_VRT(self.ds, self.config['verbose'], self.logger)
-
-		#at this point no dataset is open except the merged one
-		self.ds = ds
+		ds = d2r.misc.make_VRT(sources, self.config['verbose'], self.logger, 
+			lazy = self.config['join_mode'] == 'lazy', cache_folder = self.config['warp_cache_folder'])
 
 		#the nodata value needs to be specified again for the VRT
 		for i in range(1, ds.RasterCount + 1):  # Bands are 1-indexed
 			band = ds.GetRasterBand(i)
 			band.SetNoDataValue(int(self.config['nodata']))
 		
-		return(None)
+		return(ds)
 				
 	def get_reference_datasource(self):
 		"""returns the datasource key for the GDAL dataset to be used as reference for resolution"""
@@ -390,82 +614,301 @@ class Dataset:
 		Note that the two above options are incompatible, if both or none are specified an
 		error is raised. 
 		"""
-		
+		return(self.shapes.geometry.iloc[self.get_geom_position(selector)])
+
+	def get_geom_position(self, selector):
+		"""Returns the (zero-based) position in the shapes file of the geometry selected by selector, see get_geom()"""
 		#sanity
 		if not ((isinstance(selector, int)) ^ (isinstance(selector, dict))):
 			raise ValueError('Passed selector should be either an int or a dict')
 
-		#let's find the polygon requested
-		geom = None
+		#simple case, the selector is already a position
 		if isinstance(selector, int):
-			shape = self.shapes.iloc[selector, :]
-			geom = shape.geometry
-		else:
-			#building a selector with all the required fields and values
-			msg = []
-			sel = None
-			for key, value in selector.items():
-				msg.append(str(key) + '=' + str(value))
-				sel_current = self.shapes[key] == value
-				if sel is None:
-					sel = sel_current
-				else:
-					sel = sel & sel_current
-			#doing the selection
-			shape = self.shapes[sel]
-			
-			#sanity check: did we select just one row?
-			if len(shape.index) == 0:
-				raise ValueError('The choice of fields+values (from selector) selects zero polygons:\n' + ', '.join(msg))
-			if len(shape.index) > 1:
-				raise ValueError('The choice of fields+values (from selector) selects more than one polygons:\n' + ', '.join(msg))
-			
-			#if we get here all is good
-			geom = shape.iloc[0,:].geometry
+			return(selector)
+
+		#common case: the selector uses exactly the shapes_index fields, hash lookup
+		fields = self.config['shapes_index']
+		if set(selector.keys()) == set(fields):
+			key = tuple(selector[field] for field in fields)
+			#making sure the shapes (and the index) are loaded
+			self.shapes
+			if key in self._geom_index:
+				return(self._geom_index[key])
+
+		#building a selector with all the required fields and values
+		msg = []
+		sel = None
+		for key, value in selector.items():
+			msg.append(str(key) + '=' + str(value))
+			sel_current = self.shapes[key] == value
+			if sel is None:
+				sel = sel_current
+			else:
+				sel = sel & sel_current
+		#doing the selection
+		positions = np.flatnonzero(sel.to_numpy())
+		
+		#sanity check: did we select just one row?
+		if len(positions) == 0:
+			raise ValueError('The choice of fields+values (from selector) selects zero polygons:\n' + ', '.join(msg))
+		if len(positions) > 1:
+			raise ValueError('The choice of fields+values (from selector) selects more than one polygons:\n' + ', '.join(msg))
+		
+		#if we get here all is good
+		return(int(positions[0]))
+
+	def iter_geoms(self):
+		"""yields a (selector, geometry) pair for each shape, in shapes file order. See get_geom()"""
+		fields = self.config['shapes_index']
+		keys = zip(*[self.shapes[key].tolist() for key in fields])
+		for key, geom in zip(keys, self.shapes.geometry):
+			yield (dict(zip(fields, key)), geom)
+
+	def query_geoms(self, bounds, predicate='intersects'):
+		"""
+		Returns the (sorted) positions of the shapes matching a spatial query, via the shapes spatial index (STRtree)
 		
-		return(geom)
+		bounds: either a shapely geometry (e.g. a point) or a (x_min, y_min, x_max, y_max) box, georeferenced
+		predicate: the spatial relation tested, e.g. 'intersects', 'contains', 'within'
+		"""
+		if not isinstance(bounds, shapely.Geometry):
+			bounds = shapely.box(*bounds)
+		return(np.sort(self.shapes.sindex.query(bounds, predicate=predicate)))
+
+	def query_window(self, x_offset, y_offset, x_size, y_size, predicate='intersects'):
+		"""same as query_geoms(), for a window in pixel coordinates"""
+		corners = self.pix_to_geo(np.array([[x_offset, y_offset], [x_offset + x_size, y_offset + y_size]]))
+		x_min, y_min = np.min(corners, axis=0)
+		x_max, y_max = np.max(corners, axis=0)
+		return(self.query_geoms((x_min, y_min, x_max, y_max), predicate))
+
+	def get_label_image(self):
+		"""
+		Returns all the ROIs rasterized in a single label image
 		
-	def get_geom_raster(self, selector, rescale_to_255=False, normalize_if_possible=False):
+		The returned tuple is (labels, x_offset, y_offset), where labels is an
+		int32 matrix covering the union of the ROIs bounding boxes, starting
+		at pixel (x_offset, y_offset) of the orthomosaic. Each pixel contains
+		the position of the ROI covering it plus one, zero means no ROI.
+		The image is computed once, at the first invocation.
+		"""
+		if self.labels is None:
+			self.labels = self.__rasterize_shapes()
+		return(self.labels)
+
+	def __rasterize_shapes(self):
+		"""burns all ROIs in a label image, see get_label_image()"""
+		#the union of all the ROIs bounding boxes, in pixel coordinates
+		windows = self.get_ROI_windows()
+		x_offset = int(np.min(windows[:, 2]))
+		y_offset = int(np.min(windows[:, 3]))
+		x_size = int(np.max(windows[:, 0] + windows[:, 2])) - x_offset
+		y_size = int(np.max(windows[:, 1] + windows[:, 3])) - y_offset
+		self.logger.info('rasterizing ' + str(len(windows)) + ' ROIs in a ' + str(x_size) + 'x' + str(y_size) + ' label image')
+
+		#the target raster, same geotransform as the orthomosaic but shifted to the union origin
+		gt = self.ds.GetGeoTransform()
+		label_ds = gdal.GetDriverByName('MEM').Create('', x_size, y_size, 1, gdal.GDT_Int32)
+		label_ds.SetProjection(self.ds.GetProjection())
+		label_ds.SetGeoTransform((
+			gt[0] + x_offset * gt[1] + y_offset * gt[2], gt[1], gt[2],
+			gt[3] + x_offset * gt[4] + y_offset * gt[5], gt[4], gt[5]))
+
+		#an in-memory vector layer with the ROIs, the zone id as attribute
+		spatial_ref = osr.SpatialReference()
+		spatial_ref.ImportFromWkt(self.ds.GetProjection())
+		vector_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+		layer = vector_ds.CreateLayer('ROIs', srs=spatial_ref)
+		layer.CreateField(ogr.FieldDefn('zone', ogr.OFTInteger))
+		for position, geom in enumerate(self.shapes.geometry):
+			feature = ogr.Feature(layer.GetLayerDefn())
+			feature.SetField('zone', position + 1)
+			feature.SetGeometry(ogr.CreateGeometryFromWkb(geom.wkb))
+			layer.CreateFeature(feature)
+
+		#burning everything in one go
+		gdal.RasterizeLayer(label_ds, [1], layer, options=['ATTRIBUTE=zone'])
+		labels = label_ds.GetRasterBand(1).ReadAsArray()
+
+		#a pixel can hold a single zone id: ROIs overlapping other ROIs
+		#cannot use the label image and are rasterized one by one
+		left, right = self.shapes.sindex.query(self.shapes.geometry, predicate='intersects')
+		overlapping = (left != right) & ~self.shapes.geometry.iloc[left].touches(self.shapes.geometry.iloc[right], align=False).to_numpy()
+		self.overlapping_ROIs = set(left[overlapping].tolist())
+		if len(self.overlapping_ROIs) > 0:
+			self.logger.info('- ' + str(len(self.overlapping_ROIs)) + ' overlapping ROIs will be rasterized one by one')
+
+		return(labels, x_offset, y_offset)
+
+	def get_geom_raster(self, selector, rescale_to_255=False, normalize_if_possible=False, selected_channels=None):
 		"""
 		Returns the raster data for the specified polygon
 		
 		Loads in memory and returns the raster data inside the specified polygon as a
-		clipped numpy ndarray in the (rows, columns, channel) order. 
+		clipped numpy masked ndarray in the (rows, columns, channel) order. 
 		
 		selector: see get_geom()
 		normalize_if_possible : if True, and if "max_value" has been defined in config, all data will be divided by max_value, so to stay in the 0-1 ramge 
 		rescale_to_255 : if True the values will be rescaled to the 0-255 range
+		selected_channels : names of the channels to be read (in this order), all if None
+		
+		Returns None if the polygon is completely outside the image, see get_ROI_status()
 		"""
+		block = self.get_geom_block(selector, rescale_to_255, normalize_if_possible, selected_channels)
+		if block is None:
+			return(None)
+		return(block.to_masked())
+
+	def get_geom_block(self, selector, rescale_to_255=False, normalize_if_possible=False, selected_channels=None):
+		"""
+		Same as get_geom_raster(), but returns a RasterBlock: a float ndarray where
+		pixels outside the polygon (or missing) are NaN, plus a single 2D validity 
+		mask. See d2r.raster_block
+		"""
+		if selected_channels is None:
+			selected_channels = self.get_channels()
+
 		#getting the requested geometry (or die trying)
-		geom = self.get_geom(selector)
+		position = self.get_geom_position(selector)
+
+		#the raw block, from the cache if possible
+		cache = self.get_roi_cache(selected_channels)
+		block = None if cache is None else cache.get(position)
+		if block is None:
+			if self.get_ROI_status()[position] == 'outside':
+				return(None)
+			#the bounding box for the geometry, data is in channel-last format at this point
+			x_size, y_size, x_offset, y_offset = self.get_ROI_windows()[position]
+			window = self.get_window_raster(*self.__clip_window(x_offset, y_offset, x_size, y_size), dtype=self.get_block_dtype(), selected_channels=selected_channels)
+			block = self.__mask_geom_block(position, window, max(x_offset, 0), max(y_offset, 0), selected_channels)
+			if cache is not None:
+				block = cache.put(position, block)
+
+		#normalization and rescaling, if requested
+		return(self.__finalize_block(block, rescale_to_255, normalize_if_possible))
+
+	def iter_geom_blocks(self, positions, rescale_to_255=False, normalize_if_possible=False, selected_channels=None):
+		"""
+		Same as get_geom_block() for many ROIs, passed as positions in the shapes file. 
+		Yields (position, RasterBlock) pairs in the passed order, the block is None for ROIs
+		outside the image
+		
+		Consecutive ROIs close on the image are read together in a single window, 
+		up to "read_buffer" MB (see d2r.read_planner), and then sliced out of it. 
+		ROIs should then be spatially sorted, see get_ROI_order()
+		"""
+		if selected_channels is None:
+			selected_channels = self.get_channels()
+		cache = self.get_roi_cache(selected_channels)
+		status = self.get_ROI_status()
+
+		#only ROIs not in cache, and at least partially inside the image, are read
+		cached = {}
+		to_read = []
+		for position in positions:
+			block = None if cache is None else cache.get(position)
+			if block is not None:
+				cached[position] = block
+			elif status[position] != 'outside':
+				to_read.append(position)
+		bytes_per_pixel = len(selected_channels) * np.dtype(self.get_block_dtype()).itemsize
+		groups = d2r.read_planner.plan_reads(self.get_ROI_windows(), to_read, self.get_block_size(), 
+			(self.ds.RasterXSize, self.ds.RasterYSize), self.config['read_buffer'] * 1024 * 1024, bytes_per_pixel)
+		group_of = {position : group for group in groups for position in group.positions}
+
+		#the window of the current group, read when its first ROI is reached
+		current_group = None
+		window = None
+		for position in positions:
+			block = cached.get(position)
+			if block is None and position in group_of:
+				if group_of[position] is not current_group:
+					current_group = group_of[position]
+					window = self.get_window_raster(*current_group.window, dtype=self.get_block_dtype(), selected_channels=selected_channels)
+				block = self.__mask_geom_block(position, window, current_group.window[0], current_group.window[1], selected_channels)
+				if cache is not None:
+					block = cache.put(position, block)
+			if block is not None:
+				block = self.__finalize_block(block, rescale_to_255, normalize_if_possible)
+			yield (position, block)
+
+	def __clip_window(self, x_offset, y_offset, x_size, y_size):
+		"""the part of the passed window that is inside the image, as (x_offset, y_offset, x_size, y_size)"""
+		x_start, y_start = max(x_offset, 0), max(y_offset, 0)
+		x_end, y_end = min(x_offset + x_size, self.ds.RasterXSize), min(y_offset + y_size, self.ds.RasterYSize)
+		return(x_start, y_start, x_end - x_start, y_end - y_start)
+
+	def __mask_geom_block(self, position, window, window_x, window_y, selected_channels):
+		"""
+		Builds the RasterBlock for the geometry in the passed position out of a raster
+		window (whose top left corner is in window_x, window_y) containing the part of
+		the ROI inside the image. The window is not modified, see iter_geom_blocks()
+		"""
+		geom = self.shapes.geometry.iloc[position]
+		x_size, y_size, x_offset, y_offset = self.get_ROI_windows()[position]
 		
-		#extract the bounding box for the geometry from the raster dataset
-		#data is in channel-last at this point format
-		raster_box = self.get_bounding_box_raster(geom)
+		#the ROI bounding box, as a view on the window. Parts outside the image are missing data
+		x_start, y_start, x_inside, y_inside = self.__clip_window(x_offset, y_offset, x_size, y_size)
+		raster_box = window[y_start - window_y : y_start - window_y + y_inside, x_start - window_x : x_start - window_x + x_inside, :]
+		if self.get_ROI_status()[position] == 'partial':
+			padded = np.full((y_size, x_size, len(selected_channels)), np.nan, dtype=raster_box.dtype)
+			padded[y_start - y_offset : y_start - y_offset + y_inside, x_start - x_offset : x_start - x_offset + x_inside, :] = raster_box
+			raster_box = padded
 		
-		#mask the raster box with the current geometry
-		mask = self.get_geom_clipmask(geom)
+		#the pixels inside the current geometry, the same 2D mask is used for all channels
+		valid = ~self.get_geom_clipmask_2d(geom, position)
 		
-		#fix the nodata value, if present
+		#missing data: NaN and the nodata value, if present
+		missing = np.isnan(raster_box)
 		if self.get_nodata_value() is not None:
-			second_mask = np.ma.getmask(np.ma.masked_equal(raster_box, self.get_nodata_value()))
-			mask = np.logical_or(mask, second_mask)
-			
-		#applying the designed mask
-		raster_box = np.ma.masked_array(raster_box, mask)
+			missing = missing | (raster_box == self.get_nodata_value())
+		valid = valid & ~np.all(missing, axis=2)
+		
+		#the only copy: the block data, NaN outside the geometry and where missing
+		data = np.where(valid[:, :, np.newaxis] & ~missing, raster_box, np.nan).astype(raster_box.dtype, copy=False)
+		return(d2r.raster_block.RasterBlock(data, valid, list(selected_channels)))
 
+	def __finalize_block(self, block, rescale_to_255, normalize_if_possible):
+		"""applies normalization and rescaling (if requested) to a raw block, see get_geom_block()"""
 		#should we normalize?
-		if normalize_if_possible and self.config['max_value'] is not None:
-			raster_box = raster_box / self.config['max_value']
+		if normalize_if_possible:
+			block.data = self.normalize_raster(block.data)
 		
 		#should we rescale to 0-255 ?
 		if rescale_to_255:
-			mymin = np.min(raster_box)
-			mymax = np.max(raster_box)
-			raster_box = 255 * ((raster_box - mymin) / (mymax - mymin))
+			block.data = self.rescale_raster_to_255(block.data)
 
 		#and we are done
-		return(raster_box)
+		return(block)
+
+	def get_roi_cache(self, selected_channels=None):
+		"""
+		Returns the ROIs raster blocks cache (see d2r.roi_cache) for the passed channels
+		(all if None), or None if not configured
+		
+		Cached blocks are identified by the orthomosaic(s) path and modification time, 
+		the shapes file content, the options affecting the raw pixel values, the 
+		channels read and the ROI position in the shapes file. Any change in these 
+		invalidates the cache.
+		"""
+		if self.config['roi_cache_folder'] is None and self.config['roi_cache_memory'] <= 0:
+			return(None)
+		if selected_channels is None:
+			selected_channels = self.get_channels()
+		selected_channels = tuple(selected_channels)
+		if selected_channels not in self._roi_cache:
+			(ortho, shapes) = self.get_files()
+			h = hashlib.sha1()
+			for f in ortho:
+				h.update(f.encode() if f.startswith('/vsi') else d2r.roi_cache.file_fingerprint(f).encode())
+			h.update(d2r.roi_cache.file_fingerprint(shapes, content=True).encode())
+			h.update(str((self.get_channels(), list(selected_channels), str(self.get_block_dtype()), self.get_nodata_value(), self.config['join_mode'])).encode())
+			namespace = self.title.replace(' ', '_') + '_' + h.hexdigest()[0:16]
+			self._roi_cache[selected_channels] = d2r.roi_cache.ROICache(self.config['roi_cache_folder'], 
+				int(self.config['roi_cache_memory'] * 1024 * 1024), namespace, list(selected_channels))
+			self.logger.info('ROI cache for channels ' + ', '.join(selected_channels) + ': ' + str(self.config['roi_cache_folder']) + 
+				', ' + str(self.config['roi_cache_memory']) + ' MB in memory')
+		return(self._roi_cache[selected_channels])
 
 	def get_bounding_box_size_and_offset(self, geom):
 		""""from a georeferenced geometry to pixel coordinates (size and offset)"""
@@ -473,8 +916,7 @@ class Dataset:
 		x_min, y_min, x_max, y_max = geom.bounds
 
 		# geo -> pix
-		col1, row1 = transform_coords(self.ds, point=(x_min, y_min), source='geo')
-		col2, row2 = transform_coords(self.ds, point=(x_max, y_max), source='geo')
+		((col1, row1), (col2, row2)) = self.geo_to_pix(np.array([[x_min, y_min], [x_max, y_max]]))
 		
 		#define the region of interest in the required form
 		x_size = int(abs(col1 - col2))    # Width of the subset in pixels
@@ -484,61 +926,220 @@ class Dataset:
 		
 		return(x_size, y_size, x_offset, y_offset)
 		
-	def get_bounding_box_raster(self, geom):
-		"""get the raster data for the bounding box of the passed geometry"""
+	def get_ROI_windows(self):
+		"""
+		Returns the pixel bounding boxes of all the ROIs, computed at once from the shapes bounds
+		
+		The result is an (N, 4) int array, one row per ROI in shapes file order, 
+		with columns (x_size, y_size, x_offset, y_offset), same values as 
+		get_bounding_box_size_and_offset(). Computed once, at the first invocation.
+		"""
+		if self._windows is None:
+			bounds = self.shapes.bounds.to_numpy()
+			corner1 = self.geo_to_pix(bounds[:, [0, 1]])
+			corner2 = self.geo_to_pix(bounds[:, [2, 3]])
+			self._windows = np.column_stack((
+				np.trunc(np.abs(corner1 - corner2)),
+				np.trunc(np.minimum(corner1, corner2)))).astype(int)
+		return(self._windows)
+
+	def get_ROI_status(self):
+		"""
+		Classifies all ROIs by the position of their bounding box with respect to the image
+		
+		Returns an array of strings, one per ROI in shapes file order: 'inside' (the 
+		bounding box is completely inside the image), 'partial' (partially outside,
+		the outside pixels are treated as missing data) or 'outside' (no pixel
+		in the image, the ROI can be skipped). No raster data is read. Computed 
+		once, at the first invocation.
+		"""
+		if self._ROI_status is None:
+			x_size, y_size, x_offset, y_offset = self.get_ROI_windows().T
+			width, height = self.ds.RasterXSize, self.ds.RasterYSize
+			inside = (x_offset >= 0) & (y_offset >= 0) & (x_offset + x_size <= width) & (y_offset + y_size <= height)
+			outside = (x_offset >= width) | (y_offset >= height) | (x_offset + x_size <= 0) | (y_offset + y_size <= 0)
+			self._ROI_status = np.where(inside, 'inside', np.where(outside, 'outside', 'partial'))
+		return(self._ROI_status)
+
+	def get_block_size(self):
+		"""the (x, y) size in pixels of the image blocks (tiles or strips), as stored on disk"""
+		return(tuple(self.ds.GetRasterBand(1).GetBlockSize()))
+
+	def get_ROI_order(self, method='hilbert'):
+		"""
+		The ROI positions (in shapes file order) sorted so that ROIs close on the image
+		are one after the other, to reuse the GDAL cached blocks. See d2r.ordering
+		"""
+		return(d2r.ordering.spatial_order(self.get_ROI_windows(), self.get_block_size(), method))
+
+	def get_bounding_box_raster(self, geom, dtype=None):
+		"""get the raster data for the bounding box of the passed geometry, see get_window_raster()"""
 		#getting pixel-wise size and offset of the passed geometry 
 		x_size, y_size, x_offset, y_offset = self.get_bounding_box_size_and_offset(geom)
+		return(self.get_window_raster(x_offset, y_offset, x_size, y_size, dtype))
+
+	def get_window_raster(self, x_offset, y_offset, x_size, y_size, dtype=None, selected_channels=None):
+		"""
+		get the raster data for the passed window (in pixels), in the (rows, columns, channel) order
 		
-		# Read the specified subset as an array
-		subset_array = self.ds.ReadAsArray(x_offset, y_offset, x_size, y_size)
-		
-		#we expect this to be in the shape: channel, columns, rows. But
-		#if it's a single channel raster is just columns, rows. Let's cover
-		#this case
-		if self.ds.RasterCount == 1:
-			#double check: are we in the correct case?
-			if subset_array.shape != (y_size, x_size):
-				raise ValueError('Unexpected shape, found', subset_array.shape, 'expected', (y_size, x_size))
-			#let's now add an axis, with a single slot
-			subset_array = np.expand_dims(subset_array, axis=0)
-		
-		#we check that we are in the expected case of channel-first
-		#then move to channel-last format
-		if subset_array.shape[0] != self.ds.RasterCount:
-			raise ValueError('Data is not channel-first format')
-		subset_array = np.moveaxis(subset_array, 0, -1)
+		dtype: the numpy type of the returned array. If None, the one from get_read_dtype()
+		selected_channels: names of the channels to be read (in this order), all if None
+		"""
+		return(self.read_window(x_offset, y_offset, x_size, y_size, selected_channels=selected_channels, dtype=dtype))
+
+	def get_interleave(self):
+		"""how the image stores the bands, either 'PIXEL' (all bands of a pixel together) or 'BAND' (one band after the other)"""
+		interleave = self.ds.GetMetadataItem('INTERLEAVE', 'IMAGE_STRUCTURE')
+		#joined images (VRTs) do not declare it, but are better read all together
+		if interleave is None:
+			return('PIXEL')
+		return(interleave.upper())
+
+	def read_window(self, x_offset, y_offset, x_size, y_size, selected_channels=None, dtype=None, buf_xsize=None, buf_ysize=None, overview_level=None):
+		"""
+		Reads a window (in pixels) of the raster, returns an ndarray in the (rows, columns, channel) order
+		
+		selected_channels: names of the channels to be read, all if None
+		dtype: the numpy type of the returned array. If None, the one from get_read_dtype()
+		buf_xsize, buf_ysize: size of the returned array, if different from the window
+		                      the data is resampled (see "resampling" config field)
+		overview_level: if not None, data is read from that overview (see get_overview_level())
+		
+		For pixel-interleaved images all channels are read in a single call, so that
+		each image block is decoded once. For band-interleaved images (or when 
+		reading from an overview) channels are read one at a time. In both cases 
+		GDAL writes directly in the returned array, no copy is made.
+		"""
+		if selected_channels is None:
+			selected_channels = self.get_channels()
+		if dtype is None:
+			dtype = self.get_read_dtype()
+		if buf_xsize is None:
+			buf_xsize = x_size
+		if buf_ysize is None:
+			buf_ysize = y_size
+		band_list = [self.get_channels().index(x) + 1 for x in selected_channels]
+		resample_alg = RESAMPLING[self.config['resampling']][2]
+
+		#the output buffer is allocated in channel-last format, and GDAL is
+		#asked to fill it through a channel-first view
+		subset_array = np.empty((buf_ysize, buf_xsize, len(band_list)), dtype=dtype)
+		
+		if overview_level is None and self.get_interleave() == 'PIXEL':
+			#single bands are read as a plain (rows, columns) matrix
+			buf_obj = subset_array[:, :, 0] if len(band_list) == 1 else np.moveaxis(subset_array, -1, 0)
+			res = self.ds.ReadAsArray(x_offset, y_offset, x_size, y_size, buf_obj=buf_obj, 
+				buf_xsize=buf_xsize, buf_ysize=buf_ysize, resample_alg=resample_alg, band_list=band_list)
+		else:
+			for i in range(len(band_list)):
+				band = self.ds.GetRasterBand(band_list[i])
+				x_off, y_off, x_sz, y_sz = x_offset, y_offset, x_size, y_size
+				if overview_level is not None:
+					#the window, in the overview coordinates
+					band = band.GetOverview(overview_level)
+					fx = band.XSize / self.ds.RasterXSize
+					fy = band.YSize / self.ds.RasterYSize
+					x_off, y_off = int(round(x_offset * fx)), int(round(y_offset * fy))
+					x_sz = min(max(1, int(round(x_size * fx))), band.XSize - x_off)
+					y_sz = min(max(1, int(round(y_size * fy))), band.YSize - y_off)
+				res = band.ReadAsArray(x_off, y_off, x_sz, y_sz, buf_obj=subset_array[:, :, i], 
+					buf_xsize=buf_xsize, buf_ysize=buf_ysize, resample_alg=resample_alg)
+				if res is None:
+					break
+		
+		if res is None:
+			raise ValueError('Cannot read window ' + str((x_offset, y_offset, x_size, y_size)) + ' from a ' + 
+				str(self.ds.RasterXSize) + 'x' + str(self.ds.RasterYSize) + ' image')
 
 		return(subset_array)
 
+	def iter_tiles(self, x_offset=0, y_offset=0, x_size=None, y_size=None, tile_size=512, selected_channels=None, dtype=None):
+		"""
+		Reads the passed window (the whole image by default) one tile at a time
+		
+		Yields (x_offset, y_offset, data) tuples, with data as returned by read_window()
+		and tiles as computed by iter_windows(). Only one tile is kept in memory at a time.
+		"""
+		if x_size is None:
+			x_size = self.ds.RasterXSize - x_offset
+		if y_size is None:
+			y_size = self.ds.RasterYSize - y_offset
+		for tile_x, tile_y, tile_x_size, tile_y_size in self.iter_windows(x_offset, y_offset, x_size, y_size, tile_size):
+			yield (tile_x, tile_y, self.read_window(tile_x, tile_y, tile_x_size, tile_y_size, selected_channels=selected_channels, dtype=dtype))
+
+	def iter_windows(self, x_offset, y_offset, x_size, y_size, tile_size=512):
+		"""
+		Splits the passed window (in pixels) in tiles aligned to the raster blocks
+		
+		Yields (x_offset, y_offset, x_size, y_size) tuples, clipped to the
+		raster extent. Each tile spans an integer number of blocks, and at
+		least tile_size pixels per side (unless the block itself is larger, e.g.
+		for striped tiffs where a block is a whole row).
+		"""
+		block_x, block_y = self.ds.GetRasterBand(1).GetBlockSize()
+		step_x = block_x * max(1, tile_size // block_x)
+		step_y = block_y * max(1, tile_size // block_y)
+
+		#clipping to the raster
+		x_start = max(x_offset, 0)
+		y_start = max(y_offset, 0)
+		x_end = min(x_offset + x_size, self.ds.RasterXSize)
+		y_end = min(y_offset + y_size, self.ds.RasterYSize)
+
+		#tiles start on block boundaries
+		for row in range((y_start // step_y) * step_y, y_end, step_y):
+			for col in range((x_start // step_x) * step_x, x_end, step_x):
+				tile_x = max(col, x_start)
+				tile_y = max(row, y_start)
+				yield (tile_x, tile_y, min(col + step_x, x_end) - tile_x, min(row + step_y, y_end) - tile_y)
+
 	def get_geom_clipmask(self, geom):
-		"""get a raster clipmask for the passed geometry"""
+		"""get a raster clipmask for the passed geometry, in the (rows, columns, channel) format"""
+		mask = self.get_geom_clipmask_2d(geom)
+		return(np.repeat(mask[:, :, np.newaxis], self.ds.RasterCount, axis=2).astype(self.get_block_dtype()))
+
+	def get_geom_clipmask_2d(self, geom, position=None):
+		"""
+		get a 2D boolean clipmask for the passed geometry, True outside the geometry
+		
+		If the dataset is configured to use a label image and the geometry
+		position in the shapes file is passed the mask is a simple comparison
+		on the label image, otherwise the polygon is rasterized on the spot.
+		"""
 		#getting pixel-wise size and offset of the passed geometry 
 		x_size, y_size, x_offset, y_offset = self.get_bounding_box_size_and_offset(geom)
+
+		#the cheap way: a slice of the label image
+		if self.config['label_image'] and position is not None:
+			labels, labels_x, labels_y = self.get_label_image()
+			if position not in self.overlapping_ROIs:
+				window = labels[y_offset - labels_y : y_offset - labels_y + y_size, x_offset - labels_x : x_offset - labels_x + x_size]
+				return(window != position + 1)
 		
 		#let's build a mask where to rasterize the geometry
-		mask = np.ones((y_size, x_size, self.ds.RasterCount))
-
-		#converting the polygon coordinates to pixel coordinates
-		coords = list(geom.exterior.coords)
-		coords2 = np.zeros((len(coords), 2))
-
-		for i in range(len(coords)):
-			#from geo to pixel (absolute)
-			mycol, myrow = transform_coords(self.ds, point=(coords[i][0], coords[i][1]), source='geo')
-			#from pixel (absolute) to image (relative)
-			mycol = mycol - x_offset                      
-			myrow = myrow - y_offset
-			#storing the results
-			coords2[i,0] = mycol
-			coords2[i,1] = myrow
+		mask = np.ones((y_size, x_size), dtype=bool)
+
+		#converting the polygon coordinates from geo to pixel (absolute), 
+		#then from pixel (absolute) to image (relative)
+		coords2 = self.geo_to_pix(np.asarray(geom.exterior.coords)[:, 0:2])
+		coords2 = coords2 - (x_offset, y_offset)
 			
-		#drawing the polygon
-		rr, cc = polygon(coords2[:,1], coords2[:,0], mask.shape)
-		mask[rr, cc, :] = 0
+		#drawing the polygon. skimage tests the integer coordinates, shifting by 
+		#half a pixel tests the pixel centers instead, as GDAL does for the label image
+		rr, cc = polygon(coords2[:,1] - 0.5, coords2[:,0] - 0.5, mask.shape)
+		mask[rr, cc] = False
 		
 		#masking the original raster
 		return(mask)
 
+	def geo_to_pix(self, coords):
+		"""converts an (N, 2) array of georeferenced coordinates to (column, row) pixel coordinates"""
+		return(transform_coords_array(self.inv_geotransform, coords))
+
+	def pix_to_geo(self, coords):
+		"""converts an (N, 2) array of (column, row) pixel coordinates to georeferenced coordinates"""
+		return(transform_coords_array(self.geotransform, coords))
+
 	def get_geom_centroid(self, selector):
 		""""returns the passed geometry centroid"""
 		geom = self.get_geom(selector)
@@ -549,8 +1150,8 @@ class Dataset:
 		#getting pixel-wise limits of the passed geometry
 		x_size, y_size, x_offset, y_offset = self.get_bounding_box_size_and_offset(geom)
 		
-		#checking if all values are inside the raster size
-		return (x_offset >= 0) and (y_offset >= 0) and (x_offset + x_size < self.ds.RasterXSize) and (y_offset + y_size < self.ds.RasterYSize)
+		#checking if all values are inside the raster size, see also get_ROI_status()
+		return (x_offset >= 0) and (y_offset >= 0) and (x_offset + x_size <= self.ds.RasterXSize) and (y_offset + y_size <= self.ds.RasterYSize)
 
 def transform_coords(ds, point, source):
 	"""
@@ -570,3 +1171,27 @@ def transform_coords(ds, point, source):
 	if source == 'pix':
 		return gdal.ApplyGeoTransform(forward_transform, point[0], point[1])
 	raise ValueError('source needs to be either geo or pix, instead was:', str(source))
+
+def transform_coords_array(transform, coords):
+	"""
+	Applies a GDAL geotransform to many points at once
+	
+	'transform' is a six values affine transform (as returned by GetGeoTransform()
+	or gdal.InvGeoTransform()), 'coords' an (N, 2) array of (x, y) coordinates.
+	Returns an (N, 2) array with the transformed coordinates.
+	"""
+	coords = np.asarray(coords, dtype=float)
+	res = np.empty(coords.shape)
+	res[:, 0] = transform[0] + transform[1] * coords[:, 0] + transform[2] * coords[:, 1]
+	res[:, 1] = transform[3] + transform[4] * coords[:, 0] + transform[5] * coords[:, 1]
+	return(res)
+
+def exterior_coords(geoms):
+	"""
+	Returns the vertices of the exterior rings of all the passed polygons
+	
+	'geoms' is a GeoSeries (or array) of polygons. Returns a tuple (coords, index),
+	with coords an (N, 2) array of all vertices and index an array of length N 
+	containing, for each vertex, the position of its polygon in 'geoms'
+	"""
+	return(shapely.get_coordinates(shapely.get_exterior_ring(np.asarray(geoms)), return_index=True))
@@ -0,0 +1,161 @@
+#This module contains the ThresholdExpression class, used to parse the
+#"threshold" filtering expressions of the config (e.g. (NDVI > 0.3) & (thermal < 310))
+#once, instead of running them through exec() for each ROI. Only a small
+#whitelist of python syntax is accepted: numbers, names, arithmetic,
+#comparisons and logical operators. Names are resolved to matrix-returning
+#indexes or to channels, and the expression is evaluated on whole blocks
+#with numpy, computing all the needed indexes in a single batch
+
+import ast
+import operator
+import numpy as np
+
+import d2r.tasks.matrix_returning_indexes as mri
+
+#allowed operators, and their vectorized implementation
+_BINARY = {
+	ast.Add    : operator.add,
+	ast.Sub    : operator.sub,
+	ast.Mult   : operator.mul,
+	ast.Div    : operator.truediv,
+	ast.Pow    : operator.pow,
+	ast.Mod    : operator.mod,
+	ast.BitAnd : np.logical_and,
+	ast.BitOr  : np.logical_or,
+	ast.BitXor : np.logical_xor,
+}
+_UNARY = {
+	ast.USub   : operator.neg,
+	ast.UAdd   : operator.pos,
+	ast.Invert : np.logical_not,
+	ast.Not    : np.logical_not,
+}
+_COMPARE = {
+	ast.Lt    : operator.lt,
+	ast.LtE   : operator.le,
+	ast.Gt    : operator.gt,
+	ast.GtE   : operator.ge,
+	ast.Eq    : operator.eq,
+	ast.NotEq : operator.ne,
+}
+_BOOLEAN = {
+	ast.And : np.logical_and,
+	ast.Or  : np.logical_or,
+}
+
+class ThresholdExpression:
+	"""
+	A filtering expression, parsed once and evaluated on raster blocks
+
+	text: the expression, as in the "threshold" config field
+
+	After parsing, "names" contains all the names used in the expression, "indexes"
+	the ones that are matrix-returning indexes and "channels" the others, that
+	are expected to be channel names. Raises ValueError for invalid expressions.
+	"""
+	def __init__(self, text):
+		self.text = text
+		self._parse()
+
+	def __str__(self):
+		return(self.text)
+
+	def __getstate__(self):
+		"""the compiled expression cannot be pickled, it's rebuilt from the text on the other side"""
+		return({'text' : self.text})
+
+	def __setstate__(self, state):
+		self.text = state['text']
+		self._parse()
+
+	def _parse(self):
+		try:
+			tree = ast.parse(self.text.strip(), mode='eval')
+		except SyntaxError as e:
+			raise ValueError('In .ini file, cannot parse threshold expression "' + self.text + '": ' + str(e.msg))
+		names = []
+		self._evaluate = _compile(tree.body, names, self.text)
+		self.names = list(dict.fromkeys(names))
+		self.indexes = [name for name in self.names if name in mri.REQUIRED_CHANNELS]
+		self.channels = [name for name in self.names if name not in mri.REQUIRED_CHANNELS]
+
+	def evaluate(self, data, channels, planes=None):
+		"""
+		Evaluates the expression on a raster, returns a (selection, planes) tuple
+
+		data: ndarray (or masked array) in the (rows, columns, channel) order
+		channels: the channel names of data
+		planes: optional {index name : matrix} dict of already computed indexes,
+		        that are used instead of computing them again
+
+		selection is the boolean matrix of the selected pixels (masked, if data is
+		masked), planes the passed dict plus all the indexes computed to evaluate
+		the expression, so that they can be reused.
+		"""
+		planes = {} if planes is None else dict(planes)
+		dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+
+		#all missing indexes are computed at once, sharing the common terms
+		missing = [name for name in self.indexes if name not in planes]
+		if len(missing) > 0:
+			planes.update(zip(missing, mri.compute_indexes(data, channels, missing, dtype=dtype)))
+
+		#the values for each name
+		env = {name : planes[name] for name in self.indexes}
+		for name in self.channels:
+			if name not in channels:
+				raise ValueError('In .ini file, requested unknown index or channels (case sensitive): ' + name)
+			env[name] = data[:, :, channels.index(name)]
+
+		#NaN (missing data) is never selected
+		with np.errstate(invalid='ignore'):
+			selection = self._evaluate(env)
+		if np.ndim(selection) == 0:
+			selection = np.full(data.shape[0:2], bool(selection))
+		return(selection, planes)
+
+def _compile(node, names, text):
+	"""translates an ast node into a function of the {name : value} environment, raises ValueError on non whitelisted syntax"""
+	if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, bool)):
+		value = node.value
+		return(lambda env: value)
+
+	if isinstance(node, ast.Name):
+		name = node.id
+		names.append(name)
+		return(lambda env: env[name])
+
+	if isinstance(node, ast.BinOp) and type(node.op) in _BINARY:
+		op = _BINARY[type(node.op)]
+		left = _compile(node.left, names, text)
+		right = _compile(node.right, names, text)
+		return(lambda env: op(left(env), right(env)))
+
+	if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY:
+		op = _UNARY[type(node.op)]
+		operand = _compile(node.operand, names, text)
+		return(lambda env: op(operand(env)))
+
+	if isinstance(node, ast.BoolOp) and type(node.op) in _BOOLEAN:
+		op = _BOOLEAN[type(node.op)]
+		values = [_compile(value, names, text) for value in node.values]
+		def boolean(env):
+			res = values[0](env)
+			for value in values[1:]:
+				res = op(res, value(env))
+			return(res)
+		return(boolean)
+
+	if isinstance(node, ast.Compare) and all(type(op) in _COMPARE for op in node.ops):
+		#chained comparisons (e.g. 0.3 < NDVI < 0.7) are joined with a logical and
+		ops = [_COMPARE[type(op)] for op in node.ops]
+		operands = [_compile(operand, names, text) for operand in [node.left] + node.comparators]
+		def compare(env):
+			values = [operand(env) for operand in operands]
+			res = ops[0](values[0], values[1])
+			for i in range(1, len(ops)):
+				res = np.logical_and(res, ops[i](values[i], values[i + 1]))
+			return(res)
+		return(compare)
+
+	raise ValueError('In .ini file, unsupported syntax in threshold expression "' + text + '": ' + ast.unparse(node))
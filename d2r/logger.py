@@ -37,3 +37,27 @@ def get_logger(logname, config):
 	
 	#done
 	return(logger)
+
+def redirect_to_file(outfile, lognames=('d2r.task', 'd2r.dataset')):
+	"""
+	Sends the messages of the passed loggers (in the current process only) to 
+	outfile and stdout, replacing any previous handler. Used by jobs running in
+	worker processes, so that each job has its own log file. Returns the first logger
+	"""
+	os.makedirs(os.path.dirname(outfile), exist_ok=True)
+	formatter = logging.Formatter('[%(asctime)s %(levelname)s] %(message)s')
+	console_handler = logging.StreamHandler(sys.stdout)
+	console_handler.setFormatter(formatter)
+	file_handler = logging.FileHandler(outfile)
+	file_handler.setFormatter(formatter)
+	
+	for logname in lognames:
+		logger = logging.getLogger(logname)
+		for handler in list(logger.handlers):
+			logger.removeHandler(handler)
+			handler.close()
+		logger.setLevel(logging.INFO)
+		logger.addHandler(console_handler)
+		logger.addHandler(file_handler)
+	
+	return(logging.getLogger(lognames[0]))
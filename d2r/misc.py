@@ -1,4 +1,5 @@
 import os
+import hashlib
 import pandas as pd
 import numpy as np
 import skimage.draw
@@ -7,7 +8,9 @@ from osgeo import gdal
 import plotly.express as px
 
 import d2r.dataset
-import d2r.tasks.matrix_returning_indexes as mri
+import d2r.collector
+import d2r.raster_block
+import d2r.expression
 
 def find_case_insensitve(dirname, extensions):
 	"""find all files in passed folder with the passed extension, case insensitive"""
@@ -46,6 +49,11 @@ def parse_python(value):
 	"""evaluates the passed string as a python statement"""
 	return eval(value)
 
+def set_gdal_cachemax(megabytes):
+	"""sets the size of the GDAL block cache, for this process and for the ones it will start"""
+	os.environ['GDAL_CACHEMAX'] = str(megabytes)
+	gdal.SetCacheMax(megabytes * 1024 * 1024)
+
 def parse_config(config):
 	"""the basic parsing of the config object, returns a dict, all keys to lower case"""
 	res = {}
@@ -59,66 +67,64 @@ def parse_config(config):
 	return(res)
 
 def draw_ROI_perimeter(ROIs, target_img, raster_data, verbose=False, logger=None):
-	for i in range(len(ROIs.index)):
-		sh = ROIs.iloc[i,:].geometry
-		#check: is this polygon-like?
-		if not hasattr(sh, 'exterior'):
-			if verbose:
-				logger.info('Found that geometry number ' + str(i) + ' is not polygon-like, type: ' + str(type(sh)))
-			#if it's not polygon-like we cannot draw it
-			continue
-		
-		#converting the polygon coordinates to pixel coordinates
-		coords = list(sh.exterior.coords)
-		coords2 = np.zeros((len(coords), 2))
-		for i in range(len(coords)):
-			(coords2[i,0], coords2[i,1]) = d2r.dataset.transform_coords(target_img, point=(coords[i][0], coords[i][1]), source='geo')
-		
-		#drawing the polygon in red
-		rr, cc = skimage.draw.polygon_perimeter(coords2[:,1], coords2[:,0], raster_data.shape)
-		raster_data[rr, cc, :] = (255, 0, 0)
-
-def thresholded_filter(raster, channels, filter_string):
-	"""Tries to apply a filtering expression to a raster ROI, or dies trying"""
-	#this loop will either assign a value to "sel" or generate an exception and crash
-	while True:
-		try:
-			exec('sel = ' + filter_string)
-		except NameError as e:
-			#let's define the missing variable, if valid
-			found = False
-			
-			#is the missing variable an matrix-returning index function?
-			if hasattr(mri, e.name):
-				found = True
-				index_function = getattr(mri, e.name)
-				exec(e.name + '= index_function(raster, channels)')
-			
-			#is the missing variable a channel?
-			if e.name in channels:
-				found = True
-				i = channels.index(e.name)
-				exec(e.name + '= raster[:,:,i]')
-			
-			#have we found something?
-			if not found:
-				raise ValueError('In .ini file, requested unknown index or channels (case sensitive): ' + e.name)
-		
-		#checking if we need to keep going or not
-		if 'sel' in locals():
-			break
+	rr, cc = get_ROI_perimeter(ROIs, target_img, raster_data.shape, verbose, logger)
+	raster_data[rr, cc, :] = (255, 0, 0)
+
+def get_ROI_perimeter(ROIs, target_img, shape, verbose=False, logger=None):
+	"""returns the (rows, columns) pixel coordinates of all the ROIs perimeters, in the target_img gdal dataset"""
+	#check: which geometries are polygon-like?
+	polygon_like = np.array([hasattr(sh, 'exterior') for sh in ROIs.geometry], dtype=bool)
+	if verbose:
+		for i in np.flatnonzero(~polygon_like):
+			logger.info('Found that geometry number ' + str(i) + ' is not polygon-like, type: ' + str(type(ROIs.geometry.iloc[i])))
+
+	#converting all the polygon coordinates to pixel coordinates, in one go
+	#(if it's not polygon-like we cannot draw it)
+	coords, index = d2r.dataset.exterior_coords(ROIs.geometry[polygon_like])
+	inv_transform = gdal.InvGeoTransform(target_img.GetGeoTransform())
+	coords2 = d2r.dataset.transform_coords_array(inv_transform, coords)
+
+	#tracing each polygon (vertices are grouped by polygon)
+	rr = [np.empty(0, dtype=int)]
+	cc = [np.empty(0, dtype=int)]
+	for current in np.split(coords2, np.flatnonzero(np.diff(index)) + 1) if len(index) > 0 else []:
+		rr_current, cc_current = skimage.draw.polygon_perimeter(current[:,1], current[:,0], shape)
+		rr.append(rr_current)
+		cc.append(cc_current)
+	return(np.concatenate(rr), np.concatenate(cc))
+
+def thresholded_filter(raster, channels, expression):
+	"""
+	Applies a filtering expression to a raster ROI (masked array or RasterBlock), or dies trying
 	
-	#if we get here we have defined sel (in a dynamic context)
+	expression: a d2r.expression.ThresholdExpression, or its text
+	"""
+	sel = thresholded_selection(raster.data if isinstance(raster, d2r.raster_block.RasterBlock) else raster, channels, expression)
+	if isinstance(raster, d2r.raster_block.RasterBlock):
+		#a single 2D mask to update
+		return(raster.select(np.ma.filled(sel, False)))
+
 	#let's apply the newfound filtering mask to the existing one, once
 	#for each existing channel
 	for i in range(raster.mask.shape[2]):
 		#rembember that the mask tells what values to NOT use, and the
 		#user in the ini specify the target areas to ACTUALLY use. Thus,
 		#we need a logical not
-		raster.mask[:, :, i] = raster.mask[:, :, i] | np.ma.logical_not(eval('sel'))
+		raster.mask[:, :, i] = raster.mask[:, :, i] | np.ma.logical_not(sel)
 		
 	return(raster)
 
+def thresholded_selection(raster, channels, expression):
+	"""
+	Evaluates a filtering expression on a raster, returns the boolean matrix of the selected pixels
+	
+	expression: a d2r.expression.ThresholdExpression, or its text (parsed at each call)
+	"""
+	if not isinstance(expression, d2r.expression.ThresholdExpression):
+		expression = d2r.expression.ThresholdExpression(expression)
+	(sel, planes) = expression.evaluate(raster, channels)
+	return(sel)
+
 def tostring_gdal_info(ds, title, channels=None):
 	res = ''
 	"""prints information on the passed gdal dataset"""
@@ -142,10 +148,16 @@ def tostring_gdal_info(ds, title, channels=None):
 		res += " - band names: unspecified"
 	return(res)
 		
-def make_VRT(datasets, verbose = True, logger=None):
+def make_VRT(datasets, verbose = True, logger=None, lazy = True, cache_folder = None):
 	"""
 	merges all gdal datasets from a dict into a single VRT, max resolution.
-	As common, target projection it is used the one of the first dataset
+	As common, target projection it is used the one of the first dataset.
+	
+	If lazy is True all intermediate steps (reprojection, band selection) are
+	VRTs too, and no pixel is read until the returned dataset is actually
+	accessed. Otherwise all bands are copied in memory. If cache_folder is 
+	specified the reprojected images are saved there as GeoTIFF, and reused
+	in subsequent runs.
 	"""
 	
 	#extracting the SRS (spatial reference system) from the first image
@@ -153,13 +165,19 @@ def make_VRT(datasets, verbose = True, logger=None):
 	target_srs = datasets[first_key].GetProjection()
 	if verbose : logger.info('Target SRS taken from ' + str(first_key))
 	
+	#VRT is the lazy format, MEM means everything is read in memory
+	band_format = 'VRT' if lazy else 'MEM'
+	
 	if verbose : logger.info('Merging ' + str(len(datasets)) + ' images')
 	cnt = 1
 	all_stuff = []
 	for key, ds in datasets.items():
 		# Reproject into the common SRS, if needed
 		if key != first_key:
-			reprojected = gdal.Warp('', ds, dstSRS=target_srs, format='MEM', resampleAlg='cubic')
+			if cache_folder is not None:
+				reprojected = warp_cached(ds, target_srs, cache_folder, verbose, logger)
+			else:
+				reprojected = gdal.Warp('', ds, dstSRS=target_srs, format=band_format, resampleAlg='cubic')
 		else:
 			#no need to reproject here, it's by definition the same SRS
 			reprojected = ds
@@ -168,13 +186,39 @@ def make_VRT(datasets, verbose = True, logger=None):
 		cnt = cnt + 1
 		for i in range(reprojected.RasterCount):
 			if verbose: logger.info(str(i+1) + ' ')
-			all_stuff.append(gdal.Translate('', reprojected, format='MEM', bandList=[i+1]))
+			all_stuff.append(gdal.Translate('', reprojected, format=band_format, bandList=[i+1]))
 	
 	vrt = gdal.BuildVRT('', all_stuff, separate=True, resolution='highest')
 	return(vrt)
 
+def warp_cached(ds, target_srs, cache_folder, verbose = True, logger=None):
+	"""
+	reprojects the passed gdal dataset to target_srs, saving the result as a GeoTIFF
+	in cache_folder. If the file is already there (same source file, same
+	modification time, same target SRS) it is simply opened
+	"""
+	#the cache file name depends on everything that affects the result
+	infile = ds.GetDescription()
+	fingerprint = os.path.realpath(infile) + str(os.path.getmtime(infile)) + target_srs
+	fingerprint = hashlib.sha1(fingerprint.encode()).hexdigest()[0:10]
+	core, ext = get_file_corename_ext(infile)
+	outfile = os.path.join(cache_folder, core + '_warped_' + fingerprint + '.tif')
+
+	if not os.path.isfile(outfile):
+		if verbose: logger.info('Reprojecting ' + infile + ' to ' + outfile)
+		os.makedirs(cache_folder, exist_ok=True)
+		#writing to a temporary file first, so that concurrent runs never see a partial file
+		tmpfile = outfile + '.' + str(os.getpid()) + '.tmp'
+		gdal.Warp(tmpfile, ds, dstSRS=target_srs, format='GTiff', resampleAlg='cubic', 
+			creationOptions=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+		os.replace(tmpfile, outfile)
+	elif verbose: 
+		logger.info('Using cached reprojection ' + outfile)
+	
+	return(gdal.Open(outfile, gdal.GA_ReadOnly))
+
 def indexfile_to_html(infile, include_plotlyjs = False):
-	'''reads the passed .csv file, created by index tasks and returns a
+	'''reads the passed table file (any format), created by index tasks and returns a
 	   dictionary of embeddable html strings, one per dataset/index combination.
 	   Note that the default is to not include the plotly library (~3MB)
 	   which needs to be included at least once for the plot to work
@@ -183,9 +227,10 @@ def indexfile_to_html(infile, include_plotlyjs = False):
 	#all plots (each one html) will be saved into a list
 	returned_html = {}
 
-	#reading data in, check if it's in the expected format 
+	#reading data in (only the columns needed, for columnar formats), check if it's in the expected format 
 	#TODO
-	df = pd.read_csv(infile)
+	columns = [name for name in d2r.collector.table_columns(infile) if not name.endswith(('_min', '_max', '_median', '_std'))]
+	df = d2r.collector.read_table(infile, columns=columns)
 
 	#----- removing useless columns
 	#extract column names from df
@@ -0,0 +1,74 @@
+#This module contains the functions used to sort the ROIs spatially, so that
+#ROIs close on the image are processed one after the other. Since GDAL
+#caches the decoded image blocks, neighbouring ROIs reuse the blocks read for
+#the previous ones instead of decompressing them again, which is what happens
+#with a random order (e.g. hand digitized shapefiles). ROIs are sorted by the
+#image block containing their center, along a space filling curve
+
+import numpy as np
+
+#available traversal orders. "shapefile" keeps the original order
+ROI_ORDERS = ['shapefile', 'zorder', 'hilbert', 'block_row']
+
+def spatial_order(windows, block_size, method='hilbert'):
+	"""
+	Returns the ROI positions (indexes in windows), in the order they should be processed
+
+	windows: N x 4 array of ROI windows in pixels, as (x_size, y_size, x_offset, y_offset), see Dataset.get_ROI_windows()
+	block_size: (x, y) size in pixels of the image blocks, see Dataset.get_block_size()
+	method: one of ROI_ORDERS. "zorder" and "hilbert" follow the corresponding curve
+	        over the blocks grid, "block_row" goes through the ROIs one row of blocks
+	        at a time, from left to right
+
+	ROIs in the same block keep their original order.
+	"""
+	if method not in ROI_ORDERS:
+		raise ValueError('Unknown ROI order: ' + str(method) + ', valid values are: ' + ', '.join(ROI_ORDERS))
+	windows = np.asarray(windows, dtype=np.int64).reshape(-1, 4)
+	if method == 'shapefile' or len(windows) == 0:
+		return(np.arange(len(windows)))
+
+	#the block containing the center of each ROI (ROIs partially outside the image are clamped)
+	bx = np.maximum(windows[:, 2] + windows[:, 0] // 2, 0) // block_size[0]
+	by = np.maximum(windows[:, 3] + windows[:, 1] // 2, 0) // block_size[1]
+
+	if method == 'block_row':
+		return(np.lexsort((bx, by)))
+	if method == 'zorder':
+		keys = morton_keys(bx, by)
+	else:
+		keys = hilbert_keys(bx, by)
+	return(np.argsort(keys, kind='stable'))
+
+def morton_keys(x, y):
+	"""the position of the (x, y) cells along the Z-order (Morton) curve, vectorized. Coordinates up to 2^32"""
+	return(_spread_bits(x) | (_spread_bits(y) << np.uint64(1)))
+
+def _spread_bits(v):
+	"""inserts a zero bit between each bit of v"""
+	v = np.asarray(v).astype(np.uint64) & np.uint64(0xFFFFFFFF)
+	for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+		v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+	return(v)
+
+def hilbert_keys(x, y):
+	"""the position of the (x, y) cells along the Hilbert curve, vectorized"""
+	x = np.asarray(x, dtype=np.int64).copy()
+	y = np.asarray(y, dtype=np.int64).copy()
+	#the curve covers a power of two sided square
+	n = 1
+	while n <= max(int(np.max(x, initial=0)), int(np.max(y, initial=0))):
+		n = n * 2
+	keys = np.zeros(x.shape, dtype=np.int64)
+	s = n // 2
+	while s > 0:
+		rx = (x & s) > 0
+		ry = (y & s) > 0
+		keys += s * s * ((3 * rx) ^ ry)
+		#rotating the quadrant, so that the curve is continuous
+		flip = ~ry & rx
+		x = np.where(flip, n - 1 - x, x)
+		y = np.where(flip, n - 1 - y, y)
+		x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+		s = s // 2
+	return(keys)
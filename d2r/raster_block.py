@@ -0,0 +1,67 @@
+#This module contains the RasterBlock class, the internal representation of
+#a piece of raster (e.g. the bounding box of a ROI) used for computation.
+#Instead of a numpy masked array, with a boolean mask for each channel, a
+#block holds a dense float array, where missing values are NaN, and a single
+#2D validity mask shared by all channels. Plain numpy ufuncs and reductions
+#are much faster than their np.ma counterparts
+
+import numpy as np
+
+STATISTICS = ['mean', 'median', 'std', 'max', 'min']
+
+class RasterBlock:
+	"""
+	A raster block in the (rows, columns, channel) order, plus a 2D validity mask
+
+	data: float ndarray, NaN for pixels outside the ROI or missing (nodata)
+	valid: 2D boolean ndarray, True for pixels that should be used
+	channels: list of channel names, one per data[:, :, i] plane
+	"""
+	def __init__(self, data, valid, channels):
+		self.data = data
+		self.valid = valid
+		self.channels = channels
+
+	def get_channel(self, name):
+		"""the plane of the passed channel, as a (rows, columns) matrix"""
+		return(self.data[:, :, self.channels.index(name)])
+
+	def count(self):
+		"""number of valid pixels"""
+		return(int(np.count_nonzero(self.valid)))
+
+	def select(self, selection):
+		"""
+		Restricts the valid pixels to the selected ones (a 2D boolean matrix, True to keep)
+
+		The block is updated and returned, same as misc.thresholded_filter(). The
+		arrays are replaced, not modified, since they may be shared (see d2r.roi_cache)
+		"""
+		self.valid = self.valid & np.asarray(selection, dtype=bool)
+		self.data = np.where(self.valid[:, :, np.newaxis], self.data, np.nan)
+		return(self)
+
+	def to_masked(self):
+		"""the block as a numpy masked array, for functions still using the np.ma interface"""
+		mask = np.broadcast_to(~self.valid[:, :, np.newaxis], self.data.shape) | np.isnan(self.data)
+		return(np.ma.masked_array(self.data, mask))
+
+def statistics(name, values, valid=None):
+	"""
+	Summary statistics of a matrix, as a {name_stat : value} dict
+
+	Only the finite values where valid (if passed) is True are considered.
+	All statistics are np.nan if no value is available.
+	"""
+	if valid is not None:
+		values = values[valid]
+	values = values[np.isfinite(values)]
+	if len(values) == 0:
+		return({name + '_' + stat : np.nan for stat in STATISTICS})
+	return({
+		name + '_mean'   : np.mean(values),
+		name + '_median' : np.median(values),
+		name + '_std'    : np.std(values),
+		name + '_max'    : np.max(values),
+		name + '_min'    : np.min(values)
+	})
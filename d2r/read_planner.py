@@ -0,0 +1,77 @@
+#This module contains the read planner, used to read many small ROIs (e.g. a
+#grid of plots) with a few large reads instead of one tiny read per ROI.
+#Consecutive ROIs whose windows are close on the image are grouped, and each
+#group is read once as a single window aligned to the image blocks, as long
+#as it fits in a memory budget. ROIs are then sliced out of the group window.
+#Only consecutive ROIs are grouped, so that the processing order does not
+#change: ROIs should be spatially sorted (see d2r.ordering) to get large groups
+
+import numpy as np
+
+class ReadGroup:
+	"""
+	A window of the image, read at once, and the ROIs inside it
+
+	window: (x_offset, y_offset, x_size, y_size) in pixels, always inside the image
+	positions: the ROI positions (in the shapes file) covered by the window, in processing order
+	"""
+	def __init__(self, window, positions):
+		self.window = window
+		self.positions = positions
+
+def plan_reads(windows, positions, block_size, image_size, max_bytes, bytes_per_pixel):
+	"""
+	Groups the passed ROIs into windows to be read at once, returns a list of ReadGroup
+
+	windows: N x 4 array of ROI windows in pixels, as (x_size, y_size, x_offset, y_offset), see Dataset.get_ROI_windows()
+	positions: the ROIs to be read (indexes in windows), in processing order. They should
+	           be at least partially inside the image, see Dataset.get_ROI_status()
+	block_size: (x, y) size in pixels of the image blocks, see Dataset.get_block_size()
+	image_size: (x, y) size in pixels of the image
+	max_bytes: the maximum size of a group window, 0 to read each ROI by itself
+	bytes_per_pixel: size of a pixel in memory, all channels included
+
+	A ROI joins the current group if its window touches the group window, grown
+	by one block in each direction, and if the new group window fits in max_bytes.
+	Groups of a single ROI read just the ROI window.
+	"""
+	groups = []
+	#the current group, as an [x0, y0, x1, y1] block aligned box, plus the exact union of the ROI windows
+	box = None
+	exact = None
+	members = []
+	for p in positions:
+		x_size, y_size, x_offset, y_offset = windows[p]
+		#the part of the ROI inside the image
+		roi = np.array([max(x_offset, 0), max(y_offset, 0), min(x_offset + x_size, image_size[0]), min(y_offset + y_size, image_size[1])])
+		roi_box = _align(roi, block_size, image_size)
+
+		if box is not None:
+			new_box = np.concatenate((np.minimum(box[0:2], roi_box[0:2]), np.maximum(box[2:4], roi_box[2:4])))
+			near = np.all(roi_box[0:2] <= box[2:4] + block_size) and np.all(roi_box[2:4] >= box[0:2] - block_size)
+			if near and _area(new_box) * bytes_per_pixel <= max_bytes:
+				box = new_box
+				exact = np.concatenate((np.minimum(exact[0:2], roi[0:2]), np.maximum(exact[2:4], roi[2:4])))
+				members.append(p)
+				continue
+			groups.append(_make_group(box, exact, members))
+		box, exact, members = roi_box, roi, [p]
+	if box is not None:
+		groups.append(_make_group(box, exact, members))
+	return(groups)
+
+def _align(box, block_size, image_size):
+	"""expands the [x0, y0, x1, y1] box to the image blocks borders, without going outside the image"""
+	block_size = np.asarray(block_size)
+	start = (box[0:2] // block_size) * block_size
+	end = np.minimum(-(-box[2:4] // block_size) * block_size, image_size)
+	return(np.concatenate((start, end)))
+
+def _area(box):
+	return(int(box[2] - box[0]) * int(box[3] - box[1]))
+
+def _make_group(box, exact, members):
+	#a single ROI does not need the whole blocks
+	if len(members) == 1:
+		box = exact
+	return(ReadGroup((int(box[0]), int(box[1]), int(box[2] - box[0]), int(box[3] - box[1])), members))
@@ -3,7 +3,7 @@ import pathlib
 import warnings
 from d2r.render import Render
 import d2r.misc
-import pandas as pd
+import d2r.collector
 
 import pprint
 
@@ -21,19 +21,31 @@ class collect_tables(Render):
 		
 		#for each table type
 		for table_type in infiles:
-			#building a summary table
-			sumtab =  self._summary_table(infiles[table_type])
-			
-			#saving the table
-			outfile = os.path.join(outfolder, table_type + '.csv')
-			sumtab.to_csv(outfile, index=False)
-			print('Collected ' + table_type + ' table into ' + outfile)
+			#streaming the summary table to disk, in the required format (possibly partitioned)
+			outfile = os.path.join(outfolder, table_type + d2r.collector.TABLE_FORMATS[self.config['output_format']])
+			rows = self._summary_table(infiles[table_type], outfile)
+			print('Collected ' + table_type + ' table into ' + outfile + ' (' + str(rows) + ' rows)')
 
-	def _summary_table(self, infiles):
-		res = None
-		for f in infiles:
-			res = pd.concat([res, pd.read_csv(f)])
-		return res
+	def _summary_table(self, infiles, outfile):
+		"""
+		Appends all the infiles into outfile, one chunk at a time, returns the number of rows
+		
+		Tables may have different columns (e.g. different indexes per flight): the
+		summary has the union of all columns, missing values are left empty. 
+		Parquet summaries are written with a schema fitting all tables, since
+		the same column may have different types in different tables
+		"""
+		schema = None
+		if self.config['output_format'] == 'parquet':
+			schema = d2r.collector.union_schema(infiles, self.config['chunk_rows'])
+			columns = schema.names
+		else:
+			columns = d2r.collector.union_columns(infiles)
+		res = d2r.collector.ResultCollector(outfile, flush_rows=self.config['chunk_rows'], columns=columns, partition_cols=self.config['partition_by'], schema=schema)
+		for f, chunk in d2r.collector.iter_tables(infiles, self.config['chunk_rows'], workers=self.config['cores']):
+			res.append_frame(chunk)
+		res.save()
+		return(res.flushed_rows)
 
 	def _collect_files(self):
 		"""returns all interesting files in a type => [files list] dictionary"""
@@ -63,14 +75,15 @@ class collect_tables(Render):
 
 	def _get_table_type(self, path):
 		"""the first word before the underscore in the filename is the table type. Can return None"""
-		if not os.path.isfile(path):
+		#only interested in tables, in any supported format. Partitioned
+		#parquet datasets are folders
+		fmt = d2r.collector.table_format(path)
+		if fmt is None:
+			return None
+		if not (os.path.isfile(path) or (fmt == 'parquet' and os.path.isdir(path))):
 			return None
-		
 		
 		(core, ext) = d2r.misc.get_file_corename_ext(path)
-		if ext.lower() != '.csv':
-			#only interested in csv files
-			return None
 		
 		pieces = core.split('_', maxsplit=1)
 		if len(pieces) != 2:
@@ -78,3 +91,24 @@ class collect_tables(Render):
 			return None
 		#done
 		return(pieces[0])
+
+	def parse_config(self, config):
+		"""parsing config parameters specific to this subclass"""
+		res = super().parse_config(config)
+
+		#default values
+		res['output_format'] = res.get('output_format', 'csv')
+		res['partition_by'] = ''.join(res['partition_by'].split()).split(',') if 'partition_by' in res else None
+		res['chunk_rows'] = int(res.get('chunk_rows', 100000))
+		#as for all sections, cores is inherited from DEFAULT if not specified here
+		res['cores'] = res.get('cores', 1)
+
+		#sanity
+		if res['output_format'] not in d2r.collector.TABLE_FORMATS:
+			raise ValueError('Unknown output_format for collect_tables: ' + res['output_format'] + ', valid values are: ' + ', '.join(d2r.collector.TABLE_FORMATS.keys()))
+		if res['partition_by'] is not None and res['output_format'] != 'parquet':
+			raise ValueError('partition_by is only supported with output_format=parquet')
+		if res['chunk_rows'] < 1:
+			raise ValueError('chunk_rows for collect_tables should be a positive integer, instead was: ' + str(res['chunk_rows']))
+
+		return(res)
@@ -5,6 +5,7 @@ import glob
 
 from d2r.render import Render
 from d2r.misc import indexfile_to_html
+import d2r.collector
 
 class report(Render):
 	
@@ -64,7 +65,10 @@ class report(Render):
 		
 		#adding the plots for all the found indexes, if required
 		if self.config['index_folder'] is not None:
-			for indexfile in glob.glob(self.config['index_folder'] + '/*.csv'):
+			indexfiles = []
+			for ext in d2r.collector.TABLE_FORMATS.values():
+				indexfiles = indexfiles + sorted(glob.glob(self.config['index_folder'] + '/*' + ext))
+			for indexfile in indexfiles:
 				#data to html
 				my_html = indexfile_to_html(indexfile, include_plotlyjs)
 				include_plotlyjs = False
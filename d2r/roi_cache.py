@@ -0,0 +1,111 @@
+#This module contains the ROICache class, used to store the raster blocks of
+#the ROIs (see d2r.raster_block) so that they are read from the orthomosaic
+#and masked only once, and then reused by all tasks and in subsequent runs.
+#There are two tiers: an in-process LRU cache, bounded by a memory budget,
+#and an on-disk cache where each block is saved as two .npy files (data and
+#validity mask), read back via memory mapping
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+import d2r.raster_block
+
+class ROICache:
+	"""
+	A two tier (memory, disk) cache of RasterBlock objects, identified by an integer key
+	(the ROI position in the shapes file)
+
+	folder: where blocks are saved on disk, None for no disk tier
+	memory_bytes: the maximum size of the blocks kept in memory, 0 for no memory tier
+	namespace: a string identifying the cached data (e.g. a fingerprint of the input
+	           files), blocks are stored in a subfolder with this name
+	channels: the channel names of the cached blocks
+
+	Returned blocks are read-only and shared: they should never be modified in place.
+	"""
+	def __init__(self, folder, memory_bytes, namespace, channels):
+		self.folder = None if folder is None else os.path.join(folder, namespace)
+		self.memory_bytes = memory_bytes
+		self.channels = channels
+		self.blocks = OrderedDict()
+		self.used_bytes = 0
+		if self.folder is not None:
+			os.makedirs(self.folder, exist_ok=True)
+
+	def get(self, key):
+		"""returns the cached block for the key, or None if not cached"""
+		#memory tier first
+		if key in self.blocks:
+			self.blocks.move_to_end(key)
+			return(self._to_block(self.blocks[key]))
+
+		#then disk
+		if self.folder is None:
+			return(None)
+		data_file, valid_file = self._files(key)
+		if not (os.path.isfile(data_file) and os.path.isfile(valid_file)):
+			return(None)
+		arrays = (np.load(data_file, mmap_mode='r'), np.load(valid_file, mmap_mode='r'))
+		self._remember(key, arrays)
+		return(self._to_block(arrays))
+
+	def put(self, key, block):
+		"""stores the block in both tiers, returns the cached (read-only) block"""
+		arrays = (block.data, block.valid)
+		for array in arrays:
+			array.setflags(write=False)
+		if self.folder is not None:
+			for array, outfile in zip(arrays, self._files(key)):
+				#writing to a temporary file first, so that an interrupted run does not leave broken blocks.
+				#Other processes and threads may be writing the same block
+				tmpfile = outfile + '.' + str(os.getpid()) + '_' + str(threading.get_ident()) + '.tmp.npy'
+				np.save(tmpfile, array)
+				os.replace(tmpfile, outfile)
+		self._remember(key, arrays)
+		return(self._to_block(arrays))
+
+	def clear(self):
+		"""empties the memory tier, the disk tier is left untouched"""
+		self.blocks = OrderedDict()
+		self.used_bytes = 0
+
+	def _to_block(self, arrays):
+		"""a new RasterBlock on the cached arrays, so that callers can restrict it (see RasterBlock.select()) without touching the cache"""
+		return(d2r.raster_block.RasterBlock(arrays[0], arrays[1], self.channels))
+
+	def _remember(self, key, arrays):
+		"""adds the (data, valid) arrays to the memory tier, evicting the least recently used ones if over budget"""
+		#a block stored again (e.g. by another thread) replaces the previous one
+		if key in self.blocks:
+			previous = self.blocks.pop(key)
+			self.used_bytes -= previous[0].nbytes + previous[1].nbytes
+		size = arrays[0].nbytes + arrays[1].nbytes
+		if size > self.memory_bytes:
+			return None
+		self.blocks[key] = arrays
+		self.used_bytes += size
+		while self.used_bytes > self.memory_bytes:
+			_, evicted = self.blocks.popitem(last=False)
+			self.used_bytes -= evicted[0].nbytes + evicted[1].nbytes
+		return None
+
+	def _files(self, key):
+		return(os.path.join(self.folder, str(key) + '_data.npy'), os.path.join(self.folder, str(key) + '_valid.npy'))
+
+def file_fingerprint(infile, content=False):
+	"""
+	A string identifying the current version of a file: a hash of path, size and
+	modification time or, if content is True, of the file content
+	"""
+	h = hashlib.sha1()
+	if content:
+		with open(infile, 'rb') as fp:
+			for chunk in iter(lambda: fp.read(1 << 20), b''):
+				h.update(chunk)
+	else:
+		stat = os.stat(infile)
+		h.update((os.path.realpath(infile) + ':' + str(stat.st_size) + ':' + str(stat.st_mtime_ns)).encode())
+	return(h.hexdigest())
@@ -0,0 +1,93 @@
+#This module takes care of running tasks on datasets. Each job is one dataset
+#plus the list of tasks to be run on it, in order, and whether it's the last
+#job using that dataset (which is then closed). Jobs are either run one
+#after the other in the current process, or distributed across a pool of
+#processes. In both cases a failing job is logged and does not stop the others
+
+import os
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import d2r.logger
+
+def make_jobs(tasks, datasets, loop_order='task', parallel=False):
+	"""
+	Builds the list of jobs, as (dataset, [tasks], last) tuples, where last is
+	True for the last job using the dataset, which closes it
+
+	With loop_order 'task' each job is a single (task, dataset) combination, and
+	all datasets go through the first task before moving to the second one.
+	With loop_order 'dataset' each job runs all tasks on a single dataset, so
+	that each dataset is opened once.
+	
+	If the jobs are going to be run in parallel the loop order is always 
+	'dataset': a dataset must not be opened by two processes at the same time,
+	since opening it may write files (e.g. the overviews are built by the first
+	process needing them, next to the image or in overviews_folder)
+	"""
+	if loop_order not in ['task', 'dataset']:
+		raise ValueError('loop_order should be either "task" or "dataset", instead was: ' + str(loop_order))
+	if loop_order == 'task' and not parallel:
+		jobs = [(d, [t]) for t in tasks for d in datasets]
+	else:
+		jobs = [(d, tasks) for d in datasets]
+
+	#the index of the last job for each dataset
+	last = {id(d) : i for i, (d, t) in enumerate(jobs)}
+	return([(d, t, last[id(d)] == i) for i, (d, t) in enumerate(jobs)])
+
+def run_jobs(jobs, cores=1, logfolder=None, logger=None):
+	"""
+	Runs all the passed jobs, serially if cores is one, otherwise on a pool of cores processes.
+	Returns the list of failures, as (task title, dataset title, error message) tuples
+	"""
+	failures = []
+	if cores <= 1:
+		for dataset, tasks, last in jobs:
+			failures = failures + run_job(dataset, tasks, logger, close=last)
+		return(failures)
+
+	#parallel case, each worker opens its own datasets
+	logger.info('running ' + str(len(jobs)) + ' jobs on ' + str(cores) + ' processes, logs in ' + str(logfolder))
+	context = multiprocessing.get_context('spawn')
+	with ProcessPoolExecutor(max_workers=cores, mp_context=context) as executor:
+		futures = {executor.submit(_run_job_in_worker, dataset, tasks, logfolder) : (dataset, tasks) for dataset, tasks, last in jobs}
+		for future in as_completed(futures):
+			dataset, tasks = futures[future]
+			try:
+				current_failures = future.result()
+			except Exception:
+				#the worker itself died (e.g. out of memory)
+				current_failures = [(t.to_string(), dataset.get_title(), traceback.format_exc()) for t in tasks]
+			for failure in current_failures:
+				logger.info('FAILED: task ' + failure[0] + ' on dataset ' + failure[1])
+			failures = failures + current_failures
+			logger.info('job done: dataset ' + dataset.get_title() + ', tasks ' + ', '.join([t.to_string() for t in tasks]))
+	return(failures)
+
+def run_job(dataset, tasks, logger=None, close=True):
+	"""runs the passed tasks on the passed dataset, then closes it if required. Returns the list of failures"""
+	failures = []
+	for t in tasks:
+		try:
+			t.run(dataset)
+		except Exception:
+			msg = traceback.format_exc()
+			if logger is not None:
+				logger.info('Task ' + t.to_string() + ' failed on dataset ' + dataset.get_title() + ':\n' + msg)
+			failures.append((t.to_string(), dataset.get_title(), msg))
+	if close:
+		dataset.close()
+	return(failures)
+
+def _run_job_in_worker(dataset, tasks, logfolder):
+	"""runs a job in a worker process, with its own log file"""
+	#one log file per job
+	jobname = 'd2r.job.' + '_'.join([t.to_string() for t in tasks]) + '.' + dataset.get_title().replace(' ', '_')
+	logger = d2r.logger.redirect_to_file(os.path.join(logfolder, jobname + '.log'))
+
+	#no nested process pools: the parallelism is already at job level
+	for t in tasks:
+		t.config['cores'] = 1
+	return(run_job(dataset, tasks, logger))
@@ -7,6 +7,8 @@ from tqdm import tqdm
 
 from d2r.task import Task
 import d2r.misc
+import d2r.raster_block
+import d2r.ordering
 
 class ROIs(Task):
 	def run(self, dataset):
@@ -17,29 +19,40 @@ class ROIs(Task):
 		path = pathlib.Path(self.config['outfolder'], dataset.get_title())
 		path.mkdir(parents=True, exist_ok=True)
 		
-		#the geometry index, whose values are also used for filenames
-		geoid = dataset.get_geom_index()
-		geometry_columns = dataset.get_geom_field(geoid)
-		
-		#for each ROI
-		for i in tqdm(range(len(geometry_columns))):
-			#selecting the current geometry
-			cg = geometry_columns.iloc[i,:]
-			
+		#ROIs completely outside the image are skipped, without reading anything
+		status = dataset.get_ROI_status()
+		for position in np.flatnonzero(status == 'outside'):
+			self.logger.info('ROI number ' + str(position) + ' is outside the image borders, skipped')
+
+		#for each ROI, selected via the geometry index, whose values are also used for filenames.
+		#ROIs are processed in spatial order (see "roi_order"), so that image blocks are reused
+		selectors = [sel for sel, geom in dataset.iter_geoms()]
+		outfiles = {}
+		for position in dataset.get_ROI_order(self.config['roi_order']):
+			if status[position] == 'outside':
+				continue
+			sel = selectors[position]
+
 			#build the outfile name, without the extension
 			outfile = 'ROI'
-			for key in geoid:
-				outfile = outfile + '_' + key + '=' + str(cg[key])
+			for key in sel:
+				outfile = outfile + '_' + key + '=' + str(sel[key])
 			outfile = os.path.join(path, outfile)
-			
-			#building a selector dict
-			sel = {key : cg[key] for key in geoid}
-			
+
+			#ROIs with all the outputs already there are not even read
+			extensions = [ext for ext, requested in [('.tif', self.config['tif']), ('.png', self.config['png'])] if requested]
+			if self.config['skip_if_already_done'] and all(os.path.isfile(outfile + ext) for ext in extensions):
+				print('skipping, output files already exist: ' + outfile)
+				continue
+			outfiles[position] = outfile
+
+		#neighbouring ROIs are read together, see Dataset.iter_geom_blocks()
+		for position, block in tqdm(dataset.iter_geom_blocks(list(outfiles.keys())), total=len(outfiles)):
 			#saving each requested format
-			if self.config['tif'] : self._save_tif(outfile, dataset, sel)
-			if self.config['png'] : self._save_png(outfile, dataset, sel)
+			if self.config['tif'] : self._save_tif(outfiles[position], dataset, selectors[position], block)
+			if self.config['png'] : self._save_png(outfiles[position], dataset, selectors[position], block)
 
-	def _save_tif(self, outfile, dataset, selector):
+	def _save_tif(self, outfile, dataset, selector, block=None):
 			#build the outfile name
 			outfile_current = outfile + '.tif'
 			
@@ -48,13 +61,16 @@ class ROIs(Task):
 				print('skipping, output file already exists: ' + outfile_current)
 				return(None)
 			
-			#extract the data
-			rb = dataset.get_geom_raster(selector)
+			#extract the data, if not already read
+			if block is None:
+				rb = dataset.get_geom_raster(selector)
+			else:
+				rb = block.to_masked()
 			
 			if rb is None:
 				msg = ','.join([str(key) + '=' + str(selector[key]) for key in selector])
 				print('Empty ROI, selected by ' + msg)
-				next
+				return(None)
 			
 			#save the data
 			rows, cols, bands = rb.shape
@@ -75,7 +91,7 @@ class ROIs(Task):
 			#closing and saving
 			outdataset = None
 		
-	def _save_png(self, outfile, dataset, selector):
+	def _save_png(self, outfile, dataset, selector, block=None):
 			#build the outfile name
 			outfile_current = outfile + '.png'
 			
@@ -84,13 +100,18 @@ class ROIs(Task):
 				print('skipping, output file already exists: ' + outfile_current)
 				return(None)
 
-			#extract the data
-			rb = dataset.get_geom_raster(selector, normalize_if_possible=False, rescale_to_255=self.config['png_stretch_to_0-255'])
+			#extract the data, if not already read
+			if block is None:
+				rb = dataset.get_geom_raster(selector, normalize_if_possible=False, rescale_to_255=self.config['png_stretch_to_0-255'])
+			elif self.config['png_stretch_to_0-255']:
+				rb = d2r.raster_block.RasterBlock(dataset.rescale_raster_to_255(block.data), block.valid, block.channels).to_masked()
+			else:
+				rb = block.to_masked()
 						
 			if rb is None:
 				msg = ','.join([str(key) + '=' + str(selector[key]) for key in selector])
 				print('Empty ROI, selected by ' + msg)
-				next
+				return(None)
 			
 			#what are the visible channels, out of the available ones?
 			channels = dataset.get_channels()
@@ -116,4 +137,11 @@ class ROIs(Task):
 			if key in ['tif', 'png', 'png_stretch_to_0-255']:
 				res[key] = d2r.misc.parse_boolean(res[key])
 
+		#default values
+		res['roi_order'] = res.get('roi_order', 'shapefile')
+
+		#sanity
+		if res['roi_order'] not in d2r.ordering.ROI_ORDERS:
+			raise ValueError('Unknown roi_order for ROIs task: ' + res['roi_order'] + ', valid values are: ' + ', '.join(d2r.ordering.ROI_ORDERS))
+
 		return(res)
@@ -8,10 +8,27 @@
 	With:
 	 - img: numpy ndarray, axis are row, columns, channels
 	 - channels: list of string, channel names
+	
+	Each function should declare the channels it uses in REQUIRED_CHANNELS, so
+	that only those bands are read from the image, and the keys of the returned
+	dictionary in COLUMNS, so that the output table columns are known in advance
 """
 
 import numpy as np
 
+#the channels used by each index, only these are read from the image. None
+#means that the index may use any channel, and all channels are read
+REQUIRED_CHANNELS = {
+	'random_array' : [],
+	'summation'    : None,
+}
+
+#the keys of the dictionary returned by each index, i.e. its output table columns
+COLUMNS = {
+	'random_array' : ['first_random_value', 'second_random_value'],
+	'summation'    : ['summation'],
+}
+
 def random_array(img, channels):
 	"""two random values between zero and one"""
 	return({
@@ -1,133 +1,587 @@
 import os
+import json
+import queue
+import threading
+import hashlib
 import pathlib
 import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
 from d2r.task import Task
 import d2r.misc
+import d2r.collector
+import d2r.zonal
+import d2r.raster_block
+import d2r.roi_cache
+import d2r.expression
+import d2r.ordering
 import d2r.tasks.matrix_returning_indexes as mri
 import d2r.tasks.array_returning_indexes  as ari
 
+#per-process state for the "parallel" execution mode, filled by _init_worker()
+_worker_state = {}
+
+def _init_worker(task, dataset):
+	"""initializer for the worker processes. Each worker receives its own
+	unpickled copy of the dataset, and thus its own GDAL handle"""
+	_worker_state['task'] = task
+	_worker_state['dataset'] = dataset
+
+def _run_chunk(chunk, index_names):
+	"""computes the rows for a list of (position, selector) pairs, in the worker process"""
+	task = _worker_state['task']
+	dataset = _worker_state['dataset']
+	#neighbouring ROIs in the chunk are read together, see Dataset.iter_geom_blocks()
+	blocks = dataset.iter_geom_blocks([dataset.get_geom_position(selector) for position, selector in chunk], 
+		normalize_if_possible=True, selected_channels=task._needed_channels(dataset, index_names))
+	return([(position, task._process_ROI(dataset, selector, index_names, rb)) for (position, selector), (_, rb) in zip(chunk, blocks)])
+
 class indexes(Task):
 	def run(self, dataset):
 		#a bit of interface
 		self.logger.info('TASK:' + self.to_string() + ', DATASET:' + dataset.to_string() )
-		
+
 		#the output path
-		outfile = os.path.join(self.config['outfolder'], 'indexes_' + dataset.get_title() + '.csv')
+		outfile = os.path.join(self.config['outfolder'], 'indexes_' + dataset.get_title() + d2r.collector.TABLE_FORMATS[self.config['output_format']])
 		path = pathlib.Path(self.config['outfolder'])
-		path.mkdir(parents=True, exist_ok=True)		
+		path.mkdir(parents=True, exist_ok=True)
 
-		#check if we should do the task or not
-		if os.path.isfile(outfile) and self.config['skip_if_already_done']:
+		#check if we should do the task or not (in incremental mode that's decided later, see _run_incremental())
+		if os.path.isfile(outfile) and self.config['skip_if_already_done'] and not self.config['incremental']:
 			self.logger.info('skipping. Output file already exists: ' + outfile)
 			return(None)
 		self.logger.info('results saved to: ' + outfile)
-		
-		#room for results
-		df = None
-		
+
 		#the index list
 		index_names = self.config['indexes'].replace(" ", "").split(',')
-		
-		#the field that is used to index geometries in the shape file
+
+		#the selectors of all geometries in the shape file, in order
+		selectors = [selector for selector, geom in dataset.iter_geoms()]
+
+		#a cheap pre-pass on the ROIs bounding boxes: ROIs outside the image
+		#are skipped without reading anything, partial ones are clipped
+		status = dataset.get_ROI_status()
+		self.logger.info('ROIs inside the image: ' + str(np.sum(status == 'inside')) + 
+			', partially outside (clipped): ' + str(np.sum(status == 'partial')) + 
+			', outside (skipped): ' + str(np.sum(status == 'outside')))
+		for position in np.flatnonzero(status == 'outside'):
+			msg = ','.join([str(key) + '=' + str(selectors[position][key]) for key in selectors[position]])
+			self.logger.info('Warning: ROI marked with ' + msg + ' is outside the image borders. Ignored.')
+
+		#in incremental mode what has been computed, and on what input, is stored 
+		#next to the results, and only what is missing or stale is computed
+		state_file = os.path.splitext(outfile)[0] + '.json'
+		if self.config['incremental']:
+			state = self._get_state(dataset, index_names)
+			if self._run_incremental(dataset, outfile, state_file, state, selectors, index_names):
+				return(None)
+		elif os.path.isfile(state_file):
+			#the results are about to be overwritten, the state of a previous incremental run no longer describes them
+			os.remove(state_file)
+
+		#computing one row per shape in the dataset
+		rows = self._compute_rows(dataset, selectors, range(len(selectors)), index_names)
+
+		#storing the results, in shapefile order
+		collector = d2r.collector.ResultCollector(outfile, self.config['flush_rows'])
+		for d in rows:
+			if d is not None:
+				collector.append(d)
+
+		#saving the results
+		collector.save()
+		if self.config['incremental']:
+			self._save_state(state_file, state)
+
+	def _compute_rows(self, dataset, selectors, positions, index_names):
+		"""computes the rows for the ROIs in the passed positions (of the selectors list), using the configured execution mode"""
+		if self.config['execution'] == 'zonal':
+			#a single pass computes all ROIs anyway
+			rows = self._run_zonal(dataset, selectors, index_names)
+			return([rows[p] for p in positions])
+		#ROIs are processed in spatial order (see "roi_order"), so that image blocks are reused
+		order = self._traversal_order(dataset, positions)
+		if self.config['execution'] == 'parallel' and self.config['cores'] > 1:
+			rows = self._run_parallel(dataset, [selectors[p] for p in order], index_names)
+		elif self.config['execution'] == 'pipeline':
+			rows = self._run_pipeline(dataset, selectors, order, index_names)
+		else:
+			#neighbouring ROIs are read together (see Dataset.iter_geom_blocks()), the positions 
+			#in the shapes file and in selectors are the same
+			blocks = dataset.iter_geom_blocks(order, normalize_if_possible=True, selected_channels=self._needed_channels(dataset, index_names))
+			rows = (self._process_ROI(dataset, selectors[p], index_names, rb) for p, rb in tqdm(blocks, total=len(order)))
+			if order == list(positions):
+				#a generator, so that rows can be flushed to disk as they come
+				return(rows)
+			rows = list(rows)
+
+		#back to the original order
+		rows = dict(zip(order, rows))
+		return([rows[p] for p in positions])
+
+	def _traversal_order(self, dataset, positions):
+		"""the passed ROI positions, in the order they should be processed (see d2r.ordering)"""
+		if self.config['roi_order'] == 'shapefile':
+			return(list(positions))
+		rank = np.empty(len(dataset.get_ROI_windows()), dtype=int)
+		rank[dataset.get_ROI_order(self.config['roi_order'])] = np.arange(len(rank))
+		return(sorted(positions, key=lambda p: rank[p]))
+
+	def _get_state(self, dataset, index_names):
+		"""
+		Describes what is being computed: the inputs (files fingerprints and parameters
+		affecting pixel values), the list of indexes and a hash of each ROI geometry
+		"""
+		(ortho, shapes) = dataset.get_files()
+		return({
+			'inputs' : {
+				'ortho_files' : [f if f.startswith('/vsi') else d2r.roi_cache.file_fingerprint(f) for f in ortho],
+				'channels' : dataset.get_channels(),
+				'nodata' : dataset.get_nodata_value(),
+				'max_value' : dataset.get_config()['max_value'],
+				'dtype' : dataset.get_config()['dtype'],
+				'threshold' : self.config['threshold']
+			},
+			'indexes' : index_names,
+			'geometries' : {self._row_key(selector) : hashlib.sha1(geom.wkb).hexdigest() for selector, geom in dataset.iter_geoms()}
+		})
+
+	def _save_state(self, state_file, state):
+		with open(state_file, 'w') as fp:
+			json.dump(state, fp)
+
+	def _row_key(self, selector):
+		"""a string identifying a ROI, from its selector. Values are compared as strings, as read back from the csv"""
+		return(json.dumps([str(value) for value in selector.values()]))
+
+	def _run_incremental(self, dataset, outfile, state_file, state, selectors, index_names):
+		"""
+		Updates the results of a previous run, computing only new ROIs, ROIs whose
+		geometry changed and indexes not computed before. Returns False (and does 
+		nothing) if a full computation is needed: no previous results or different
+		input files or parameters.
+		"""
+		#is there anything to start from?
+		if not (os.path.isfile(outfile) and os.path.isfile(state_file)):
+			self.logger.info('incremental mode: no previous results, computing everything')
+			return(False)
+		with open(state_file) as fp:
+			previous_state = json.load(fp)
+		if previous_state['inputs'] != state['inputs']:
+			self.logger.info('incremental mode: input files or parameters changed since last run, computing everything')
+			return(False)
+
+		#the previous table, indexed by ROI
 		fields = dataset.get_geom_index()
-		geometry_columns = dataset.get_geom_field(fields)
-		
-		#for each shape in the dataset
-		for i in tqdm(range(len(geometry_columns))):
-			#selecting the current geometry
-			cg = geometry_columns.iloc[i,:]
-			selector = {key : cg[key] for key in fields}
-			
-			#a raster block
-			rb = dataset.get_geom_raster(selector, normalize_if_possible=True)
-			
-			if rb is None:
-				#if rb is None it means that we have asked for data outside the image
-				msg = ','.join([str(key) + '=' + str(selector[key]) for key in selector])
-				self.logger.info('Warning: ROI marked with ' + msg + ' is outside the image borders. Ignored.')
+		previous = d2r.collector.read_table(outfile, dtype={key : str for key in fields})
+		previous.index = [self._row_key(selector) for selector in previous[fields].to_dict('records')]
+		keys = [self._row_key(selector) for selector in selectors]
+
+		#new ROIs and ROIs whose geometry changed are computed from scratch...
+		stale = [p for p, key in enumerate(keys) if key not in previous.index or previous_state['geometries'].get(key) != state['geometries'][key]]
+		#...while the others just need the indexes that were not computed before
+		stale_set = set(stale)
+		current = [p for p in range(len(keys)) if p not in stale_set]
+		new_indexes = [name for name in index_names if name not in previous_state['indexes']]
+		removed_indexes = [name for name in previous_state['indexes'] if name not in index_names]
+		self.logger.info('incremental mode: ' + str(len(stale)) + ' new or changed ROIs, ' + str(len(current)) + 
+			' ROIs up to date, indexes to be added: ' + str(new_indexes) + ', to be removed: ' + str(removed_indexes))
+		if len(stale) == 0 and len(new_indexes) == 0 and len(removed_indexes) == 0 and list(previous.index) == keys:
+			self.logger.info('incremental mode: results are up to date, nothing to do')
+			return(True)
+
+		#adding the missing indexes to the up to date ROIs
+		if len(new_indexes) > 0 and len(current) > 0:
+			extra = pd.DataFrame.from_records([d for d in self._compute_rows(dataset, selectors, current, new_indexes)])
+			extra.index = [keys[p] for p in current]
+			index_columns = [column for name in new_indexes for column in self._index_columns(name)]
+			for column in index_columns:
+				if column not in previous.columns:
+					previous[column] = np.nan
+			previous.loc[extra.index, index_columns] = extra[index_columns]
+
+		#merging, in shapefile order (ROIs no longer in the shapefile are dropped)
+		table = previous
+		if len(stale) > 0:
+			fresh = pd.DataFrame.from_records([d for d in self._compute_rows(dataset, selectors, stale, index_names)])
+			fresh.index = [keys[p] for p in stale]
+			table = pd.concat([previous.drop(index=fresh.index, errors='ignore'), fresh])
+		table = table.reindex(keys)
+
+		#the ROI fields were read as strings, back to their original type
+		for field in fields:
+			table[field] = [selector[field] for selector in selectors]
+
+		#only the columns of the requested indexes (removed ones are dropped)
+		columns = self._base_columns(dataset) + [column for name in index_names for column in self._index_columns(name)]
+		table = table.reindex(columns=columns)
+
+		#writing to a temporary file first, so that the previous results survive an interrupted run
+		tmpfile = os.path.splitext(outfile)[0] + '.tmp' + os.path.splitext(outfile)[1]
+		d2r.collector.write_table(table, tmpfile)
+		os.replace(tmpfile, outfile)
+		self._save_state(state_file, state)
+		return(True)
+
+	def _run_parallel(self, dataset, selectors, index_names):
+		"""shards the ROIs across a pool of "cores" processes, returns the rows in the original order"""
+		#several chunks per worker, so that a slow chunk does not stall the pool
+		chunk_size = max(1, len(selectors) // (self.config['cores'] * 8))
+		positions = list(range(len(selectors)))
+		chunks = [list(zip(positions[i:i + chunk_size], selectors[i:i + chunk_size])) for i in range(0, len(selectors), chunk_size)]
+		self.logger.info('processing ' + str(len(selectors)) + ' ROIs on ' + str(self.config['cores']) + ' processes')
+
+		#spawned workers do not inherit the parent GDAL handles, each one opens its own
+		rows = [None] * len(selectors)
+		context = multiprocessing.get_context('spawn')
+		with ProcessPoolExecutor(max_workers=self.config['cores'], mp_context=context, initializer=_init_worker, initargs=(self, dataset)) as executor:
+			futures = [executor.submit(_run_chunk, chunk, index_names) for chunk in chunks]
+			with tqdm(total=len(selectors)) as progress:
+				for future in as_completed(futures):
+					done = future.result()
+					for position, d in done:
+						rows[position] = d
+					progress.update(len(done))
+		return(rows)
+
+	def _run_pipeline(self, dataset, selectors, order, index_names):
+		"""
+		Overlaps reading and computation: "reader_threads" threads, each with its own GDAL
+		handle (see Dataset.clone()), read the ROIs blocks into a queue of at most "queue_depth"
+		blocks, while "compute_threads" threads compute the rows. GDAL and numpy release the
+		GIL while working, so the threads actually run in parallel. Returns the rows for the
+		ROI positions in order, in the same order
+		"""
+		#everything shared by the threads is built once, before starting them
+		dataset.open()
+		dataset.get_ROI_windows()
+		dataset.get_ROI_status()
+		if dataset.get_config()['label_image']:
+			dataset.get_label_image()
+		channels = self._needed_channels(dataset, index_names)
+		n_readers = self.config['reader_threads']
+		n_workers = self.config['compute_threads']
+
+		#readers get chunks of consecutive ROIs, so that neighbouring ROIs are still read together
+		chunk_size = max(1, min(64, len(order) // (n_readers * 4)))
+		work = queue.Queue()
+		for i in range(0, len(order), chunk_size):
+			work.put(order[i:i + chunk_size])
+		blocks = queue.Queue(maxsize=self.config['queue_depth'])
+		results = queue.Queue()
+		#set when done, or when a thread fails, so that all threads stop
+		stop = threading.Event()
+
+		def put(q, item):
+			#a bounded put that gives up if the pipeline is stopped
+			while not stop.is_set():
+				try:
+					q.put(item, timeout=0.1)
+					return(True)
+				except queue.Full:
+					pass
+			return(False)
+
+		def reader():
+			try:
+				clone = dataset.clone()
+				while not stop.is_set():
+					try:
+						chunk = work.get_nowait()
+					except queue.Empty:
+						return None
+					for position, rb in clone.iter_geom_blocks(chunk, normalize_if_possible=True, selected_channels=channels):
+						if not put(blocks, (position, rb)):
+							return None
+			except Exception as e:
+				results.put(('error', None, e))
+
+		def worker():
+			while not stop.is_set():
+				try:
+					position, rb = blocks.get(timeout=0.1)
+				except queue.Empty:
+					continue
+				try:
+					results.put(('row', position, self._process_ROI(dataset, selectors[position], index_names, rb)))
+				except Exception as e:
+					results.put(('error', position, e))
+
+		self.logger.info('processing ' + str(len(order)) + ' ROIs with ' + str(n_readers) + ' reader threads, ' + 
+			str(n_workers) + ' compute threads, queue depth ' + str(self.config['queue_depth']))
+		threads = [threading.Thread(target=reader, daemon=True) for i in range(n_readers)] + [threading.Thread(target=worker, daemon=True) for i in range(n_workers)]
+		for t in threads:
+			t.start()
+
+		#collecting the rows, the progress bar shows how full the queue is (empty: reading is the bottleneck)
+		rows = {}
+		try:
+			with tqdm(total=len(order), desc='readers=' + str(n_readers) + ' workers=' + str(n_workers)) as progress:
+				while len(rows) < len(order):
+					kind, position, value = results.get()
+					if kind == 'error':
+						raise value
+					rows[position] = value
+					progress.set_postfix_str('queue=' + str(blocks.qsize()) + '/' + str(self.config['queue_depth']), refresh=False)
+					progress.update(1)
+		finally:
+			stop.set()
+			for t in threads:
+				t.join()
+		return([rows[p] for p in order])
+
+	def _run_zonal(self, dataset, selectors, index_names):
+		"""
+		computes the statistics of all ROIs in a single streaming pass over the raster, 
+		one block at a time, using the ROIs label image. Returns the rows in the original order
+		"""
+		#only the channels needed by the indexes are read
+		channels = self._needed_channels(dataset, index_names)
+		labels, labels_x, labels_y = dataset.get_label_image()
+		n_zones = len(selectors)
+
+		#one accumulator per index, plus two for the pixel counts
+		accumulators = {name : d2r.zonal.ZonalAccumulator(n_zones) for name in index_names}
+		pixels = np.zeros(n_zones)
+		pixels_after_threshold = np.zeros(n_zones)
+
+		#streaming over the blocks covered by the label image
+		windows = list(dataset.iter_windows(labels_x, labels_y, labels.shape[1], labels.shape[0], self.config['block_size']))
+		self.logger.info('computing zonal statistics for ' + str(n_zones) + ' ROIs over ' + str(len(windows)) + ' raster blocks')
+		for x_offset, y_offset, x_size, y_size in tqdm(windows):
+			#the zones in the current block, skipping blocks without ROIs before reading them
+			zones = labels[y_offset - labels_y : y_offset - labels_y + y_size, x_offset - labels_x : x_offset - labels_x + x_size] - 1
+			inside = zones >= 0
+			if not np.any(inside):
+				continue
+
+			#the raster block, with missing data as NaN
+			rb = dataset.get_window_raster(x_offset, y_offset, x_size, y_size, dtype=dataset.get_block_dtype(), selected_channels=channels)
+			if dataset.get_nodata_value() is not None:
+				rb[rb == dataset.get_nodata_value()] = np.nan
+			if dataset.get_config()['max_value'] is not None:
+				rb /= dataset.get_config()['max_value']
+
+			#as in RasterBlock, a pixel is missing only if all the channels are missing
+			valid = inside & ~np.all(np.isnan(rb), axis=2)
+			pixels += np.bincount(zones[valid], minlength=n_zones)
+
+			#should we apply a thresholded filter? The indexes it computes are reused below
+			planes = {}
+			if self.config['threshold'] is not None:
+				selection, planes = self.config['threshold_expression'].evaluate(rb, channels)
+				inside = inside & selection
+				valid = valid & selection
+			pixels_after_threshold += np.bincount(zones[valid], minlength=n_zones)
+
+			#all (other) matrix-returning indexes are computed at once per block, then split by zone
+			block_indexes = [name for name in index_names if hasattr(mri, name) and name not in planes]
+			planes.update(zip(block_indexes, mri.compute_indexes(rb, channels, block_indexes, dtype=rb.dtype)))
+			for current_index in index_names:
+				if current_index in planes:
+					plane = planes[current_index]
+				elif current_index in channels:
+					plane = rb[:, :, channels.index(current_index)]
+				else:
+					raise ValueError('In the .ini file it is requested an unknown index: ' + current_index)
+				#indexes not applicable to this dataset are all NaN, and thus never accumulated
+				selected = inside & np.isfinite(plane)
+				accumulators[current_index].update(zones[selected], plane[selected])
+
+		#ROIs overlapping other ROIs do not have a reliable zone id in
+		#the label image, they are computed one by one
+		overlapping = dataset.overlapping_ROIs
+
+		#building the rows, same format as _process_ROI()
+		status = dataset.get_ROI_status()
+		rows = []
+		for position, selector in enumerate(selectors):
+			if position in overlapping:
+				rows.append(self._process_ROI(dataset, selector, index_names))
+				continue
+			d = self._make_row(dataset, selector, status[position], int(pixels[position]), int(pixels_after_threshold[position]))
+			for current_index in index_names:
+				stats = accumulators[current_index].statistics(position)
+				for stat in d2r.raster_block.STATISTICS:
+					d[current_index + '_' + stat] = stats[stat]
+			rows.append(d)
+		return(rows)
+
+	def _index_columns(self, index_name):
+		"""the output table columns of the passed index (or channel)"""
+		if hasattr(ari, index_name):
+			return(list(ari.COLUMNS[index_name]))
+		return([index_name + '_' + stat for stat in d2r.raster_block.STATISTICS])
+
+	def _needed_channels(self, dataset, index_names):
+		"""
+		The channels used by the passed indexes and by the threshold expression, in the
+		dataset order: only these are read from the image. Channels missing from the 
+		dataset are ignored, the indexes using them are not applicable anyway
+		"""
+		names = list(index_names)
+		if self.config['threshold'] is not None:
+			names = names + self.config['threshold_expression'].names
+		needed = set()
+		for name in names:
+			if name in mri.REQUIRED_CHANNELS:
+				required = mri.REQUIRED_CHANNELS[name]
+			elif name in ari.REQUIRED_CHANNELS:
+				required = ari.REQUIRED_CHANNELS[name]
+			elif hasattr(mri, name) or hasattr(ari, name):
+				#an index not declaring its channels could use any of them
+				required = None
 			else:
-				#collecting required data
-				(ortho, shapes) = dataset.get_files()
-				(cx, cy) = dataset.get_geom_centroid(selector)
-				
-				#starting to build the saved dict
-				d = {
-					'type' : [dataset.get_type()], #this is a list for allowing straightforward dict to pd.dataframe conversion
-					'dataset' : dataset.get_title(),
-					'ortho_files' : ' '.join(ortho), 
-					'shapes_file' : shapes,
-					'channels' : ' '.join(dataset.get_channels()),
-					'centroid_x' : cx,
-					'centroid_y' : cy,
-					'threshold' : self.config['threshold'],
-					#all channels share the same mask, so we just count the pixels on the first channel
-					'pixels' : np.ma.count(rb[:, :, 0]) 
-				}
-				
-				#adding info on the current geometry
-				d = d | selector
-				
-				#should we apply a thresholded filter?
-				if self.config['threshold'] is not None:
-					rb = d2r.misc.thresholded_filter(rb, dataset.get_channels(), self.config['threshold'])
-				d['pixels_after_threshold'] = np.ma.count(rb[:, :, 0])
-
-				#for each required index
-				for current_index in index_names:
-					found = False
-					#if it's a matrix-returning index, we are going to compute it and
-					#then store some general statistics
-					if hasattr(mri, current_index):
-						found = True
-						current_index_function = getattr(mri, current_index)
-						myindex = current_index_function(rb, dataset.get_channels())
-						d[current_index + '_mean'] = np.ma.mean(myindex)
-						d[current_index + '_median'] = np.ma.median(myindex)
-						d[current_index + '_std'] = np.ma.std(myindex)
-						d[current_index + '_max'] = np.ma.max(myindex)
-						d[current_index + '_min'] = np.ma.min(myindex)
-					
-					#if it's the name of a channel we are going to compute its 
-					#values and store some general statistics
-					if current_index in dataset.get_channels():
-						found = True
-						i = dataset.get_channels().index(current_index)
-						requested_channel = rb[:, :, i]
-						
-						d[current_index + '_mean'] = np.ma.mean(requested_channel)
-						d[current_index + '_median'] = np.ma.median(requested_channel)
-						d[current_index + '_std'] = np.ma.std(requested_channel)
-						d[current_index + '_max'] = np.ma.max(requested_channel)
-						d[current_index + '_min'] = np.ma.min(requested_channel)
-
-					#if it's an array-returning index, we are going to compute 
-					#it and then just store the info
-					if hasattr(ari, current_index):
-						found = True
-						current_index_function = getattr(ari, current_index)
-						d.update(current_index_function(rb, dataset.get_channels()))
-					
-					#if we get here and the index is unknown we raise an error
-					if not found:
-						raise ValueError('In the .ini file it is requested an unknown index: ' + current_index)
-					
-				#storing the results
-				tmp = pd.DataFrame.from_dict(d)
-				df = pd.concat([df, pd.DataFrame.from_dict(d)])
-		
-		#saving the results
-		df.to_csv(outfile, index=False)
+				#a channel name (unknown names are reported later)
+				required = [name]
+			if required is None:
+				return(dataset.get_channels())
+			needed.update(required)
+		channels = [channel for channel in dataset.get_channels() if channel in needed]
+
+		#at least one channel is read, to know which pixels are valid
+		if len(channels) == 0:
+			channels = dataset.get_channels()[0:1]
+		return(channels)
+
+	def _base_columns(self, dataset):
+		"""the columns of the output table before the index ones, as built by _make_row()"""
+		return(['type', 'dataset', 'ortho_files', 'shapes_file', 'channels', 'centroid_x', 'centroid_y', 'threshold', 'pixels'] + 
+			dataset.get_geom_index() + ['roi_status', 'pixels_after_threshold'])
+
+	def _make_row(self, dataset, selector, status, pixels, pixels_after_threshold):
+		"""the first part of a row of the output table (see _base_columns()), common to all execution modes"""
+		(ortho, shapes) = dataset.get_files()
+		(cx, cy) = dataset.get_geom_centroid(selector)
+		d = {
+			'type' : dataset.get_type(),
+			'dataset' : dataset.get_title(),
+			'ortho_files' : ' '.join(ortho),
+			'shapes_file' : shapes,
+			'channels' : ' '.join(dataset.get_channels()),
+			'centroid_x' : cx,
+			'centroid_y' : cy,
+			'threshold' : self.config['threshold'],
+			#all channels share the same mask, so this is the number of valid pixels
+			'pixels' : pixels
+		}
+
+		#adding info on the current geometry, and on its position with respect to the image
+		d = d | selector
+		d['roi_status'] = status
+		d['pixels_after_threshold'] = pixels_after_threshold
+		return(d)
+
+	def _process_ROI(self, dataset, selector, index_names, rb=None):
+		"""
+		computes all the requested indexes on a single ROI, returns a dict (one row of the output table) or None
 		
+		rb: the ROI RasterBlock, with the channels from _needed_channels() and normalized, 
+		    if already read (see Dataset.iter_geom_blocks()). If None it's read here
+		"""
+		#ROIs outside the image get a row without statistics, and no data is read
+		status = dataset.get_ROI_status()[dataset.get_geom_position(selector)]
+		if status == 'outside':
+			d = self._make_row(dataset, selector, status, 0, 0)
+			for current_index in index_names:
+				if not (hasattr(mri, current_index) or hasattr(ari, current_index) or current_index in dataset.get_channels()):
+					raise ValueError('In the .ini file it is requested an unknown index: ' + current_index)
+				#all the columns are there, so that the table header is the same for all rows
+				d.update({column : np.nan for column in self._index_columns(current_index)})
+			return(d)
+
+		#a raster block: dense data (NaN where missing) plus a 2D validity mask.
+		#Only the channels needed by the indexes and the threshold are read
+		if rb is None:
+			rb = dataset.get_geom_block(selector, normalize_if_possible=True, selected_channels=self._needed_channels(dataset, index_names))
+		pixels = rb.count()
+
+		#should we apply a thresholded filter? The indexes it computes are reused below,
+		#their values outside the selection are ignored (see rb.valid)
+		mri_planes = {}
+		if self.config['threshold'] is not None:
+			selection, mri_planes = self.config['threshold_expression'].evaluate(rb.data, rb.channels)
+			rb = rb.select(selection)
+		d = self._make_row(dataset, selector, status, pixels, rb.count())
+
+		#all (other) matrix-returning indexes are computed together, sharing channels and common terms
+		mri_names = [current_index for current_index in index_names if hasattr(mri, current_index) and current_index not in mri_planes]
+		mri_planes.update(zip(mri_names, mri.compute_indexes(rb.data, rb.channels, mri_names, dtype=rb.data.dtype)))
+
+		#for each required index
+		for current_index in index_names:
+			found = False
+			#if it's a matrix-returning index, we store some general statistics
+			if current_index in mri_planes:
+				found = True
+				d.update(d2r.raster_block.statistics(current_index, mri_planes[current_index], rb.valid))
+
+			#if it's the name of a channel we are going to compute its
+			#values and store some general statistics
+			if current_index in rb.channels:
+				found = True
+				d.update(d2r.raster_block.statistics(current_index, rb.get_channel(current_index), rb.valid))
+
+			#if it's an array-returning index, we are going to compute
+			#it and then just store the info. These functions expect a masked array
+			if hasattr(ari, current_index):
+				found = True
+				current_index_function = getattr(ari, current_index)
+				d.update(current_index_function(rb.to_masked(), rb.channels))
+
+			#if we get here and the index is unknown we raise an error
+			if not found:
+				raise ValueError('In the .ini file it is requested an unknown index: ' + current_index)
+
+		return(d)
+
 	def parse_config(self, config):
 		"""parsing index-specific config parameters"""
 		res = super().parse_config(config)
-		
+
 		#default values
 		if 'threshold' not in res:
 			res['threshold'] = None
-		
+		#the threshold is parsed once, here, and then evaluated on each ROI
+		res['threshold_expression'] = None if res['threshold'] is None else d2r.expression.ThresholdExpression(res['threshold'])
+		if 'execution' not in res:
+			res['execution'] = 'serial'
+		if 'cores' not in res:
+			res['cores'] = 1
+		res['block_size'] = int(res.get('block_size', 512))
+		res['flush_rows'] = int(res['flush_rows']) if 'flush_rows' in res else None
+		res['incremental'] = d2r.misc.parse_boolean(res['incremental']) if 'incremental' in res else False
+		res['output_format'] = res.get('output_format', 'csv')
+		res['roi_order'] = res.get('roi_order', 'shapefile')
+		res['reader_threads'] = int(res.get('reader_threads', 2))
+		res['compute_threads'] = int(res.get('compute_threads', res['cores']))
+		res['queue_depth'] = int(res.get('queue_depth', 16))
+
+		#sanity
+		if res['output_format'] not in d2r.collector.TABLE_FORMATS:
+			raise ValueError('Unknown output_format for indexes task: ' + res['output_format'] + ', valid values are: ' + ', '.join(d2r.collector.TABLE_FORMATS.keys()))
+		for key in ['reader_threads', 'compute_threads', 'queue_depth']:
+			if res[key] < 1:
+				raise ValueError(key + ' for indexes task should be a positive integer, instead was: ' + str(res[key]))
+		if res['roi_order'] not in d2r.ordering.ROI_ORDERS:
+			raise ValueError('Unknown roi_order for indexes task: ' + res['roi_order'] + ', valid values are: ' + ', '.join(d2r.ordering.ROI_ORDERS))
+		if res['execution'] not in ['serial', 'parallel', 'zonal', 'pipeline']:
+			raise ValueError('Unknown execution mode for indexes task: ' + res['execution'])
+		for current_index in res['indexes'].replace(" ", "").split(','):
+			if hasattr(ari, current_index) and current_index not in ari.COLUMNS:
+				raise ValueError('Index ' + current_index + ' does not declare its output columns, see COLUMNS in d2r/tasks/array_returning_indexes.py')
+		if res['execution'] == 'zonal':
+			for current_index in res['indexes'].replace(" ", "").split(','):
+				if hasattr(ari, current_index) or current_index in mri.IMAGE_WIDE_INDEXES:
+					raise ValueError('Index ' + current_index + ' needs the whole ROI at once and cannot be computed with execution=zonal')
+			#the threshold is evaluated one block at a time, too
+			if res['threshold_expression'] is not None:
+				for current_index in res['threshold_expression'].names:
+					if current_index in mri.IMAGE_WIDE_INDEXES:
+						raise ValueError('Index ' + current_index + ' in threshold needs the whole ROI at once and cannot be computed with execution=zonal')
+
 		return(res)
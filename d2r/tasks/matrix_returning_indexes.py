@@ -9,10 +9,45 @@
 	With:
 	 - img: numpy ndarray, axis are rows, columns, channels
 	 - channels: list of strings representing the channel names (e.g. ['red', 'green', 'blue'])
+	
+	Each function should declare the channels it uses in REQUIRED_CHANNELS, so
+	that only those bands are read from the image
 """
 
 import numpy as np
 
+#indexes that are normalized using statistics of the whole input image
+#(e.g. the max and min temperature), thus their value on a pixel depends
+#on all the other pixels and cannot be computed block by block
+IMAGE_WIDE_INDEXES = ['TVI']
+
+#the channels used by each index, only these are read from the image. None
+#means that the index may use any channel, and all channels are read
+REQUIRED_CHANNELS = {
+	'TVI'             : ['red', 'green', 'blue', 'thermal'],
+	'NDVI'            : ['red', 'nir'],
+	'GLI'             : ['red', 'green', 'blue'],
+	'CVI'             : ['nir', 'red', 'green'],
+	'EVI'             : ['nir', 'red', 'blue'],
+	'CIG'             : ['nir', 'green'],
+	'CIrededge'       : ['nir', 'rededge'],
+	'CIrededge710'    : ['710', '750'],
+	'BGI'             : ['450', '550'],
+	'HUE'             : ['red', 'green', 'blue'],
+	'PSRI'            : ['500', '678', '750'],
+	'TVI_triangular'  : ['550', '670', '750'],
+	'TVI_transformed' : ['nir', 'red'],
+	'GNDVI'           : ['540:570', 'nir'],
+	'RVI'             : ['800', '670'],
+	'NDRE'            : ['rededge', 'nir'],
+	'NGRDI'           : ['red', 'green'],
+	'VARIgreen'       : ['459:490', '545:565', '620:680'],
+	'VARI700'         : ['470:490', '660:680', '700'],
+	'VARIrededge'     : ['700:710', '620:680'],
+	'VARIrgb'         : ['red', 'green', 'blue'],
+	'random_matrix'   : [],
+}
+
 def TVI(img, channels):
 	"""Thermal vegetation index, uses red, green, blue, thermal"""
 	try:
@@ -296,3 +331,117 @@ def random_matrix(img, channels):
 	return(np.random.rand((img.shape[0], img.shape[1])))   
 
 
+#----------------------- batch evaluation -----------------------
+#The functions below compute many indexes in a single call, sharing the
+#channel extraction and the common subexpressions (e.g. NIR+red is used by
+#NDVI, TVI_transformed...). Indexes without a fused definition are simply
+#computed via their function
+
+class _SharedTerms:
+	"""channels and intermediate results of a fused evaluation, each computed once"""
+	def __init__(self, img, channels, dtype):
+		self.img = img
+		self.channels = channels
+		self.dtype = dtype
+		self.cache = {}
+
+	def _cached(self, key, compute):
+		if key not in self.cache:
+			self.cache[key] = compute()
+		return(self.cache[key])
+
+	def channel(self, name):
+		#raises ValueError if the channel is not available
+		i = self.channels.index(name)
+		return(self._cached(('channel', name), lambda: np.asarray(self.img[:,:,i], dtype=self.dtype)))
+
+	def sum(self, a, b):
+		a, b = sorted([a, b])
+		return(self._cached(('sum', a, b), lambda: self.channel(a) + self.channel(b)))
+
+	def diff(self, a, b):
+		return(self._cached(('diff', a, b), lambda: self.channel(a) - self.channel(b)))
+
+	def ratio(self, a, b):
+		return(self._cached(('ratio', a, b), lambda: self.channel(a) / self.channel(b)))
+
+	def normalized_difference(self, a, b, out):
+		"""(a - b) / (a + b)"""
+		return(np.divide(self.diff(a, b), self.sum(a, b), out=out))
+
+	def index(self, name, out):
+		"""a fused index, stored in out and cached for other indexes that use it"""
+		self.cache[('index', name)] = _FUSED[name](self, out)
+		return(out)
+
+def _GLI(t, out):
+	green2 = t._cached(('scaled', 'green', 2.0), lambda: 2.0 * t.channel('green'))
+	red_blue = t.sum('red', 'blue')
+	return(np.divide(green2 - red_blue, green2 + red_blue, out=out))
+
+def _EVI(t, out):
+	denominator = t.channel('nir') + 6*t.channel('red') - 7.5*t.channel('blue') + 1
+	return(np.divide(2.5 * t.diff('nir', 'red'), denominator, out=out))
+
+def _TVI_transformed(t, out):
+	if ('index', 'NDVI') in t.cache:
+		ndvi = t.cache[('index', 'NDVI')]
+	else:
+		ndvi = t.normalized_difference('nir', 'red', None)
+	return(np.sqrt(ndvi + 0.5, out=out))
+
+#index name => function(shared terms, output plane) writing the index in the output plane
+_FUSED = {
+	'NDVI'         : lambda t, out: t.normalized_difference('nir', 'red', out),
+	'GNDVI'        : lambda t, out: t.normalized_difference('nir', '540:570', out),
+	'NDRE'         : lambda t, out: t.normalized_difference('nir', 'rededge', out),
+	'NGRDI'        : lambda t, out: t.normalized_difference('green', 'red', out),
+	'VARIrededge'  : lambda t, out: t.normalized_difference('700:710', '620:680', out),
+	'CIG'          : lambda t, out: np.subtract(t.ratio('nir', 'green'), 1, out=out),
+	'CIrededge'    : lambda t, out: np.subtract(t.ratio('nir', 'rededge'), 1, out=out),
+	'CIrededge710' : lambda t, out: np.subtract(t.ratio('750', '710'), 1, out=out),
+	'BGI'          : lambda t, out: np.copyto(out, t.ratio('450', '550')) or out,
+	'RVI'          : lambda t, out: np.copyto(out, t.ratio('800', '670')) or out,
+	'GLI'          : _GLI,
+	'EVI'          : _EVI,
+	'TVI_transformed' : _TVI_transformed,
+}
+
+def compute_indexes(img, channels, index_names, dtype=np.float64, out=None):
+	"""
+	Computes several indexes at once, returns a (n_indexes, rows, columns) array
+	
+	img, channels: as for the single index functions, missing data can be either
+	               masked or NaN. If img is a masked array the result is a masked
+	               array too, with invalid values masked
+	index_names: list of index names (function names in this module)
+	dtype: the type used for computation and output (e.g. np.float32 to halve the memory)
+	out: optional preallocated (n_indexes, rows, columns) array where to store the result
+	
+	Indexes not applicable to the passed channels are filled with NaN.
+	"""
+	masked = np.ma.isMaskedArray(img)
+	data = img.astype(dtype).filled(np.nan) if masked else img
+	if out is None:
+		out = np.empty((len(index_names), img.shape[0], img.shape[1]), dtype=dtype)
+	
+	terms = _SharedTerms(data, channels, dtype)
+	#non fused indexes get a masked array, with missing data (NaN) masked
+	legacy_img = img if masked else None
+	with np.errstate(divide='ignore', invalid='ignore'):
+		for k, name in enumerate(index_names):
+			try:
+				if name in _FUSED:
+					terms.index(name, out[k])
+				else:
+					if legacy_img is None:
+						legacy_img = np.ma.masked_invalid(img)
+					res = globals()[name](legacy_img, channels)
+					out[k] = np.ma.filled(res, np.nan) if np.ma.isMaskedArray(res) else res
+			except ValueError:
+				#if this clause is activated it means that the requested channel(s) are not available
+				out[k] = np.nan
+
+	if masked:
+		return(np.ma.masked_invalid(out))
+	return(out)
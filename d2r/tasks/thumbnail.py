@@ -1,7 +1,6 @@
 import os
 import pathlib
 import numpy as np
-from osgeo import gdal
 from PIL import Image
 
 import d2r.tasks.matrix_returning_indexes
@@ -13,86 +12,112 @@ class thumbnail(Task):
 		#a bit of interface
 		self.logger.info('TASK:' + self.to_string() + ', DATASET:' + dataset.to_string() )
 
-		#computing the index/channel over all image
-		myindex = self._compute_index(self.config['index_investigated'], dataset)	
-		mysubindex = self._compute_index(self.config['subindex_investigated'], dataset)	
-		
-		#if we have an index, for each required threshold
-		if myindex is not None:
+		#making sure the output folder do exists
+		path = pathlib.Path(self.config['outfolder'])
+		path.mkdir(parents=True, exist_ok=True)
+
+		#the list of thumbnails to be done, as (index_threshold, subindex_threshold) pairs
+		thumbnails = []
+		if self.config['index_investigated'] is not None:
 			for index_threshold in self.config['index_thresholds']:
-				if mysubindex is None:
+				if self.config['subindex_investigated'] is None:
 					#no subindex, just an index
-					self._make_thumbnail(dataset=dataset, index=myindex, index_threshold=index_threshold)
+					thumbnails.append((index_threshold, None))
 				else:
-					#for every requested subindex threshold				
+					#for every requested subindex threshold
 					for subindex_threshold in self.config['subindex_thresholds']:
-						self._make_thumbnail(dataset=dataset, index=myindex, index_threshold=index_threshold, subindex=mysubindex, subindex_threshold=subindex_threshold)
-		
+						thumbnails.append((index_threshold, subindex_threshold))
 		#extra: no threshold, just the image
-		self._make_thumbnail(dataset=dataset)
-	
-	def _compute_index(self, target, dataset):
-		"""compute the target index on the passed dataset, returns a matrix"""
-		#we support an empty target
-		if target is None:
-			return None
-
-		#if we get here we need to work
-		res = None	
-		
-		#I need all the data here, not only the visible channels, for computation
-		raster_data_raw = dataset.get_raster_data(
+		thumbnails.append((None, None))
+
+		#check if we should do the thumbnails or not
+		todo = []
+		for index_threshold, subindex_threshold in thumbnails:
+			outfile = self._get_outfile(dataset, index_threshold, subindex_threshold)
+			if os.path.isfile(outfile) and self.config['skip_if_already_done']:
+				self.logger.info('skipping, output file already exists: ' + outfile)
+			else:
+				todo.append((outfile, index_threshold, subindex_threshold))
+		if len(todo) == 0:
+			return(None)
+
+		#all the channels are read once, from the resized image, and then
+		#used for both index computation and output
+		#(plain arrays, missing data as NaN)
+		raster_data_raw = dataset.get_raster_block(
 			selected_channels = dataset.get_channels(), 
 			output_width = self.config['output_width'], 
-			rescale_to_255=False, normalize_if_possible=True)
-		
-		#is it an actual index?
-		if hasattr(d2r.tasks.matrix_returning_indexes, target):
-			index_function = getattr(d2r.tasks.matrix_returning_indexes, target)
-			res = index_function(raster_data_raw, dataset.get_channels())
-		
-		#is is a simple channel?
-		if target in dataset.get_channels():
-			i = dataset.get_channels().index(target)
-			res = raster_data_raw[:,:,i]
+			rescale_to_255=False, normalize_if_possible=False).data
+
+		#computing the index/channel over all image, index and subindex in a single pass
+		raster_data_normalized = dataset.normalize_raster(raster_data_raw)
+		(myindex, mysubindex) = self._compute_indexes([self.config['index_investigated'], self.config['subindex_investigated']], dataset, raster_data_normalized)
+
+		#I just need the visible channels here, for output
+		visible = [dataset.get_channels().index(x) for x in dataset.get_visible_channels()]
+		output_raster = raster_data_raw[:, :, visible]
+		if self.config['rescale_to_255']:
+			output_raster = dataset.rescale_raster_to_255(output_raster)
+
+		#should we draw the ROI perimeters, too? They are traced once for all thumbnails
+		perimeter = None
+		if self.config['draw_rois']:
+			resized_ds = dataset.get_resized_ds(target_width = self.config['output_width'])
+			#only the ROIs intersecting the image are traced
+			visible_rois = dataset.query_window(0, 0, dataset.ds.RasterXSize, dataset.ds.RasterYSize)
+			perimeter = d2r.misc.get_ROI_perimeter(ROIs=dataset.shapes.iloc[visible_rois], target_img=resized_ds, shape=output_raster.shape, verbose = self.config['verbose'], logger = self.logger)
+
+		#all thresholded variants, from memory
+		for outfile, index_threshold, subindex_threshold in todo:
+			self._make_thumbnail(outfile, output_raster, perimeter, 
+				index=None if index_threshold is None else myindex, index_threshold=index_threshold, 
+				subindex=None if subindex_threshold is None else mysubindex, subindex_threshold=subindex_threshold)
+	
+	def _compute_indexes(self, targets, dataset, raster_data_raw):
+		"""compute the target indexes on the passed raster data (all channels), returns a list of matrices (None for None targets)"""
+		res = [None] * len(targets)
+		channels = dataset.get_channels()
+
+		#actual indexes are computed all together, sharing the common terms
+		index_positions = [i for i, target in enumerate(targets) if target is not None and hasattr(d2r.tasks.matrix_returning_indexes, target)]
+		if len(index_positions) > 0:
+			planes = d2r.tasks.matrix_returning_indexes.compute_indexes(raster_data_raw, channels, [targets[i] for i in index_positions], dtype=raster_data_raw.dtype)
+			for plane, i in zip(planes, index_positions):
+				res[i] = plane
 		
-		#have we failed?
-		if res is None:
-			raise ValueError('In .ini file, requested unknown index or channels (case sensitive): ' + target)
+		for i, target in enumerate(targets):
+			#we support an empty target
+			if target is None:
+				continue
+
+			#is is a simple channel?
+			if target in channels:
+				res[i] = raster_data_raw[:,:,channels.index(target)]
+			
+			#have we failed?
+			if res[i] is None:
+				raise ValueError('In .ini file, requested unknown index or channels (case sensitive): ' + target)
 		
 		#done
 		return(res)
 
-	def _make_thumbnail(self, dataset, index=None, index_threshold=None, subindex=None, subindex_threshold=None):
-		#building the file name, which is slightly different if we 
-		#are doing no threshold, index, or subindex
+	def _get_outfile(self, dataset, index_threshold=None, subindex_threshold=None):
+		"""building the file name, which is slightly different if we are doing no threshold, index, or subindex"""
 		outfile = os.path.join(self.config['outfolder'], dataset.get_title())
 		outfile = outfile + '_' + ''.join(dataset.get_visible_channels())
-		if index is not None:
+		if index_threshold is not None:
 			outfile = outfile + '_index' + self.config['index_investigated'] + '_threshold' + str(index_threshold)
-		if subindex is not None:
+		if subindex_threshold is not None:
 			outfile = outfile + '_subindex' + self.config['subindex_investigated'] + '_threshold' + str(subindex_threshold)
-		outfile = outfile + '.png'
-		
-		#making sure the output folder do exists
-		path = pathlib.Path(self.config['outfolder'])
-		path.mkdir(parents=True, exist_ok=True)
-		
-		#check if we should do the task or not
-		if os.path.isfile(outfile) and self.config['skip_if_already_done']:
-			self.logger.info('skipping, output file already exists: ' + outfile)
-			return(None)
+		return(outfile + '.png')
 
-		#I just need the visible channels here, for output	
-		output_raster = dataset.get_raster_data(
-			selected_channels = dataset.get_visible_channels(), 
-			output_width = self.config['output_width'], 
-			rescale_to_255=self.config['rescale_to_255'], normalize_if_possible=False)
+	def _make_thumbnail(self, outfile, visible_raster, perimeter=None, index=None, index_threshold=None, subindex=None, subindex_threshold=None):
+		#a copy of the visible channels, to be colored. Missing data is black
+		output_raster = np.nan_to_num(visible_raster, nan=0)
 
-		#thresholding index
+		#thresholding index (NaN values are never above threshold)
 		if index is not None:
 			selector = index > index_threshold
-			selector = np.ma.filled(selector, fill_value=False)
 			output_raster[selector, :] = (0, 255, 255)
 		
 		#thresholding subindex
@@ -101,9 +126,9 @@ class thumbnail(Task):
 			output_raster[selector, :] = (0, 0, 255)
 		
 		#should we draw the ROI perimeters, too? 
-		if self.config['draw_rois']:
-			resized_ds = dataset.get_resized_ds(target_width = self.config['output_width'])
-			d2r.misc.draw_ROI_perimeter(ROIs=dataset.shapes, target_img=resized_ds, raster_data=output_raster, verbose = self.config['verbose'], logger = self.logger)
+		if perimeter is not None:
+			rr, cc = perimeter
+			output_raster[rr, cc, :] = (255, 0, 0)
 		
 		#save the image
 		foo = Image.fromarray(output_raster.astype(np.uint8))
@@ -118,7 +143,7 @@ class thumbnail(Task):
 				res[key] = int(res[key])
 			elif key in ['index_thresholds', 'subindex_thresholds']:
 				res[key] = [float(x) for x in res[key].split(',')]
-			elif key in ['rescale_to_255', 'draw_ROIs']:
+			elif key in ['rescale_to_255', 'draw_rois']:
 				res[key] = d2r.misc.parse_boolean(res[key])
 		
 		#sanity
@@ -0,0 +1,129 @@
+#This module contains the building blocks for zonal statistics: summary
+#statistics computed for many zones (ROIs) at once, while streaming over
+#the raster one block at a time. Each block contributes the values of its
+#pixels, tagged with the zone they belong to, and the statistics are
+#accumulated without ever holding a full zone in memory
+
+import numpy as np
+
+class QuantileSketch:
+	"""
+	A mergeable summary of a stream of values, used to estimate quantiles
+
+	Values are stored as they come until more than "capacity" are collected,
+	then they are compressed into capacity/2 weighted centroids of equal weight.
+	As long as no compression happened the quantiles are exact (same as
+	np.quantile), afterwards they are an approximation.
+	"""
+	def __init__(self, capacity=4096):
+		self.capacity = capacity
+		self.values = np.empty(0)
+		self.weights = np.empty(0)
+		self.exact = True
+
+	def update(self, values, weights=None):
+		"""adds the passed values (1D array) to the sketch"""
+		values = np.asarray(values, dtype=float).ravel()
+		if weights is None:
+			weights = np.ones(len(values))
+		else:
+			self.exact = False
+		self.values = np.concatenate((self.values, values))
+		self.weights = np.concatenate((self.weights, weights))
+		if len(self.values) > self.capacity:
+			self._compress()
+
+	def merge(self, other):
+		"""adds all the values summarized by another sketch"""
+		if other.exact:
+			self.update(other.values)
+		else:
+			self.update(other.values, other.weights)
+
+	def count(self):
+		"""number of values added so far"""
+		return(self.weights.sum())
+
+	def quantile(self, q):
+		"""the q-th quantile of the added values, np.nan if the sketch is empty"""
+		if len(self.values) == 0:
+			return(np.nan)
+		if self.exact:
+			return(np.quantile(self.values, q))
+		#weighted quantile, each centroid standing in the middle of its weight
+		order = np.argsort(self.values)
+		values = self.values[order]
+		weights = self.weights[order]
+		positions = (np.cumsum(weights) - weights / 2) / weights.sum()
+		return(np.interp(q, positions, values))
+
+	def _compress(self):
+		"""merges the stored values into capacity/2 equal weight centroids"""
+		order = np.argsort(self.values)
+		values = self.values[order]
+		weights = self.weights[order]
+		buckets = self.capacity // 2
+		cumulative = np.cumsum(weights)
+		target = np.floor((cumulative - weights / 2) / cumulative[-1] * buckets).astype(int)
+		new_weights = np.bincount(target, weights=weights, minlength=buckets)
+		new_values = np.bincount(target, weights=weights * values, minlength=buckets)
+		keep = new_weights > 0
+		self.values = new_values[keep] / new_weights[keep]
+		self.weights = new_weights[keep]
+		self.exact = False
+
+class ZonalAccumulator:
+	"""
+	Accumulates count, sum, sum of squares, min and max (plus a quantile
+	sketch for the median) of a single variable for n_zones zones,
+	identified by integers in the [0, n_zones) range
+	"""
+	def __init__(self, n_zones, sketch_capacity=4096):
+		self.n_zones = n_zones
+		self.sketch_capacity = sketch_capacity
+		self.count = np.zeros(n_zones)
+		self.sum = np.zeros(n_zones)
+		self.sumsq = np.zeros(n_zones)
+		self.min = np.full(n_zones, np.inf)
+		self.max = np.full(n_zones, -np.inf)
+		self.sketches = {}
+
+	def update(self, zones, values):
+		"""adds the passed values (1D array) to the corresponding zones (1D int array, same length)"""
+		if len(values) == 0:
+			return None
+		values = np.asarray(values, dtype=float)
+		self.count += np.bincount(zones, minlength=self.n_zones)
+		self.sum += np.bincount(zones, weights=values, minlength=self.n_zones)
+		self.sumsq += np.bincount(zones, weights=values * values, minlength=self.n_zones)
+		np.minimum.at(self.min, zones, values)
+		np.maximum.at(self.max, zones, values)
+
+		#grouping the values by zone, for the sketches
+		order = np.argsort(zones, kind='stable')
+		zones = zones[order]
+		values = values[order]
+		starts = np.flatnonzero(np.r_[True, zones[1:] != zones[:-1]])
+		ends = np.r_[starts[1:], len(zones)]
+		for start, end in zip(starts, ends):
+			zone = int(zones[start])
+			if zone not in self.sketches:
+				self.sketches[zone] = QuantileSketch(self.sketch_capacity)
+			self.sketches[zone].update(values[start:end])
+		return None
+
+	def statistics(self, zone):
+		"""returns a dict with mean, median, std, max and min for the passed zone, np.nan if zone is empty"""
+		n = self.count[zone]
+		if n == 0:
+			return({'mean' : np.nan, 'median' : np.nan, 'std' : np.nan, 'max' : np.nan, 'min' : np.nan})
+		mean = self.sum[zone] / n
+		#population standard deviation, same as np.std
+		variance = max(self.sumsq[zone] / n - mean * mean, 0.0)
+		return({
+			'mean'   : mean,
+			'median' : self.sketches[zone].quantile(0.5),
+			'std'    : np.sqrt(variance),
+			'max'    : self.max[zone],
+			'min'    : self.min[zone]
+		})
@@ -3,26 +3,42 @@ import sys
 import pprint
 
 #drone2report specific submodules
-from d2r.config import read_config
+from d2r.config import read_config, read_run_config
+import d2r.logger
+import d2r.scheduler
+import d2r.misc
 
 def drone2report(infile):
 	print('========================== DATASET SETUP ===========================')
 	#reading the config in
 	datasets, tasks, renders = read_config(infile)
+	run_config = read_run_config(infile)
+	logger = d2r.logger.get_logger('d2r.scheduler', run_config)
+	
+	#the GDAL block cache, shared by all datasets (worker processes inherit it)
+	if run_config['gdal_cachemax'] is not None:
+		d2r.misc.set_gdal_cachemax(run_config['gdal_cachemax'])
+		logger.info('GDAL block cache set to ' + str(run_config['gdal_cachemax']) + ' MB')
 	
 	print('\n========================== RUNNING TASKS ===========================')
-	#applying all tasks to all datasets
-	for t in tasks:
-		for d in datasets:
-			t.run(d)
+	#applying all tasks to all datasets. Datasets are opened when first
+	#accessed and closed after the last job using them: with loop_order=dataset
+	#only one is in memory at a time (or one per process, if running in parallel)
+	cores = run_config['cores'] if run_config['parallel_jobs'] else 1
+	jobs = d2r.scheduler.make_jobs(tasks, datasets, run_config['loop_order'], parallel=cores > 1)
+	failures = d2r.scheduler.run_jobs(jobs, cores, run_config['logfolder'], logger)
 
 	print('\n============================ RENDERING =============================')
-	#executing all the renderings
+	#executing all the renderings, only after all tasks are done
 	for r in renders:
 		r.run()
 	
+	#a failing task does not stop the others, but it's reported here
+	for task_title, dataset_title, msg in failures:
+		logger.info('FAILED: task ' + task_title + ' on dataset ' + dataset_title + '\n' + msg)
+	
 	#done
-	return None
+	return failures
 
 if __name__ == "__main__":
 	print('Welcome to Drone2Report!')
@@ -33,6 +49,8 @@ if __name__ == "__main__":
 		exit(0)
 	
 	#invoking drone2report
-	drone2report(sys.argv[1])
+	failures = drone2report(sys.argv[1])
+	if len(failures) > 0:
+		exit(1)
 
 	
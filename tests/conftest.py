@@ -0,0 +1,119 @@
+import os
+import numpy as np
+import pytest
+
+#the test image: 64x48 pixels, tiled in 16x16 blocks, one pixel per meter
+WIDTH, HEIGHT = 64, 48
+ORIGIN_X, ORIGIN_Y = 500000, 5000000
+CHANNELS = ['red', 'nir', 'thermal']
+
+def grid_rois(columns=4, rows=3, size=10, step=15, start=3):
+	"""a grid of square ROIs, as (x0, y0, x1, y1) boxes in pixel coordinates"""
+	return [(start + step * i, start + step * j, start + step * i + size, start + step * j + size)
+			for j in range(rows) for i in range(columns)]
+
+@pytest.fixture
+def make_dataset(tmp_path):
+	"""
+	Returns a function building a test Dataset: a 3 channels (red, nir, thermal)
+	float32 GeoTIFF and a shapes file with one polygon per passed ROI, indexed by
+	plot_id. ROIs are (x0, y0, x1, y1) boxes in pixel coordinates (grid_rois() by
+	default), or shapely geometries, either as a list (plot_id from 1) or as a
+	{plot_id : ROI} dict. The image declares image_nodata as nodata value, and
+	the pixels selected by nodata_pixels (an index on the image array) are
+	set to it. Other keyword arguments are added to the dataset config. The
+	image values and file are in dataset.test_data and dataset.test_image_file:
+	passing the latter as image_file (and the same title) builds another
+	dataset on the same image
+	"""
+	gdal = pytest.importorskip('osgeo.gdal')
+	osr = pytest.importorskip('osgeo.osr')
+	gpd = pytest.importorskip('geopandas')
+	shapely = pytest.importorskip('shapely')
+	import d2r.config
+	import d2r.dataset
+
+	counter = [0]
+	def make(rois=None, image_nodata=None, nodata_pixels=None, data=None, image_file=None, title=None, **options):
+		counter[0] += 1
+		folder = tmp_path / ('dataset' + str(counter[0]))
+		folder.mkdir()
+		if image_file is None:
+			data, image_file = write_image(folder, data, image_nodata, nodata_pixels)
+
+		#the shapes, from pixel to georeferenced coordinates
+		if rois is None:
+			rois = grid_rois()
+		if not isinstance(rois, dict):
+			rois = dict(zip(range(1, len(rois) + 1), rois))
+		geometries = [roi if isinstance(roi, shapely.Geometry) else
+					  shapely.box(ORIGIN_X + roi[0], ORIGIN_Y - roi[3], ORIGIN_X + roi[2], ORIGIN_Y - roi[1]) for roi in rois.values()]
+		shapes = gpd.GeoDataFrame({'plot_id': list(rois.keys())}, geometry=geometries, crs='EPSG:32632')
+		shapes_file = str(folder / 'shapes.gpkg')
+		shapes.to_file(shapes_file)
+
+		config = {
+			'type': 'tif_multichannel',
+			'orthomosaic': image_file,
+			'channels': ','.join(CHANNELS),
+			'visible_channels': 'red,nir,thermal',
+			'shapes_file': shapes_file,
+			'shapes_index': 'plot_id',
+			'logfolder': str(tmp_path / 'logs'),
+			'active': 'True',
+		}
+		config.update({key: str(value) for key, value in options.items()})
+		dataset = d2r.dataset.Dataset('test_image' + str(counter[0]) if title is None else title, config)
+		dataset.test_data = data
+		dataset.test_image_file = image_file
+		return dataset
+
+	def write_image(folder, data, nodata, nodata_pixels):
+		if data is None:
+			data = np.random.default_rng(counter[0]).uniform(0.1, 1, size=(HEIGHT, WIDTH, len(CHANNELS))).astype(np.float32)
+		if nodata_pixels is not None:
+			data[nodata_pixels] = nodata
+		image_file = str(folder / 'image.tif')
+		ds = gdal.GetDriverByName('GTiff').Create(image_file, data.shape[1], data.shape[0], data.shape[2], gdal.GDT_Float32,
+			options=['TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16', 'INTERLEAVE=PIXEL'])
+		ds.SetGeoTransform((ORIGIN_X, 1, 0, ORIGIN_Y, 0, -1))
+		srs = osr.SpatialReference()
+		srs.ImportFromEPSG(32632)
+		ds.SetProjection(srs.ExportToWkt())
+		for i in range(data.shape[2]):
+			band = ds.GetRasterBand(i + 1)
+			band.WriteArray(data[:, :, i])
+			if nodata is not None:
+				band.SetNoDataValue(nodata)
+		ds = None
+		return data, image_file
+	return make
+
+@pytest.fixture
+def make_task(tmp_path):
+	"""Returns a function building an indexes task writing in tmp_path/out, keyword arguments are added to the task config"""
+	pytest.importorskip('osgeo')
+	pytest.importorskip('tqdm')
+	import d2r.config
+	import d2r.tasks.indexes
+
+	def make(indexes='NDVI,red', **options):
+		config = {
+			'outfolder': str(tmp_path / 'out'),
+			'logfolder': str(tmp_path / 'logs'),
+			'indexes': indexes,
+			'active': 'True',
+			'skip_if_already_done': 'False',
+		}
+		config.update({key: str(value) for key, value in options.items()})
+		return d2r.tasks.indexes.indexes('indexes', config)
+	return make
+
+@pytest.fixture
+def read_results():
+	"""Returns a function reading the output table of an indexes task on a dataset, as a DataFrame"""
+	def read(task, dataset):
+		import d2r.collector
+		outfile = os.path.join(task.config['outfolder'], 'indexes_' + dataset.get_title() + d2r.collector.TABLE_FORMATS[task.config['output_format']])
+		return d2r.collector.read_table(outfile)
+	return read
@@ -0,0 +1,74 @@
+import pytest
+import pandas as pd
+from d2r.collector import ResultCollector, read_table, write_table, table_format, table_columns, iter_tables, union_columns, union_schema
+
+def test_rows_become_one_table():
+    """Rows and frames should end up in a single table, in insertion order."""
+    collector = ResultCollector()
+    collector.append({'id': 1, 'value': 0.5})
+    collector.append({'id': 2, 'value': 0.7})
+    collector.append_frame(pd.DataFrame({'id': [3, 4], 'value': [0.1, 0.2]}))
+    df = collector.to_dataframe()
+    assert list(df['id']) == [1, 2, 3, 4]
+
+def test_chunked_flush(tmp_path):
+    """Flushing in chunks should produce the same file as a single save."""
+    outfile = tmp_path / 'table.csv'
+    collector = ResultCollector(outfile, flush_rows=3)
+    for i in range(10):
+        collector.append({'id': i, 'value': i * 2})
+    collector.save()
+    df = pd.read_csv(outfile)
+    assert list(df['id']) == list(range(10))
+    assert list(df['value']) == [i * 2 for i in range(10)]
+
+def test_table_formats(tmp_path):
+    """Tables are read and written according to the file extension, columns can be selected."""
+    df = pd.DataFrame({'id': [1, 2], 'NDVI_mean': [0.5, 0.7], 'NDVI_std': [0.1, 0.2]})
+    outfile = tmp_path / 'indexes_test.csv'
+    write_table(df, outfile)
+    assert table_format(outfile) == 'csv'
+    assert table_format(tmp_path / 'indexes_test.parquet') == 'parquet'
+    assert table_format(tmp_path / 'indexes_test.json') is None
+    assert table_columns(outfile) == ['id', 'NDVI_mean', 'NDVI_std']
+    assert list(read_table(outfile, columns=['id', 'NDVI_mean']).columns) == ['id', 'NDVI_mean']
+
+def test_streamed_union(tmp_path):
+    """Tables with different columns should be streamed into their union, in file order."""
+    first = tmp_path / 'indexes_a.csv'
+    second = tmp_path / 'indexes_b.csv'
+    pd.DataFrame({'id': range(5), 'NDVI_mean': 0.5}).to_csv(first, index=False)
+    pd.DataFrame({'id': range(5, 12), 'GLI_mean': 0.1}).to_csv(second, index=False)
+    columns = union_columns([first, second])
+    assert columns == ['id', 'NDVI_mean', 'GLI_mean']
+    outfile = tmp_path / 'summary.csv'
+    collector = ResultCollector(outfile, flush_rows=4, columns=columns)
+    for _, chunk in iter_tables([first, second], chunk_rows=3, workers=2):
+        assert len(chunk.index) <= 3
+        collector.append_frame(chunk)
+    collector.save()
+    df = pd.read_csv(outfile)
+    assert list(df['id']) == list(range(12))
+    assert df['GLI_mean'].isna().sum() == 5
+
+@pytest.mark.parametrize('partition_cols', [None, ['flight']])
+def test_mixed_types_to_parquet(tmp_path, partition_cols):
+    """A column empty in a table and with strings in another should be collected as strings."""
+    pyarrow = pytest.importorskip('pyarrow')
+    write_table(pd.DataFrame({'flight': ['a'] * 3, 'plot_id': [1, 2, 3], 'threshold': [float('nan')] * 3, 'NDVI_mean': [0.1, 0.2, 0.3]}), tmp_path / 'indexes_a.csv')
+    write_table(pd.DataFrame({'flight': ['b'] * 3, 'plot_id': [1, 2, 3], 'threshold': ['NDVI > 0.3'] * 3, 'NDVI_mean': [1, 2, 3]}), tmp_path / 'indexes_b.csv')
+    infiles = [tmp_path / 'indexes_a.csv', tmp_path / 'indexes_b.csv']
+
+    schema = union_schema(infiles, chunk_rows=2)
+    assert pyarrow.types.is_string(schema.field('threshold').type) or pyarrow.types.is_large_string(schema.field('threshold').type)
+    assert pyarrow.types.is_float64(schema.field('NDVI_mean').type)
+    outfile = tmp_path / 'indexes.parquet'
+    collector = ResultCollector(outfile, flush_rows=2, columns=schema.names, partition_cols=partition_cols, schema=schema)
+    for f, chunk in iter_tables(infiles, 2):
+        collector.append_frame(chunk)
+    collector.save()
+
+    df = read_table(outfile).sort_values(['flight', 'plot_id'])
+    assert list(df['threshold'].isna()) == [True] * 3 + [False] * 3
+    assert list(df['threshold'][3:]) == ['NDVI > 0.3'] * 3
+    assert list(df['NDVI_mean']) == [0.1, 0.2, 0.3, 1, 2, 3]
@@ -0,0 +1,166 @@
+import os
+import numpy as np
+import pytest
+from conftest import ORIGIN_X, ORIGIN_Y
+
+def _polygon(*points):
+	"""a shapely polygon from (column, row) pixel coordinates"""
+	shapely = pytest.importorskip('shapely')
+	return shapely.Polygon([(ORIGIN_X + x, ORIGIN_Y - y) for x, y in points])
+
+def test_label_image_matches_polygon_fallback(make_dataset):
+	"""The label image and the one-by-one rasterization select the same pixels: the ones whose center is inside the ROI."""
+	rois = [(3, 3, 13, 13), _polygon((20.3, 4.1), (45.7, 9.2), (27.2, 40.6)), _polygon((50.2, 2.7), (61.6, 20.4), (49.1, 30.9))]
+	labelled = make_dataset(rois=rois, label_image=True)
+	fallback = make_dataset(rois=rois, image_file=labelled.test_image_file)
+	for position, geom in enumerate(labelled.shapes.geometry):
+		expected = labelled.get_geom_clipmask_2d(geom, position)
+		assert np.array_equal(fallback.get_geom_clipmask_2d(geom, position), expected)
+	#the square ROI covers exactly its 10x10 pixels
+	assert np.sum(~fallback.get_geom_clipmask_2d(fallback.get_geom(0))) == 100
+
+def test_nodata_value_without_reopening(make_dataset):
+	"""The nodata value is read once from the image, or taken from the config, and does not need the image to stay open."""
+	dataset = make_dataset(image_nodata=-1)
+	assert dataset.get_nodata_value() == -1
+	dataset.close()
+	assert dataset.get_nodata_value() == -1
+	assert not dataset.is_open()
+
+	configured = make_dataset(image_file=dataset.test_image_file, nodata=5)
+	assert configured.get_nodata_value() == 5
+	assert not configured.is_open()
+
+def test_coordinates_conversion(make_dataset):
+	"""The vectorized conversions match GDAL's point by point ones, both ways."""
+	import d2r.dataset
+	dataset = make_dataset()
+	pixels = np.array([[0, 0], [10.5, 3.25], [64, 48]])
+	geo = dataset.pix_to_geo(pixels)
+	assert np.allclose(geo[0], (ORIGIN_X, ORIGIN_Y))
+	for pixel, point in zip(pixels, geo):
+		assert np.allclose(d2r.dataset.transform_coords(dataset.ds, pixel, 'pix'), point)
+		assert np.allclose(d2r.dataset.transform_coords(dataset.ds, point, 'geo'), pixel)
+	assert np.allclose(dataset.geo_to_pix(geo), pixels)
+
+def test_overview_level(make_dataset):
+	"""The smallest overview still wide enough is chosen, None when the full resolution is needed."""
+	gdal = pytest.importorskip('osgeo.gdal')
+	dataset = make_dataset()
+	ds = gdal.Open(dataset.test_image_file, gdal.GA_Update)
+	ds.BuildOverviews('AVERAGE', [2, 4])
+	ds = None
+	assert dataset.get_overview_level(10) == 1
+	assert dataset.get_overview_level(20) == 0
+	assert dataset.get_overview_level(40) is None
+
+def test_overviews_in_separate_folder(make_dataset, tmp_path):
+	"""Overviews are built next to a VRT in overviews_folder, and downsampled reads come from them."""
+	data = np.random.default_rng(0).uniform(0.1, 1, size=(520, 520, 3)).astype(np.float32)
+	dataset = make_dataset(data=data, overviews=True, overviews_folder=tmp_path / 'overviews', resampling='average')
+	assert dataset.ds.GetRasterBand(1).GetOverviewCount() == 1
+	assert not os.path.isfile(dataset.test_image_file + '.ovr')
+	assert any(f.endswith('.vrt.ovr') for f in os.listdir(tmp_path / 'overviews'))
+
+	block = dataset.get_raster_block(['red', 'thermal'], output_width=260, rescale_to_255=False)
+	expected = data[:, :, [0, 2]].reshape(260, 2, 260, 2, 2).mean(axis=(1, 3))
+	assert np.allclose(block.data, expected, atol=1e-5)
+
+def test_joined_datasets(make_dataset, tmp_path):
+	"""Multi-file datasets give the same pixels whether joined lazily (VRTs) or in memory."""
+	import d2r.dataset
+	first = make_dataset()
+	second = make_dataset()
+	windows = {}
+	for join_mode in ['lazy', 'memory']:
+		config = {
+			'type': 'tif_multichannel',
+			'orthomosaic_a': first.test_image_file,
+			'channels_a': 'red,nir,thermal',
+			'orthomosaic_b': second.test_image_file,
+			'channels_b': 'green,blue,rededge',
+			'visible_channels': 'red,green,blue',
+			'shapes_file': first.get_files()[1],
+			'shapes_index': 'plot_id',
+			'nodata': '-10000',
+			'join_mode': join_mode,
+			'verbose': 'False',
+			'logfolder': str(tmp_path / 'logs'),
+		}
+		joined = d2r.dataset.Dataset('joined_' + join_mode, config)
+		assert joined.get_channels() == ['red', 'nir', 'thermal', 'green', 'blue', 'rededge']
+		windows[join_mode] = joined.read_window(8, 4, 40, 30, selected_channels=['thermal', 'green', 'red'])
+	assert np.array_equal(windows['lazy'], windows['memory'])
+	assert np.allclose(windows['lazy'][:, :, [2, 0]], first.test_data[4:34, 8:48, [0, 2]])
+
+def test_working_dtype(make_dataset):
+	"""ROI blocks use the configured dtype, the native one being the smallest float holding the image values."""
+	reference = make_dataset()
+	expected = reference.get_geom_block(0).data
+	assert expected.dtype == np.float64
+	for dtype, block_dtype in [('float32', np.float32), ('native', np.float32)]:
+		dataset = make_dataset(image_file=reference.test_image_file, dtype=dtype)
+		assert dataset.get_block_dtype() == block_dtype
+		block = dataset.get_geom_block(0)
+		assert block.data.dtype == block_dtype
+		assert np.array_equal(block.data, expected.astype(block_dtype), equal_nan=True)
+	assert dataset.get_read_dtype() == np.float32
+
+def test_read_window_interleaving(make_dataset, tmp_path):
+	"""Windows read in a single call (pixel interleaved) or band by band give the requested channels, in order."""
+	gdal = pytest.importorskip('osgeo.gdal')
+	pixel = make_dataset()
+	band_file = str(tmp_path / 'band.tif')
+	gdal.Translate(band_file, pixel.test_image_file, creationOptions=['INTERLEAVE=BAND', 'TILED=YES'])
+	band = make_dataset(image_file=band_file)
+	assert pixel.get_interleave() == 'PIXEL'
+	assert band.get_interleave() == 'BAND'
+	for channels in [['thermal', 'red'], ['nir'], None]:
+		columns = [0, 1, 2] if channels is None else [pixel.get_channels().index(c) for c in channels]
+		expected = pixel.test_data[5:25, 10:50][:, :, columns]
+		for dataset in [pixel, band]:
+			window = dataset.read_window(10, 5, 40, 20, selected_channels=channels)
+			assert window.shape == expected.shape
+			assert np.array_equal(window, expected)
+
+def test_selectors_and_spatial_queries(make_dataset):
+	"""ROIs are found by selector through the hash index, and by position through the spatial index."""
+	dataset = make_dataset(rois={10: (3, 3, 13, 13), 20: (18, 3, 28, 13), 30: (3, 18, 13, 28)})
+	assert dataset.get_geom_position({'plot_id': 20}) == 1
+	assert dataset.get_geom_position(2) == 2
+	assert dataset.get_geom({'plot_id': 30}).equals(dataset.shapes.geometry.iloc[2])
+	with pytest.raises(ValueError):
+		dataset.get_geom_position({'plot_id': 40})
+	assert list(dataset.query_window(0, 0, 15, 40)) == [0, 2]
+	assert list(dataset.query_window(14, 14, 2, 2)) == []
+	shapely = pytest.importorskip('shapely')
+	assert list(dataset.query_geoms(shapely.Point(ORIGIN_X + 20, ORIGIN_Y - 5))) == [1]
+
+def test_duplicated_selectors(make_dataset):
+	"""Fields in shapes_index must identify the ROIs uniquely."""
+	dataset = make_dataset(rois={1: (3, 3, 13, 13), 2: (18, 3, 28, 13)}, shapes_index='plot_id,not_a_field')
+	with pytest.raises(ValueError, match='not present'):
+		dataset.shapes
+	dataset = make_dataset(rois=[(3, 3, 13, 13), (18, 3, 28, 13)], shapes_index='plot_id')
+	gpd = pytest.importorskip('geopandas')
+	shapes = gpd.read_file(dataset.get_files()[1])
+	shapes['plot_id'] = 1
+	shapes.to_file(dataset.get_files()[1])
+	with pytest.raises(ValueError, match='uniquely'):
+		dataset.shapes
+
+def test_ROI_status(make_dataset):
+	"""ROIs are classified against the image extent without reading pixels, partial ones are padded with missing data."""
+	dataset = make_dataset(rois=[(3, 3, 13, 13), (58, 40, 70, 52), (70, 10, 80, 20), (-5, -5, 0, 0)])
+	assert list(dataset.get_ROI_status()) == ['inside', 'partial', 'outside', 'outside']
+	assert [dataset.is_bounding_box_inside(geom) for geom in dataset.shapes.geometry] == [True, False, False, False]
+	assert dataset.get_geom_block(2) is None
+
+	block = dataset.get_geom_block(1)
+	assert block.data.shape == (12, 12, 3)
+	assert block.count() == 48
+	assert np.array_equal(block.data[0:8, 0:6], dataset.test_data[40:48, 58:64])
+	assert np.all(np.isnan(block.data[8:, :])) and np.all(np.isnan(block.data[:, 6:]))
+	blocks = dict(dataset.iter_geom_blocks([3, 1, 0, 2]))
+	assert blocks[2] is None and blocks[3] is None
+	assert np.array_equal(blocks[1].data, block.data, equal_nan=True)
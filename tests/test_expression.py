@@ -0,0 +1,45 @@
+import pickle
+import numpy as np
+import pytest
+import d2r.tasks.matrix_returning_indexes as mri
+from d2r.expression import ThresholdExpression
+
+def _image():
+    rng = np.random.default_rng(1)
+    return rng.uniform(0.1, 1, size=(6, 7, 3)), ['red', 'nir', 'thermal']
+
+def test_expression_matches_numpy():
+    """Indexes and channels in the expression should be resolved and evaluated vectorially."""
+    img, channels = _image()
+    expression = ThresholdExpression('(NDVI > 0.1) & (thermal < 0.5) | ~(red >= 0.9)')
+    assert expression.indexes == ['NDVI']
+    assert sorted(expression.channels) == ['red', 'thermal']
+    selection, planes = expression.evaluate(img, channels)
+    ndvi = mri.NDVI(img, channels)
+    expected = ((ndvi > 0.1) & (img[:, :, 2] < 0.5)) | ~(img[:, :, 0] >= 0.9)
+    assert np.array_equal(selection, expected)
+    assert np.allclose(planes['NDVI'], ndvi)
+
+def test_chained_comparison_and_reuse():
+    """Chained comparisons are joined with a logical and, passed planes are not recomputed."""
+    img, channels = _image()
+    fake = np.full(img.shape[0:2], 0.5)
+    selection, planes = ThresholdExpression('0.4 < NDVI < 0.6').evaluate(img, channels, {'NDVI': fake})
+    assert np.all(selection)
+    assert planes['NDVI'] is fake
+
+def test_rejected_expressions():
+    """Anything outside the whitelist, and unknown names, should raise ValueError."""
+    img, channels = _image()
+    for text in ['__import__("os").system("ls")', 'red.sum() > 1', 'NDVI >', '[red]']:
+        with pytest.raises(ValueError):
+            ThresholdExpression(text)
+    with pytest.raises(ValueError):
+        ThresholdExpression('blue > 0').evaluate(img, channels)
+
+def test_pickle():
+    """Expressions are sent to worker processes, and should survive pickling."""
+    img, channels = _image()
+    expression = pickle.loads(pickle.dumps(ThresholdExpression('NDVI > 0.2')))
+    selection, planes = expression.evaluate(img, channels)
+    assert selection.shape == img.shape[0:2]
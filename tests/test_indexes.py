@@ -13,3 +13,40 @@ def test_basic_stub():
     assert result.shape == nir.shape
     assert np.all(np.isfinite(result))
 
+
+def test_batch_matches_single_functions():
+    """The fused batch evaluation should return the same values as the single index functions."""
+    rng = np.random.default_rng(0)
+    channel_list = ['red', 'green', 'blue', 'nir', 'rededge', 'thermal']
+    test_image = rng.uniform(0.1, 1, size=(4, 5, len(channel_list)))
+    names = ['NDVI', 'GLI', 'EVI', 'CIG', 'NDRE', 'TVI_transformed', 'TVI', 'HUE']
+
+    result = mri.compute_indexes(test_image, channel_list, names)
+    assert result.shape == (len(names), 4, 5)
+    for k, name in enumerate(names):
+        expected = getattr(mri, name)(test_image, channel_list)
+        assert np.allclose(result[k], expected, equal_nan=True)
+
+def test_batch_missing_channels_and_float32():
+    """Indexes needing missing channels are NaN, and the requested dtype is honored."""
+    red = np.array([[1, 2, 3], [4, 5, 6]])
+    nir = np.array([[2, 2, 4], [4, 6, 6]])
+    test_image = np.stack((red, nir), axis=2)
+
+    result = mri.compute_indexes(test_image, ['red', 'nir'], ['NDVI', 'NDRE'], dtype=np.float32)
+    assert result.dtype == np.float32
+    assert np.allclose(result[0], mri.NDVI(test_image, ['red', 'nir']))
+    assert np.all(np.isnan(result[1]))
+
+def test_required_channels():
+    """Every index should declare its channels, and work with just those."""
+    functions = [name for name in dir(mri) if callable(getattr(mri, name)) and not name.startswith('_')
+                 and getattr(mri, name).__module__ == mri.__name__ and name != 'compute_indexes']
+    assert sorted(functions) == sorted(mri.REQUIRED_CHANNELS.keys())
+    rng = np.random.default_rng(0)
+    for name, channels in mri.REQUIRED_CHANNELS.items():
+        if name == 'random_matrix':
+            continue
+        img = rng.uniform(0.1, 1, size=(4, 5, len(channels)))
+        result = mri.compute_indexes(img, channels, [name])[0]
+        assert np.any(np.isfinite(result)), name
@@ -0,0 +1,157 @@
+import os
+import pytest
+import numpy as np
+
+def test_outside_rois_have_all_columns(make_dataset, make_task, read_results):
+	"""ROIs outside the image get NaN for every index column, even when they come first and the header is written with them."""
+	dataset = make_dataset(rois=[(100, 100, 110, 110), (3, 3, 13, 13), (20, 5, 30, 15)])
+	task = make_task(indexes='NDVI,summation,red', flush_rows=1)
+	task.run(dataset)
+
+	res = read_results(task, dataset)
+	assert list(res['roi_status']) == ['outside', 'inside', 'inside']
+	for column in ['NDVI_mean', 'red_median', 'summation']:
+		assert np.isnan(res[column][0])
+		assert np.all(np.isfinite(res[column][1:]))
+
+def _rois(**changes):
+	"""the ROIs used in the incremental tests, as a {plot_id : box} dict, with the passed changes (None removes a ROI)"""
+	rois = {1: (3, 3, 13, 13), 2: (18, 3, 28, 13), 3: (33, 3, 43, 13), 4: (3, 18, 13, 28), 5: (18, 18, 28, 28)}
+	for key, roi in changes.items():
+		plot_id = int(key[1:])
+		if roi is None:
+			del rois[plot_id]
+		else:
+			rois[plot_id] = roi
+	return rois
+
+def test_incremental_rois(make_dataset, make_task, read_results):
+	"""New and changed ROIs are computed, removed ones dropped, up to date ones kept as they were."""
+	first = make_dataset(rois=_rois())
+	make_task(indexes='NDVI,random_array', incremental=True).run(first)
+	before = read_results(make_task(), first).set_index('plot_id')
+
+	#ROI 2 is moved, ROI 3 removed and ROI 6 added
+	second = make_dataset(rois=_rois(p2=(20, 5, 30, 15), p3=None, p6=(33, 18, 43, 28)), image_file=first.test_image_file, title=first.get_title())
+	task = make_task(indexes='NDVI,random_array', incremental=True)
+	task.run(second)
+	after = read_results(task, second)
+	assert list(after['plot_id']) == [1, 2, 4, 5, 6]
+	assert after['plot_id'].dtype == np.int64
+	after = after.set_index('plot_id')
+	for plot_id in [1, 4, 5]:
+		assert after.loc[plot_id, 'first_random_value'] == before.loc[plot_id, 'first_random_value']
+	assert after.loc[2, 'first_random_value'] != before.loc[2, 'first_random_value']
+
+	#same values as a full computation
+	make_task(indexes='NDVI,random_array').run(second)
+	full = read_results(task, second).set_index('plot_id')
+	assert np.allclose(after['NDVI_mean'], full['NDVI_mean'])
+	assert np.allclose(after['centroid_x'], full['centroid_x'])
+
+def test_incremental_indexes(make_dataset, make_task, read_results):
+	"""Added indexes are computed on the existing ROIs, removed ones dropped, and nothing is written if nothing changed."""
+	dataset = make_dataset(rois=_rois())
+	make_task(indexes='NDVI,red', incremental=True).run(dataset)
+	before = read_results(make_task(), dataset)
+
+	task = make_task(indexes='NDVI,nir', incremental=True)
+	task.run(dataset)
+	after = read_results(task, dataset)
+	assert 'red_mean' not in after.columns
+	assert np.allclose(after['NDVI_mean'], before['NDVI_mean'])
+	assert np.all(np.isfinite(after['nir_mean']))
+
+	#a second identical run does not touch the results
+	outfile = os.path.join(task.config['outfolder'], 'indexes_' + dataset.get_title() + '.csv')
+	mtime = os.stat(outfile).st_mtime_ns
+	make_task(indexes='NDVI,nir', incremental=True).run(dataset)
+	assert os.stat(outfile).st_mtime_ns == mtime
+
+def test_incremental_changed_inputs(make_dataset, make_task, read_results):
+	"""Changing parameters that affect the pixel values forces a full computation, no state is kept outside incremental mode."""
+	first = make_dataset(rois=_rois())
+	make_task(indexes='random_array', incremental=True).run(first)
+	before = read_results(make_task(), first)
+
+	second = make_dataset(rois=_rois(), image_file=first.test_image_file, title=first.get_title(), max_value=2)
+	task = make_task(indexes='random_array', incremental=True)
+	task.run(second)
+	after = read_results(task, second)
+	assert np.all(after['first_random_value'] != before['first_random_value'])
+
+	state_file = os.path.join(task.config['outfolder'], 'indexes_' + first.get_title() + '.json')
+	assert os.path.isfile(state_file)
+	make_task(indexes='random_array').run(second)
+	assert not os.path.isfile(state_file)
+
+def test_incremental_parquet(make_dataset, make_task, read_results):
+	"""Merged tables keep the ROI fields types, so that columnar formats can be written."""
+	pytest.importorskip('pyarrow')
+	first = make_dataset(rois=_rois(p5=None))
+	make_task(indexes='NDVI', incremental=True, output_format='parquet').run(first)
+
+	second = make_dataset(rois=_rois(), image_file=first.test_image_file, title=first.get_title())
+	task = make_task(indexes='NDVI,red', incremental=True, output_format='parquet')
+	task.run(second)
+	after = read_results(task, second)
+	assert list(after['plot_id']) == [1, 2, 3, 4, 5]
+	assert after['plot_id'].dtype == np.int64
+	assert np.all(np.isfinite(after['red_mean']))
+
+def test_zonal_matches_serial(make_dataset, make_task, read_results):
+	"""The zonal execution mode gives the same rows as the serial one, also when only some channels are missing."""
+	dataset = make_dataset(image_nodata=-1, nodata_pixels=(slice(5, 8), slice(5, 8), 0), label_image=True)
+	results = {}
+	for execution in ['serial', 'zonal']:
+		task = make_task(indexes='NDVI,nir', threshold='nir > 0.3', execution=execution)
+		task.run(dataset)
+		results[execution] = read_results(task, dataset)
+	serial, zonal = results['serial'], results['zonal']
+	assert list(zonal['pixels']) == list(serial['pixels'])
+	assert list(zonal['pixels_after_threshold']) == list(serial['pixels_after_threshold'])
+	for column in ['NDVI_mean', 'NDVI_median', 'NDVI_min', 'nir_mean', 'nir_max']:
+		assert np.allclose(zonal[column], serial[column])
+
+def test_pipeline_matches_serial(make_dataset, make_task, read_results):
+	"""The pipeline execution mode gives the same table as the serial one, in shapefile order."""
+	pd = pytest.importorskip('pandas')
+	dataset = make_dataset(rois=[(100, 100, 110, 110)] + [(3 + 6 * i, 3 + 5 * j, 9 + 6 * i, 8 + 5 * j) for j in range(8) for i in range(10)])
+	results = {}
+	for execution in ['serial', 'pipeline']:
+		task = make_task(indexes='NDVI,GLI,thermal', execution=execution, roi_order='hilbert', reader_threads=2, compute_threads=3, queue_depth=2)
+		task.run(dataset)
+		results[execution] = read_results(task, dataset)
+	pd.testing.assert_frame_equal(results['pipeline'], results['serial'])
+
+def test_pipeline_reraises_errors(make_dataset, make_task, monkeypatch):
+	"""Errors in the compute and in the reader threads stop the pipeline and are raised again, instead of hanging."""
+	dataset = make_dataset()
+	with pytest.raises(ValueError, match='unknown index'):
+		make_task(indexes='NDVI,not_an_index', execution='pipeline', queue_depth=1).run(dataset)
+
+	def broken_reader(*args, **kwargs):
+		raise OSError('cannot read')
+	monkeypatch.setattr(type(dataset), 'iter_geom_blocks', broken_reader)
+	with pytest.raises(OSError, match='cannot read'):
+		make_task(indexes='NDVI', execution='pipeline').run(dataset)
+
+def test_parallel_matches_serial(make_dataset, make_task, read_results):
+	"""The process pool execution mode gives the same table as the serial one, in shapefile order."""
+	pd = pytest.importorskip('pandas')
+	dataset = make_dataset(rois=[(100, 100, 110, 110), (60, 40, 70, 50)] + [(3 + 6 * i, 3 + 5 * j, 9 + 6 * i, 8 + 5 * j) for j in range(4) for i in range(5)])
+	results = {}
+	for execution in ['serial', 'parallel']:
+		task = make_task(indexes='NDVI,red,summation', threshold='nir > 0.3', execution=execution, cores=2)
+		task.run(dataset)
+		results[execution] = read_results(task, dataset)
+	assert list(results['serial']['roi_status'][0:2]) == ['outside', 'partial']
+	pd.testing.assert_frame_equal(results['parallel'], results['serial'])
+
+def test_zonal_rejects_image_wide_indexes(make_task):
+	"""Indexes needing the whole ROI cannot be computed in zonal mode, neither as outputs nor in the threshold."""
+	with pytest.raises(ValueError, match='TVI'):
+		make_task(indexes='NDVI,TVI', execution='zonal')
+	with pytest.raises(ValueError, match='TVI'):
+		make_task(indexes='NDVI', threshold='TVI > 0.5', execution='zonal')
+	make_task(indexes='NDVI', threshold='TVI > 0.5', execution='serial')
@@ -0,0 +1,21 @@
+import numpy as np
+from d2r.ordering import spatial_order, hilbert_keys, ROI_ORDERS
+
+def test_hilbert_curve_is_continuous():
+    """Consecutive cells along the Hilbert curve should be neighbours."""
+    xs, ys = np.meshgrid(np.arange(8), np.arange(8))
+    xs, ys = xs.ravel(), ys.ravel()
+    order = np.argsort(hilbert_keys(xs, ys))
+    assert np.all(np.abs(np.diff(xs[order])) + np.abs(np.diff(ys[order])) == 1)
+
+def test_spatial_order_is_a_permutation():
+    """Every order should return each ROI exactly once, keeping ROIs in the same block together."""
+    rng = np.random.default_rng(0)
+    windows = np.column_stack((rng.integers(5, 50, 100), rng.integers(5, 50, 100),
+                               rng.integers(-20, 2000, 100), rng.integers(-20, 2000, 100)))
+    for method in ROI_ORDERS:
+        order = spatial_order(windows, (256, 256), method)
+        assert sorted(order) == list(range(100))
+    order = spatial_order(windows, (256, 256), 'block_row')
+    rows = np.maximum(windows[order, 3] + windows[order, 1] // 2, 0) // 256
+    assert np.all(np.diff(rows) >= 0)
@@ -0,0 +1,29 @@
+import numpy as np
+from d2r.raster_block import RasterBlock, statistics
+
+def test_statistics_match_masked_arrays():
+    """Statistics on dense blocks should match the np.ma ones."""
+    rng = np.random.default_rng(0)
+    data = rng.uniform(size=(6, 5, 2))
+    valid = rng.uniform(size=(6, 5)) > 0.3
+    data[~valid, :] = np.nan
+    block = RasterBlock(data, valid, ['red', 'nir'])
+
+    masked = block.to_masked()[:, :, 1]
+    stats = statistics('nir', block.get_channel('nir'), block.valid)
+    assert np.isclose(stats['nir_mean'], np.ma.mean(masked))
+    assert np.isclose(stats['nir_median'], np.ma.median(masked))
+    assert np.isclose(stats['nir_std'], np.ma.std(masked))
+    assert np.isclose(stats['nir_max'], np.ma.max(masked))
+    assert np.isclose(stats['nir_min'], np.ma.min(masked))
+
+def test_select_and_empty_statistics():
+    """Selecting pixels shrinks the valid mask, no valid pixel means NaN statistics."""
+    block = RasterBlock(np.ones((2, 2, 1)), np.ones((2, 2), dtype=bool), ['red'])
+    block.select(np.array([[True, False], [False, False]]))
+    assert block.count() == 1
+    assert np.ma.count(block.to_masked()) == 1
+
+    block.select(np.zeros((2, 2), dtype=bool))
+    stats = statistics('red', block.get_channel('red'), block.valid)
+    assert np.isnan(stats['red_mean'])
@@ -0,0 +1,23 @@
+import numpy as np
+from d2r.read_planner import plan_reads
+
+def test_grid_is_grouped_within_budget():
+    """A grid of small plots should be read with a few block-aligned windows, each ROI in exactly one of them."""
+    #a 10 x 10 grid of 20 x 20 plots, 5 pixels apart
+    xs, ys = np.meshgrid(np.arange(10) * 25, np.arange(10) * 25)
+    windows = np.column_stack((np.full(100, 20), np.full(100, 20), xs.ravel(), ys.ravel()))
+    groups = plan_reads(windows, range(100), (64, 64), (1000, 1000), max_bytes=128 * 128 * 8, bytes_per_pixel=8)
+    assert sorted(p for g in groups for p in g.positions) == list(range(100))
+    assert len(groups) < 50
+    for g in groups:
+        x, y, w, h = g.window
+        assert w * h * 8 <= 128 * 128 * 8 or len(g.positions) == 1
+        for p in g.positions:
+            x_size, y_size, x_offset, y_offset = windows[p]
+            assert x <= x_offset and x_offset + x_size <= x + w and y <= y_offset and y_offset + y_size <= y + h
+
+def test_no_budget_reads_each_roi():
+    """With no memory budget each ROI is read by itself, clipped to the image."""
+    windows = np.array([[20, 20, -5, 0], [20, 20, 10, 10]])
+    groups = plan_reads(windows, [0, 1], (64, 64), (100, 100), max_bytes=0, bytes_per_pixel=8)
+    assert [g.window for g in groups] == [(0, 0, 15, 20), (10, 10, 20, 20)]
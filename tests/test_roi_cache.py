@@ -0,0 +1,41 @@
+import numpy as np
+from d2r.raster_block import RasterBlock
+from d2r.roi_cache import ROICache
+
+def make_block(value):
+    return RasterBlock(np.full((4, 4, 2), value, dtype=np.float32), np.ones((4, 4), dtype=bool), ['red', 'nir'])
+
+def test_disk_tier_survives_new_cache(tmp_path):
+    """Blocks saved by a cache should be read back (memory mapped) by a new cache on the same folder."""
+    cache = ROICache(str(tmp_path), 0, 'dataset', ['red', 'nir'])
+    assert cache.get(3) is None
+    cache.put(3, make_block(7))
+
+    block = ROICache(str(tmp_path), 0, 'dataset', ['red', 'nir']).get(3)
+    assert isinstance(block.data, np.memmap)
+    assert np.all(block.get_channel('nir') == 7)
+
+    #restricting the returned block leaves the cached data untouched
+    block.select(np.zeros((4, 4), dtype=bool))
+    assert np.all(cache.get(3).data == 7)
+
+def test_memory_tier_evicts_least_recently_used():
+    """The memory tier should stay within its budget, dropping the oldest blocks."""
+    block_size = make_block(0).data.nbytes + make_block(0).valid.nbytes
+    cache = ROICache(None, 2 * block_size, 'dataset', ['red', 'nir'])
+    for key in range(3):
+        cache.put(key, make_block(key))
+    assert cache.get(0) is None
+    assert cache.get(2).data[0, 0, 0] == 2
+    assert cache.used_bytes <= 2 * block_size
+
+def test_memory_tier_replaces_stored_blocks():
+    """Storing a block again replaces the previous one, without counting its size twice."""
+    block_size = make_block(0).data.nbytes + make_block(0).valid.nbytes
+    cache = ROICache(None, 2 * block_size, 'dataset', ['red', 'nir'])
+    for value in range(3):
+        cache.put(0, make_block(value))
+    assert cache.used_bytes == block_size
+    assert cache.get(0).data[0, 0, 0] == 2
+    cache.put(1, make_block(1))
+    assert cache.get(0) is not None and cache.get(1) is not None
@@ -0,0 +1,80 @@
+import os
+import logging
+import pytest
+import numpy as np
+from d2r.scheduler import make_jobs, run_jobs
+
+class _Task:
+	def __init__(self, title, fail=False):
+		self.title = title
+		self.fail = fail
+		self.config = {}
+	def to_string(self):
+		return self.title
+	def run(self, dataset):
+		if self.fail:
+			raise RuntimeError('task failed')
+		dataset.done.append(self.title)
+
+class _Dataset:
+	def __init__(self, title):
+		self.title = title
+		self.done = []
+		self.closed = False
+	def get_title(self):
+		return self.title
+	def close(self):
+		self.closed = True
+
+def test_make_jobs():
+	"""Jobs follow the requested loop order."""
+	tasks, datasets = ['t1', 't2'], ['d1', 'd2']
+	assert make_jobs(tasks, datasets, 'task') == [('d1', ['t1'], False), ('d2', ['t1'], False), ('d1', ['t2'], True), ('d2', ['t2'], True)]
+	assert make_jobs(tasks, datasets, 'dataset') == [('d1', tasks, True), ('d2', tasks, True)]
+	assert make_jobs(tasks, datasets, 'task', parallel=True) == [('d1', tasks, True), ('d2', tasks, True)]
+	with pytest.raises(ValueError):
+		make_jobs(tasks, datasets, 'random')
+
+def test_failures_do_not_stop_other_tasks():
+	"""A failing task is reported, the following ones still run and the dataset is closed."""
+	dataset = _Dataset('d1')
+	failures = run_jobs([(dataset, [_Task('t1', fail=True), _Task('t2')], True)], logger=logging.getLogger('test'))
+	assert [failure[0:2] for failure in failures] == [('t1', 'd1')]
+	assert 'RuntimeError' in failures[0][2]
+	assert dataset.done == ['t2']
+	assert dataset.closed
+
+def test_dataset_closed_after_last_task():
+	"""With loop_order 'task' each dataset is closed only after the last task using it."""
+	class _Closing(_Task):
+		def run(self, dataset):
+			assert not dataset.closed
+			super().run(dataset)
+	datasets = [_Dataset('d1'), _Dataset('d2')]
+	failures = run_jobs(make_jobs([_Closing('t1'), _Closing('t2')], datasets, 'task'), logger=logging.getLogger('test'))
+	assert failures == []
+	for dataset in datasets:
+		assert dataset.done == ['t1', 't2']
+		assert dataset.closed
+
+def test_parallel_jobs(make_dataset, make_task, read_results, tmp_path):
+	"""Jobs run in worker processes give the same results, each with its own log file."""
+	datasets = [make_dataset(), make_dataset()]
+	task = make_task(indexes='NDVI', cores=2)
+	failures = run_jobs(make_jobs([task], datasets), cores=2, logfolder=str(tmp_path / 'jobs'), logger=logging.getLogger('test'))
+	assert failures == []
+	for dataset in datasets:
+		assert len(read_results(task, dataset)) == 12
+	assert len(os.listdir(tmp_path / 'jobs')) == 2
+
+def test_parallel_jobs_share_overviews(make_dataset, make_task, read_results, tmp_path):
+	"""Tasks on the same dataset are not run in concurrent processes, which would build its overviews at the same time."""
+	data = np.random.default_rng(0).uniform(0.1, 1, size=(520, 520, 3)).astype(np.float32)
+	dataset = make_dataset(data=data, overviews=True, overviews_folder=tmp_path / 'overviews')
+	tasks = [make_task(indexes='NDVI'), make_task(indexes='red')]
+	jobs = make_jobs(tasks, [dataset], 'task', parallel=True)
+	assert len(jobs) == 1
+	failures = run_jobs(jobs, cores=2, logfolder=str(tmp_path / 'jobs'), logger=logging.getLogger('test'))
+	assert failures == []
+	assert 'red_mean' in read_results(tasks[1], dataset).columns
+	assert len([f for f in os.listdir(tmp_path / 'overviews') if f.endswith('.vrt.ovr')]) == 1
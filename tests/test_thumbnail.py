@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+def test_thumbnails_from_a_single_read(make_dataset, tmp_path):
+	"""All the thresholded thumbnails are built from the same resized image, with the requested size."""
+	Image = pytest.importorskip('PIL.Image')
+	import d2r.tasks.thumbnail
+	dataset = make_dataset()
+	config = {
+		'outfolder': str(tmp_path / 'thumbnails'),
+		'logfolder': str(tmp_path / 'logs'),
+		'active': 'True',
+		'skip_if_already_done': 'False',
+		'verbose': 'False',
+		'output_width': '32',
+		'rescale_to_255': 'True',
+		'draw_rois': 'True',
+		'index_investigated': 'NDVI',
+		'index_thresholds': '0,10',
+	}
+	task = d2r.tasks.thumbnail.thumbnail('thumbnail', config)
+	task.run(dataset)
+
+	images = {threshold: np.asarray(Image.open(task._get_outfile(dataset, threshold))) for threshold in [None, 0.0, 10.0]}
+	for image in images.values():
+		assert image.shape == (24, 32, 3)
+	#NDVI is never above 10, while about half of the (random) pixels are above 0
+	assert np.array_equal(images[10.0], images[None])
+	assert not np.array_equal(images[0.0], images[None])
@@ -0,0 +1,34 @@
+import numpy as np
+from d2r.zonal import QuantileSketch, ZonalAccumulator
+
+def test_accumulator_matches_numpy():
+    """Statistics accumulated over several blocks should match the ones computed on each whole zone."""
+    rng = np.random.default_rng(0)
+    zones = rng.integers(0, 3, size=1000)
+    values = rng.normal(size=1000)
+
+    acc = ZonalAccumulator(4)
+    for start in range(0, 1000, 128):
+        acc.update(zones[start:start + 128], values[start:start + 128])
+
+    for zone in range(3):
+        expected = values[zones == zone]
+        stats = acc.statistics(zone)
+        assert np.isclose(stats['mean'], np.mean(expected))
+        assert np.isclose(stats['median'], np.median(expected))
+        assert np.isclose(stats['std'], np.std(expected))
+        assert stats['max'] == np.max(expected)
+        assert stats['min'] == np.min(expected)
+
+    # the fourth zone never received values
+    assert np.isnan(acc.statistics(3)['mean'])
+
+def test_sketch_approximates_median():
+    """Once compressed, the sketch median should stay close to the exact one."""
+    values = np.random.default_rng(1).uniform(size=20000)
+    sketch = QuantileSketch(capacity=512)
+    for chunk in np.array_split(values, 40):
+        sketch.update(chunk)
+    assert not sketch.exact
+    assert sketch.count() == len(values)
+    assert abs(sketch.quantile(0.5) - np.median(values)) < 0.01